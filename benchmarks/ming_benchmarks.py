@@ -0,0 +1,244 @@
+'''Rough performance comparisons between alternative code paths in Ming.
+
+Usage: python benchmarks/ming_benchmarks.py [scale] [name ...]
+
+Each benchmark times the paths it compares and prints the results.  scale
+(default 1) multiplies the amount of work done; the names select which
+benchmarks to run (all by default).  The ming.tests.test_fast_paths tests
+check that the paths being compared agree.'''
+import os
+import sys
+import gc
+import time
+from copy import deepcopy
+from datetime import datetime
+
+# Run against the checkout this script lives in
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ming import schema as S
+from ming import datastore as DS
+from ming import mim
+from ming import collection, Field, Session
+from ming.base import Object
+from ming.odm import ODMSession
+
+def _timeit(func, repeat):
+    begin = time.time()
+    for i in xrange(repeat):
+        result = func()
+    return time.time() - begin, result
+
+def _report(name, count, **timings):
+    print '%s (%d iterations):' % (name, count)
+    for label, elapsed in sorted(timings.items()):
+        print '    %-14s %.4fs (%.0f/s)' % (
+            label, elapsed, count / max(elapsed, 1e-9))
+
+def bench_compiled_validation(scale):
+    count = int(2000 * scale)
+    schema = S.SchemaItem.make(dict(
+            _id=S.ObjectId(),
+            name=str,
+            created=datetime,
+            tags=[str],
+            author=dict(name=str, email=str, score=float),
+            comments=[dict(
+                    author=str,
+                    text=str,
+                    posted=datetime,
+                    votes=dict(up=int, down=int))],
+            meta={str:None}))
+    now = datetime.utcnow()
+    doc = dict(
+        name='A benchmark', created=now,
+        tags=[ 'tag%d' % i for i in range(10) ],
+        author=dict(name='Rick', email='rick@example.com', score=4.5),
+        comments=[
+            dict(author='user%d' % i, text='comment text %d' % i,
+                 posted=now, votes=dict(up=i, down=0))
+            for i in range(20) ],
+        meta=dict(a=1, b=2, c=3))
+    validate = schema.validate
+    compiled = schema.compiled()
+    interpreted_time, _ = _timeit(lambda: validate(doc), count)
+    compiled_time, _ = _timeit(lambda: compiled(doc), count)
+    _report('Nested document validation', count,
+            interpreted=interpreted_time, compiled=compiled_time)
+
+def bench_missing_defaults(scale):
+    count = int(5000 * scale)
+    default = dict(
+        flags=dict(a=True, b=False), history=[],
+        limits=dict(daily=[1, 2, 3], monthly=dict(max=10, used=0)))
+    schema = S.SchemaItem.make(dict(
+            _id=int,
+            settings=S.Anything(if_missing=default),
+            profile=dict(
+                name=str,
+                address=dict(street=str, city=str, zip=str),
+                prefs=dict(color=S.String(if_missing='blue'),
+                           tags=[str]))))
+    compiled = schema.compiled()
+    deepcopy_time, _ = _timeit(lambda: deepcopy(default), count)
+    copier_time, _ = _timeit(S._copier(default), count)
+    validate_time, _ = _timeit(lambda: compiled(dict(_id=1)), count)
+    _report('Missing field defaults', count,
+            deepcopy=deepcopy_time, copier=copier_time,
+            sparse_doc=validate_time)
+
+def bench_indexed_find(scale):
+    count = int(5000 * scale)
+    db = mim.Connection().benchmark
+    for name in ('plain', 'indexed'):
+        db[name].insert([ dict(_id=i, a=i % 100, b=i) for i in xrange(count) ])
+    db.indexed.ensure_index('a')
+    db.indexed.ensure_index('b')
+    def query(coll):
+        return [
+            len(list(coll.find(dict(a=i)))) +
+            len(list(coll.find(dict(b={'$gte':count - i * 10})))) +
+            len(list(coll.find(dict(b={'$gt':count - 5}))))
+            for i in range(20) ]
+    plain_time, _ = _timeit(lambda: query(db.plain), 1)
+    indexed_time, _ = _timeit(lambda: query(db.indexed), 1)
+    _report('mim queries over %d documents' % count, 60,
+            scan=plain_time, indexed=indexed_time)
+
+def bench_compiled_match(scale):
+    # scale 5 gives 100k documents
+    count = int(20000 * scale)
+    docs = [ dict(_id=i, a=i % 100, b=dict(c=i % 7, d=[i, i + 1]),
+                  tags=[ 'tag%d' % (i % 10), 'other' ])
+             for i in xrange(count) ]
+    specs = [
+        {'$or':[{'a':{'$in':[1, 2, 3]}}, {'b.c':{'$gt':5}}]},
+        {'b.d':{'$in':[10, 20, 30]}, 'tags':'tag0'},
+        {'a':{'$gte':50}, '$or':[{'tags':'tag1'}, {'b.c':3}]} ]
+    def interpreted():
+        return [ sum(1 for d in docs if mim.match(spec, d))
+                 for spec in specs ]
+    def compiled():
+        result = []
+        for spec in specs:
+            predicate = mim.compile_spec(spec)
+            result.append(sum(1 for d in docs if predicate(d)))
+        return result
+    interpreted_time, _ = _timeit(interpreted, 1)
+    compiled_time, _ = _timeit(compiled, 1)
+    _report('mim matching over %d documents' % count, len(specs),
+            per_document=interpreted_time, compiled=compiled_time)
+
+def bench_copy_on_write_reads(scale):
+    count = int(2000 * scale)
+    doc = dict(
+        a=1, tags=[ 'tag%d' % i for i in range(10) ],
+        comments=[ dict(author='user%d' % i, votes=dict(up=i, down=0))
+                   for i in range(20) ])
+    timings = {}
+    for copy_on_write in (False, True):
+        coll = mim.Connection(copy_on_write=copy_on_write).db.coll
+        for i in xrange(count):
+            doc['_id'] = i
+            coll.insert(doc)
+        label = copy_on_write and 'copy_on_write' or 'copy'
+        timings[label], _ = _timeit(
+            lambda: sum(d['a'] for d in coll.find()), 1)
+    _report('mim reads of nested documents', count, **timings)
+
+def _record_datastore(count):
+    datastore = DS.DataStore('mim:///', database='benchmark')
+    datastore.conn.drop_all()
+    datastore.db.record.insert([
+            dict(_id=i, name='record %d' % i, tags=['a', 'b'],
+                 meta=dict(a=i, b=1), extra=dict(x=dict(y=i)))
+            for i in xrange(count) ])
+    return datastore
+
+def bench_session(scale):
+    count = int(2000 * scale)
+    datastore = _record_datastore(count)
+    session = Session(bind=datastore)
+    Record = collection(
+        'record', session,
+        Field('_id', int),
+        Field('name', str),
+        Field('tags', [str]),
+        Field('meta', dict(a=int, b=int)),
+        Field('extra', None))
+    coll = datastore.db.record
+    def from_bson():
+        # decode into dicts and convert them afterwards
+        return sum(Object.from_bson(d)['meta']['a'] for d in coll.find())
+    def find(validate):
+        return sum(
+            d.meta.a for d in session.find(Record, validate=validate))
+    from_bson_time, _ = _timeit(from_bson, 1)
+    validate_time, _ = _timeit(lambda: find(True), 1)
+    raw_time, _ = _timeit(lambda: find(False), 1)
+    prefetch_time, _ = _timeit(lambda: sum(
+            d.meta.a for d in session.find(Record).prefetch()), 1)
+    _report('Session.find', count, from_bson=from_bson_time,
+            validate=validate_time, no_validate=raw_time,
+            prefetch=prefetch_time)
+    access_count = int(20000 * scale)
+    doc = session.get(Record, _id=0)
+    access_time, _ = _timeit(lambda: doc.m, access_count)
+    _report('doc.m', access_count, access=access_time)
+    datastore.conn.drop_all()
+
+def bench_odm(scale):
+    count = int(2000 * scale)
+    datastore = _record_datastore(count)
+    session = ODMSession(Session(bind=datastore))
+    record = collection(
+        'record', session.impl,
+        Field('_id', int),
+        Field('name', str),
+        Field('tags', [str]),
+        Field('meta', dict(a=int, b=int)),
+        Field('extra', None))
+    class Record(object): pass
+    session.mapper(Record, record)
+    def scan():
+        session.clear()
+        return sum(r.meta['a'] for r in Record.query.find())
+    def stream():
+        session.clear()
+        return sum(r.meta['a'] for r in Record.query.find().stream())
+    scan_time, _ = _timeit(scan, 1)
+    stream_time, _ = _timeit(stream, 1)
+    _report('ODM scan', count, session=scan_time, stream=stream_time)
+    def load(**options):
+        session.clear()
+        return Record.query.find().options(**options).all()
+    def allocated(**options):
+        'gc-tracked objects kept alive per loaded document'
+        load(**options)
+        session.clear()
+        gc.collect()
+        before = len(gc.get_objects())
+        objs = load(**options)
+        gc.collect()
+        return float(len(gc.get_objects()) - before) / len(objs)
+    print 'ODM objects kept per loaded document: %.1f (%.1f without ' \
+        'original_document)' % (
+        allocated(), allocated(original_document=False))
+    access_count = int(20000 * scale)
+    obj = Record.query.get(_id=0)
+    access_time, _ = _timeit(lambda: obj.query, access_count)
+    _report('obj.query', access_count, access=access_time)
+    session.clear()
+    datastore.conn.drop_all()
+
+def main(args):
+    scale = 1.0
+    if args and not args[0].startswith('bench_'):
+        scale = float(args.pop(0))
+    names = args or sorted(
+        name for name in globals() if name.startswith('bench_'))
+    for name in names:
+        globals()[name](scale)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
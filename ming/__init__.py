@@ -29,6 +29,11 @@ def configure(**kwargs):
         authenticate=AuthenticateSchema(if_missing=None)
         connect_retry=validators.Number(if_missing=3, if_empty=0)
         use_gevent = validators.Bool(if_missing=False)
+        circuit_breaker = validators.Bool(if_missing=False)
+        backoff = validators.Number(if_missing=1.0)
+        max_backoff = validators.Number(if_missing=60.0)
+        failure_threshold = validators.Int(if_missing=3)
+        failure_window = validators.Number(if_missing=10.0)
         # pymongo
         network_timeout=validators.Number(if_missing=None, if_empty=None)
         tz_aware=validators.Bool(if_missing=False)
@@ -1,4 +1,5 @@
 import os
+import time
 import logging
 
 import pymongo
@@ -6,13 +7,17 @@ import gevent
 from gevent.queue import Queue, Empty
 from gevent.local import local
 
+from .metrics import Metrics
+
 class AsyncConnection(pymongo.Connection):
 
     def __init__(self, *args, **kwargs):
+        self._metrics = kwargs.pop('metrics', None)
         super(AsyncConnection, self).__init__(_connect=False, *args, **kwargs)
         self._Connection__pool = AsyncPool(
             self._Connection__connect,
-            self._Connection__max_pool_size)
+            self._Connection__max_pool_size,
+            self._metrics)
         self._Connection__find_master()
 
     def __repr__(self):
@@ -24,15 +29,19 @@ class AsyncConnection(pymongo.Connection):
     def disconnect(self):
         self._Connection__pool = AsyncPool(
             self._Connection__connect,
-            self._Connection__max_pool_size)
+            self._Connection__max_pool_size,
+            self._metrics)
         self._Connection__host = None
         self._Connection__port = None
         
 class AsyncPool(object):
 
-    __slots__ = ["sockets", "socket_factory", "pool_size", "log", "local", "pid" ]
+    __slots__ = ["sockets", "socket_factory", "pool_size", "log", "local", "pid",
+                 "metrics" ]
 
-    def __init__(self, socket_factory, pool_size):
+    def __init__(self, socket_factory, pool_size, metrics=None):
+        if metrics is None: metrics = Metrics()
+        self.metrics = metrics
         self.pid = os.getpid()
         self.pool_size = pool_size
         self.socket_factory = socket_factory
@@ -58,13 +67,22 @@ class AsyncPool(object):
             self.log.debug('Return existing socket to greenlet %s', gevent.getcurrent() )
             return self.sock
         gl = gevent.getcurrent()
+        begin = time.time()
         try:
             self.sock = self.sockets.get_nowait()
             self.log.debug('Checkout socket %s to greenlet %s',
                            self.sock, gl )
         except Empty:
-            self.sock = self.socket_factory()
+            try:
+                self.sock = self.socket_factory()
+            except:
+                self.metrics.incr('pool_create_failures')
+                raise
+            self.metrics.incr('pool_creations')
             self.log.debug('Create socket in greenlet %s', gl)
+        self.metrics.incr('pool_checkouts')
+        self.metrics.observe('pool_checkout_time', time.time() - begin)
+        self.metrics.gauge('pool_idle', self.sockets.qsize())
         self.sock.last_greenlet = gl
         return self.sock
 
@@ -78,8 +96,11 @@ class AsyncPool(object):
                            self.sock, gl)
             self.sockets.put(self.sock)
             self.sock = None
+            self.metrics.incr('pool_checkins')
         else:
             self.log.debug('Close socket in greenlet %s', gevent.getcurrent() )
             self.sock.close()
             self.sock = None
+            self.metrics.incr('pool_discards')
+        self.metrics.gauge('pool_idle', self.sockets.qsize())
         self.local.sock = None
@@ -0,0 +1,237 @@
+'''Non-blocking access to a Session, for callers running an event loop.
+
+Python 2 has no asyncio, so each operation runs on a worker thread and
+returns at once with a pending result (a multiprocessing.pool.AsyncResult).
+Call its get() to wait for the value (re-raising any exception), or pass
+callback= to have it called with the value if the operation succeeds.
+Callbacks run in order on a thread of their own (not a worker), so they
+may wait for other pending results; an event loop will usually use the
+callback to hand the value back to its own thread.  Validation and
+everything else is done by the wrapped Session.'''
+from __future__ import with_statement
+import sys
+import logging
+from Queue import Queue
+from collections import deque
+from threading import Lock, Event, Thread
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger(__name__)
+
+class _CallbackThread(object):
+    '''Runs callbacks, in the order they are queued, on a thread of its own.
+    Run on a worker (or on the pool's result handler, as apply_async does),
+    a callback that waited for another pending result would keep that
+    result from ever being delivered.'''
+
+    def __init__(self):
+        self._queue = Queue()
+        self._lock = Lock()
+        self._thread = None
+
+    def put(self, callback, value):
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(
+                    target=self._run, name='ming-async-callbacks')
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put((callback, value))
+
+    def _run(self):
+        while True:
+            callback, value = self._queue.get()
+            try:
+                callback(value)
+            except Exception:
+                log.exception('Error in callback %r', callback)
+
+_callbacks = _CallbackThread()
+
+def _deferred(callback):
+    'Wrap callback to run on the callback thread'
+    if callback is None: return None
+    return lambda value: _callbacks.put(callback, value)
+
+class PendingBatch(object):
+    '''The pending result of AsyncCursor.next_batch() or all(), with the
+    interface of an AsyncResult'''
+
+    def __init__(self, size, callback=None):
+        self.size = size
+        self._callback = callback
+        self._event = Event()
+        self._success = self._value = self._traceback = None
+
+    def ready(self):
+        return self._event.is_set()
+
+    def successful(self):
+        assert self.ready()
+        return self._success
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+
+    def get(self, timeout=None):
+        self.wait(timeout)
+        if not self.ready(): raise TimeoutError
+        if self._success: return self._value
+        raise type(self._value), self._value, self._traceback
+
+    def _set(self, result):
+        self._success, self._value, self._traceback = result
+        self._event.set()
+        if self._success and self._callback is not None:
+            _callbacks.put(self._callback, self._value)
+
+class AsyncCursor(object):
+    '''Reads a cursor in batches on worker threads.  While the caller handles
+    one batch, the next is already being fetched.
+
+    Requested batches are queued and served in order by a single job on the
+    pool at a time, so a cursor never ties up more than one worker, and
+    requesting a batch never waits for a read in progress.'''
+    batch_size = 100
+
+    def __init__(self, cursor, pool, batch_size=None):
+        self.cursor = cursor
+        self.pool = pool
+        if batch_size is not None:
+            self.batch_size = batch_size
+        # _lock guards the queues and _serving (true while a _serve job is
+        # scheduled or running)
+        self._lock = Lock()
+        self._waiting = deque()
+        self._prefetched = deque()
+        self._serving = False
+        self._exhausted = False
+
+    def _read(self, size):
+        batch = []
+        if self._exhausted: return batch
+        for obj in self.cursor:
+            batch.append(obj)
+            if size is not None and len(batch) >= size: break
+        else:
+            self._exhausted = True
+        return batch
+
+    def _read_result(self, size):
+        try:
+            return True, self._read(size), None
+        except Exception:
+            exc_type, exc_value, tb = sys.exc_info()
+            return False, exc_value, tb
+
+    def _serve(self):
+        while True:
+            with self._lock:
+                pending = prefetched = None
+                if self._waiting:
+                    pending = self._waiting.popleft()
+                    if self._prefetched:
+                        prefetched = self._prefetched.popleft()
+                elif self._prefetched or self._exhausted:
+                    self._serving = False
+                    return
+            if pending is None:
+                # Nothing requested: fetch the next batch ahead of time
+                result = self._read_result(self.batch_size)
+                with self._lock:
+                    self._prefetched.append(result)
+                continue
+            if prefetched is None:
+                result = self._read_result(pending.size)
+            elif prefetched[0] and pending.size is None:
+                rest = self._read_result(None)
+                if rest[0]:
+                    result = (True, prefetched[1] + rest[1], None)
+                else:
+                    result = rest
+            else:
+                result = prefetched
+            pending._set(result)
+
+    def _request(self, size, callback):
+        pending = PendingBatch(size, callback)
+        with self._lock:
+            self._waiting.append(pending)
+            serve = not self._serving
+            self._serving = True
+        if serve:
+            self.pool.apply_async(self._serve)
+        return pending
+
+    def next_batch(self, callback=None):
+        '''Return a pending list of up to batch_size objects (empty once the
+        cursor is exhausted), and start fetching the batch after it'''
+        return self._request(self.batch_size, callback)
+
+    def all(self, callback=None):
+        'Return a pending list of all the remaining objects'
+        return self._request(None, callback)
+
+    def __iter__(self):
+        'Iterate over the objects, blocking for each batch'
+        while True:
+            batch = self.next_batch().get()
+            if not batch: break
+            for obj in batch:
+                yield obj
+
+class AsyncSession(object):
+    '''Runs the operations of a ming.Session on a pool of worker threads
+    (workers of them, unless a ThreadPool is passed in).  Each method takes
+    the same arguments as the Session method, plus an optional callback.'''
+
+    def __init__(self, session, pool=None, workers=4):
+        if pool is None: pool = ThreadPool(workers)
+        self.session = session
+        self.pool = pool
+
+    def close(self):
+        'Wait for the pending operations and stop the worker threads'
+        self.pool.close()
+        self.pool.join()
+
+    def _run(self, name, args, kwargs):
+        callback = kwargs.pop('callback', None)
+        return self.pool.apply_async(
+            getattr(self.session, name), args, kwargs, _deferred(callback))
+
+    def get(self, cls, **kwargs):
+        return self._run('get', (cls,), kwargs)
+
+    def find(self, cls, *args, **kwargs):
+        '''Return a pending AsyncCursor (batch_size= sets the size of its
+        batches)'''
+        callback = kwargs.pop('callback', None)
+        batch_size = kwargs.pop('batch_size', None)
+        def find():
+            return AsyncCursor(
+                self.session.find(cls, *args, **kwargs), self.pool,
+                batch_size)
+        return self.pool.apply_async(find, callback=_deferred(callback))
+
+    def find_and_modify(self, cls, **kwargs):
+        return self._run('find_and_modify', (cls,), kwargs)
+
+    def save(self, doc, *args, **kwargs):
+        return self._run('save', (doc,) + args, kwargs)
+
+    def insert(self, doc, **kwargs):
+        return self._run('insert', (doc,), kwargs)
+
+    def insert_many(self, docs, **kwargs):
+        return self._run('insert_many', (docs,), kwargs)
+
+    def update_partial(self, cls, spec, fields, **kwargs):
+        return self._run('update_partial', (cls, spec, fields), kwargs)
+
+    def remove(self, cls, *args, **kwargs):
+        return self._run('remove', (cls,) + args, kwargs)
+
+    def delete(self, doc, **kwargs):
+        return self._run('delete', (doc,), kwargs)
@@ -1,10 +1,16 @@
 """Ming Base module.  Good stuff here.
 """
+import sys
+import time
+import weakref
 import decimal
-from collections import defaultdict
+from collections import defaultdict, deque
 from datetime import datetime
+from threading import Thread
+from Queue import Queue, Full, Empty
 
 import bson
+from pymongo.errors import ConnectionFailure
 
 class Missing(tuple):
     '''Missing is a sentinel used to indicate a missing key or missing keyword
@@ -55,11 +61,18 @@ class Cursor(object):
     objects that it tracks
     '''
 
-    def __init__(self, cls, cursor, allow_extra=True, strip_extra=True):
+    def __init__(self, cls, cursor, allow_extra=True, strip_extra=True,
+                 validate=True):
         self.cls = cls
         self.cursor = cursor
         self._allow_extra = allow_extra
         self._strip_extra = strip_extra
+        self._validate = validate
+        self._record = None
+        self._make = cls.make
+        self._prefetch = None
+        self._prefetcher = None
+        self._connection_failed = None
 
     def __iter__(self):
         return self
@@ -67,13 +80,76 @@ class Cursor(object):
     def __len__(self):
         return self.count()
 
+    def profile(self, record):
+        '''Account for the documents read in record (a
+        ming.profiling.QueryRecord), reporting it when the cursor is
+        exhausted'''
+        self._record = record
+        cls = self.cls
+        self._make = lambda *args, **kwargs: record.validate(
+            cls.make, *args, **kwargs)
+
     def next(self):
-        doc = self.cursor.next()
+        record = self._record
+        if record is None:
+            return self._next()
+        begin = time.time()
+        try:
+            result = self._next()
+        except StopIteration:
+            record.duration += time.time() - begin
+            self._finish()
+            raise
+        record.duration += time.time() - begin
+        record.documents += 1
+        return result
+
+    def _next(self):
+        if self._prefetch is not None:
+            if self._prefetcher is None:
+                self._prefetcher = _Prefetcher(self, *self._prefetch)
+            return self._prefetcher.next()
+        return self._read()
+
+    def on_connection_failure(self, callback):
+        'Call callback(error) when reading raises a pymongo ConnectionFailure'
+        self._connection_failed = callback
+
+    def _read(self):
+        try:
+            doc = self.cursor.next()
+        except ConnectionFailure, e:
+            if self._connection_failed is not None:
+                self._connection_failed(e)
+            raise
         if doc is None: return None
-        return self.cls.make(
+        if not self._validate:
+            return self.cls(doc, skip_from_bson=True)
+        return self._make(
             doc,
             allow_extra=self._allow_extra,
-            strip_extra=self._strip_extra)
+            strip_extra=self._strip_extra,
+            skip_from_bson=True)
+
+    def _finish(self):
+        record, self._record = self._record, None
+        if record is not None:
+            record.finish()
+        self.close()
+
+    def prefetch(self, batch_size=100, depth=2):
+        '''Read and validate the documents on a background thread, batch_size
+        at a time, keeping up to depth batches ready while the caller consumes
+        the current one.  The thread starts with the first call to next(), and
+        ends when the cursor is exhausted, closed (as first() and one() do)
+        or no longer referenced.'''
+        self._prefetch = (batch_size, depth)
+        return self
+
+    def close(self):
+        'Stop any prefetching'
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
 
     def count(self):
         return self.cursor.count()
@@ -90,6 +166,10 @@ class Cursor(object):
         self.cursor = self.cursor.hint(index_or_name)
         return self
 
+    def batch_size(self, batch_size):
+        self.cursor = self.cursor.batch_size(batch_size)
+        return self
+
     def sort(self, *args, **kwargs):
         self.cursor = self.cursor.sort(*args, **kwargs)
         return self
@@ -102,18 +182,79 @@ class Cursor(object):
         try:
             self.next()
         except StopIteration:
+            self._finish()
             return result
+        self._finish()
         raise ValueError, 'More than one result from .one()'
 
     def first(self):
         try:
-            return self.next()
+            result = self.next()
         except StopIteration:
             return None
+        self._finish()
+        return result
 
     def all(self):
         return list(self)
 
+class _Prefetcher(object):
+    '''Reads a Cursor on a background thread until it is exhausted, queueing
+    the documents in batches for next().  The thread only holds a weak
+    reference to the cursor, and ends when the cursor goes away.'''
+
+    def __init__(self, cursor, batch_size, depth):
+        self._queue = Queue(depth)
+        self._batch = deque()
+        self._error = None
+        self._stopped = False
+        self.thread = Thread(
+            target=self._run, args=(weakref.ref(cursor), batch_size))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, cursor_ref, batch_size):
+        while not self._stopped:
+            cursor = cursor_ref()
+            if cursor is None: return
+            batch = []
+            error = None
+            try:
+                while len(batch) < batch_size:
+                    batch.append(cursor._read())
+            except StopIteration:
+                error = (StopIteration, StopIteration(), None)
+            except Exception:
+                error = sys.exc_info()
+            del cursor
+            # Wait for room in the queue, unless the consumer goes away
+            while True:
+                if self._stopped or cursor_ref() is None: return
+                try:
+                    self._queue.put((batch, error), timeout=0.1)
+                    break
+                except Full:
+                    pass
+            if error is not None: return
+
+    def next(self):
+        if self._stopped: raise StopIteration
+        if not self._batch and self._error is None:
+            batch, self._error = self._queue.get()
+            self._batch.extend(batch)
+        if self._batch:
+            return self._batch.popleft()
+        raise self._error[0], self._error[1], self._error[2]
+
+    def stop(self):
+        self._stopped = True
+        # make room, so that a thread waiting to queue a batch sees the stop
+        try:
+            while True:
+                self._queue.get_nowait()
+        except Empty:
+            pass
+
 NoneType = type(None)
 def _safe_bson(obj):
     '''Verify that the obj is safe for bsonification (in particular, no tuples or
@@ -132,3 +273,39 @@ def _safe_bson(obj):
     else:
         assert False, '%s is not safe for bsonification: %r' % (
             type(obj), obj)
+
+_safe_types = (
+    basestring, int, long, float, datetime, NoneType, bson.ObjectId)
+def _make_safe(obj):
+    '''Like _safe_bson, but only copies what it has to: safe values are
+    returned as they are, and plain dicts are converted to Objects.  Missing
+    passes through.
+    '''
+    if isinstance(obj, _safe_types):
+        return obj
+    elif isinstance(obj, list):
+        result = obj
+        for i, v in enumerate(obj):
+            safe_v = _make_safe(v)
+            if safe_v is not v:
+                if result is obj: result = obj[:]
+                result[i] = safe_v
+        return result
+    elif isinstance(obj, dict):
+        if isinstance(obj, Object):
+            result = obj
+        else:
+            result = Object(obj)
+        for k, v in obj.iteritems():
+            safe_v = _make_safe(v)
+            if safe_v is not v:
+                if result is obj: result = Object(obj)
+                result[k] = safe_v
+        return result
+    elif isinstance(obj, decimal.Decimal):
+        return float(obj)
+    elif obj is Missing:
+        return obj
+    else:
+        assert False, '%s is not safe for bsonification: %r' % (
+            type(obj), obj)
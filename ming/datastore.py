@@ -2,31 +2,73 @@ from __future__ import with_statement
 import time
 import logging
 
-from threading import Lock
+from threading import Lock, Condition
+from functools import partial
+from collections import deque
 
 from pymongo.connection import Connection
 from pymongo import pool
 from pymongo.master_slave_connection import MasterSlaveConnection
 
 from . import mim
+from . import exc
+from .metrics import Metrics
 
 class Engine(object):
-    '''Proxy for a pymongo connection, providing some url parsing'''
+    '''Proxy for a pymongo connection, providing some url parsing.
+
+    Connection activity is recorded in self.metrics (a ming.metrics.Metrics):
+    connect_attempts, connect_failures, connect_retries and reconnects
+    counters, and connect_time and connect_wait histograms.  DataStores
+    bound to the engine count their logins as authentications.  With
+    use_gevent, the socket pool adds pool_* counters, a pool_idle gauge, and
+    a pool_checkout_time histogram.
+
+    With circuit_breaker, a failed connection attempt opens the circuit, as
+    do failure_threshold connection failures within failure_window seconds
+    reported by connection_failed() (sessions report those raised by their
+    operations).  While the circuit is open, conn raises MongoGone at once.
+    After backoff seconds the circuit is half-open: the next call to conn
+    tries to connect while the others are still refused, closing the circuit
+    if it succeeds and opening it again for twice as long (up to
+    max_backoff) if not.  circuit_opens, circuit_rejections (calls refused
+    while the circuit is not closed) and connection_errors (those reported)
+    are counted.'''
+    closed, open, half_open = 'closed open half_open'.split()
 
     def __init__(self, master='mongodb://localhost:27017/', slave=None,
-                 connect_retry=3, use_gevent=False, **connect_args):
+                 connect_retry=3, use_gevent=False, circuit_breaker=False,
+                 backoff=1.0, max_backoff=60.0, failure_threshold=3,
+                 failure_window=10.0, **connect_args):
         self._log = logging.getLogger(__name__)
+        self.metrics = Metrics()
+        self._connected = False
         self._conn = None
         self._lock = Lock()
         self._connect_retry = connect_retry
         self._connect_args = connect_args
+        self._circuit_breaker = circuit_breaker
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._failure_threshold = failure_threshold
+        self._failure_window = failure_window
+        # Circuit breaker state, guarded by _lock; connecting is set while a
+        # thread connects outside the lock, and the others wait on
+        # _connect_done
+        self.circuit = self.closed
+        self._connecting = False
+        self._connect_done = Condition(self._lock)
+        self._failures = deque()
+        self._delay = backoff
+        self._retry_at = 0
         self.ConnectionClass = Connection
         if use_gevent:
             if hasattr(pool, 'have_greenlet'):
                 self._connect_args['use_greenlets'] = True
             else:
                 from . import async
-                self.ConnectionClass = async.AsyncConnection
+                self.ConnectionClass = partial(
+                    async.AsyncConnection, metrics=self.metrics)
         self.configure(master, slave)
 
     def __repr__(self):
@@ -53,15 +95,109 @@ class Engine(object):
 
     @property
     def conn(self):
+        if self._circuit_breaker:
+            return self._conn_or_fail()
         for attempt in xrange(self._connect_retry+1):
             if self._conn is not None: break
+            begin = time.time()
             with self._lock:
-                if self._connect() is None:
+                self.metrics.observe('connect_wait', time.time() - begin)
+                self._conn = self._connect()
+                if self._conn is None:
+                    self.metrics.incr('connect_retries')
                     time.sleep(1)
         return self._conn
 
+    def _conn_or_fail(self):
+        conn = self._conn
+        if conn is not None: return conn
+        begin = time.time()
+        with self._lock:
+            while self._connecting and self.circuit == self.closed:
+                self._connect_done.wait()
+            self.metrics.observe('connect_wait', time.time() - begin)
+            conn = self._conn
+            if conn is not None: return conn
+            if self._connecting:
+                probe = False
+            elif self.circuit == self.closed:
+                probe = True
+            else:
+                probe = (self.circuit == self.open
+                         and time.time() >= self._retry_at)
+                if probe: self.circuit = self.half_open
+            self._connecting = probe
+        if not probe:
+            self.metrics.incr('circuit_rejections')
+            raise exc.MongoGone, 'Cannot connect to %s %s (circuit %s)' % (
+                self.master_args, self.slave_args, self.circuit)
+        conn = self._connect()
+        with self._lock:
+            self._connecting = False
+            if conn is None:
+                self._open_circuit()
+            else:
+                self._conn = conn
+                self.circuit = self.closed
+                self._failures.clear()
+            self._connect_done.notify_all()
+        if conn is None:
+            raise exc.MongoGone, 'Cannot connect to %s %s' % (
+                self.master_args, self.slave_args)
+        return conn
+
+    def connection_failed(self, error):
+        '''Report a connection failure (a pymongo ConnectionFailure) raised by
+        an operation on conn.  With circuit_breaker, the connection is dropped
+        and the circuit opened once failure_threshold of them are reported
+        within failure_window seconds.'''
+        self.metrics.incr('connection_errors')
+        if not self._circuit_breaker: return
+        if self.circuit != self.closed: return
+        with self._lock:
+            conn = self._conn
+            if self.circuit != self.closed or conn is None: return
+            now = time.time()
+            failures = self._failures
+            failures.append(now)
+            while failures[0] <= now - self._failure_window:
+                failures.popleft()
+            if len(failures) < self._failure_threshold: return
+            self._log.warning('Connection failure, opening circuit: %s', error)
+            self._conn = None
+            self._open_circuit()
+        self._disconnect(conn)
+
+    def _open_circuit(self):
+        # Called with _lock held
+        if self.circuit == self.half_open:
+            self._delay = min(self._delay * 2, self._max_backoff)
+        else:
+            self._delay = self._backoff
+            self.metrics.incr('circuit_opens')
+        self.circuit = self.open
+        self._retry_at = time.time() + self._delay
+
+    def _disconnect(self, conn):
+        try:
+            conn.disconnect()
+        except:
+            self._log.exception('Error disconnecting %r', conn)
+
     def _connect(self):
-        self._conn = None
+        self.metrics.incr('connect_attempts')
+        with self.metrics.timer('connect_time'):
+            conn = self._connect_impl()
+        if conn is None:
+            self.metrics.incr('connect_failures')
+        elif self._connected:
+            self.metrics.incr('reconnects')
+        else:
+            self._connected = True
+        return conn
+
+    def _connect_impl(self):
+        conn = None
         master = None
         slaves = []
         try:
@@ -82,14 +218,14 @@ class Engine(object):
                             'Error connecting to slave: %s', host)
             if master:
                 if slaves:
-                    self._conn = MasterSlaveConnection(master, slaves)
+                    conn = MasterSlaveConnection(master, slaves)
                 else:
-                    self._conn = master
+                    conn = master
             elif self.slave_args:
-                self._conn = self.ConnectionClass(self.slave_args, slave_okay=True, **self._connect_args)
+                conn = self.ConnectionClass(self.slave_args, slave_okay=True, **self._connect_args)
         except:
             self._log.exception('Cannot connect to %s %s' % (self.master_args, self.slave_args))
-        return self._conn
+        return conn
 
 class DataStore(object):
     '''Engine bound to a particular database'''
@@ -113,6 +249,10 @@ class DataStore(object):
         self.bind = bind
         self.database = database
         self.authenticate = authenticate
+        # (connection, database, collections) -- pymongo re-authenticates
+        # the connection's new sockets itself, so logging in again (and
+        # looking up new handles) is only needed after a reconnect
+        self._handles = None
 
     def __repr__(self):
         return 'DataStore(%r, %s)' % (self.bind, self.database)
@@ -121,12 +261,41 @@ class DataStore(object):
     def conn(self):
         return self.bind.conn
 
+    @property
+    def metrics(self):
+        return self.bind.metrics
+
+    def connection_failed(self, error):
+        self.bind.connection_failed(error)
+
     @property
     def db(self):
-        db = getattr(self.bind.conn, self.database, None)
+        return self._get_handles()[1]
+
+    def collection(self, name):
+        '''The named collection of db, or None if not connected'''
+        conn, db, collections = self._get_handles()
+        try:
+            return collections[name]
+        except KeyError:
+            if db is None: return None
+            coll = collections[name] = db[name]
+            return coll
+
+    def _get_handles(self):
+        conn = self.bind.conn
+        handles = self._handles
+        if handles is not None and handles[0] is conn:
+            return handles
+        db = getattr(conn, self.database, None)
         if db and self.authenticate:
             db.authenticate(**self.authenticate)
-        return db
+            self.metrics.incr('authentications')
+        handles = (conn, db, {})
+        # mim drops its databases with drop_all, so its handles can't be kept
+        if db and not isinstance(conn, mim.Connection):
+            self._handles = handles
+        return handles
 
 class ShardedDataStore(object):
     _lock = Lock()
@@ -33,6 +33,7 @@ def filesystem(*args, **kwargs):
     return cls
 
 class _FSInstanceManager(_InstanceManager):
+    __slots__ = ()
     _proxy_methods = (
         'save', 'insert', 'upsert', 'set', 'increase_field')
     _proxy_on = _InstanceManager._proxy_on
@@ -152,6 +152,7 @@ class _CurriedProxyClass(type):
 
 class _InstanceManager(object):
     __metaclass__ = _CurriedProxyClass
+    __slots__ = ('classmanager', 'inst')
     _proxy_methods = (
         'save', 'insert', 'upsert', 'delete', 'set', 'increase_field')
     _proxy_on='session'
@@ -159,22 +160,23 @@ class _InstanceManager(object):
 
     def __init__(self, mgr, inst):
         self.classmanager = mgr
-        self.session = mgr.session
         self.inst = inst
-        self.schema = mgr.schema
-        self.collection_name = mgr.collection_name
-        self.before_save = mgr.before_save
-        return
 
-        def _proxy(name):
-            def inner(*args, **kwargs):
-                method = getattr(self.session, name)
-                return method(self.inst, *args, **kwargs)
-            inner.__name__ = name
-            return inner
+    @property
+    def session(self):
+        return self.classmanager.session
 
-        for method_name in self._proxy_methods:
-            setattr(self, method_name, _proxy(method_name))
+    @property
+    def schema(self):
+        return self.classmanager.schema
+
+    @property
+    def collection_name(self):
+        return self.classmanager.collection_name
+
+    @property
+    def before_save(self):
+        return self.classmanager.before_save
 
 class _ClassManager(object):
     __metaclass__ = _CurriedProxyClass
@@ -184,6 +186,7 @@ class _ClassManager(object):
         'get', 'find', 'find_by', 'remove', 'count', 'update_partial',
         'group', 'ensure_index', 'ensure_indexes', 'index_information',  'drop_indexes' )
     InstanceManagerClass=_InstanceManager
+    _indexes_ensured=False
 
     def __init__(
         self, cls, collection_name, session, fields, indexes, 
@@ -208,17 +211,6 @@ class _ClassManager(object):
         self.bases = self._get_bases()
         self.schema = self._get_schema()
         self._before_save = before_save
-        return
-
-        def _proxy(name):
-            def inner(*args, **kwargs):
-                method = getattr(self.session, name)
-                return method(self.cls, *args, **kwargs)
-            inner.__name__ = name
-            return inner
-
-        for method_name in self._proxy_methods:
-            setattr(self, method_name, _proxy(method_name))
 
     def _get_bases(self):
         return tuple(
@@ -275,7 +267,8 @@ class _ClassManager(object):
         return schema
 
     def add_index(self, idx):
-        self._indexes.append(idx)
+        self.indexes.append(idx)
+        self._indexes_ensured = False
 
     def with_session(self, session):
         '''Return a Manager with an alternate session'''
@@ -287,33 +280,37 @@ class _ClassManager(object):
         '''Load each doc in the collection and immediately save it'''
         for doc in self.find(): doc.m.save()
 
-    def make(self, data, allow_extra=False, strip_extra=True):
+    def make(self, data, allow_extra=False, strip_extra=True,
+             skip_from_bson=False, safe=False):
         if self.schema:
-            return self.schema.validate(
-                data, allow_extra=allow_extra, strip_extra=strip_extra)
+            validate = self.schema.compiled(
+                allow_extra=allow_extra, strip_extra=strip_extra, safe=safe)
+            return validate(data)
         else:
-            return self.cls(data)
+            return self.cls(data, skip_from_bson=skip_from_bson)
         
 class _ManagerDescriptor(object):
 
     def __init__(self, manager):
         self.manager = manager
-        self.initialized = False
 
     def _ensure_indexes(self):
-        session = self.manager.session
-        if session is None: return
-        if session.bind is None: return
-        collection = self.manager.collection
-        for idx in self.manager.indexes:
-            collection.ensure_index(
-                idx.index_spec,
-                unique=idx.unique,
-                sparse=idx.sparse)
-        self.initialized = True
+        manager = self.manager
+        if manager.indexes:
+            session = manager.session
+            if session is None: return
+            if session.bind is None: return
+            collection = manager.collection
+            for idx in manager.indexes:
+                collection.ensure_index(
+                    idx.index_spec,
+                    unique=idx.unique,
+                    sparse=idx.sparse)
+        manager._indexes_ensured = True
 
     def __get__(self, inst, cls=None):
-        if not self.initialized:
+        manager = self.manager
+        if not manager._indexes_ensured:
             try:
                 self._ensure_indexes()
             except (MongoGone, ConnectionFailure) as e:
@@ -324,9 +321,13 @@ class _ManagerDescriptor(object):
                     # raise all other connection issues
                     raise
         if inst is None:
-            return self.manager
-        else:
-            return self.manager.InstanceManagerClass(self.manager, inst)
+            return manager
+        # Each document keeps the instance manager it was first given
+        d = inst.__dict__
+        result = d.get('_ming_m')
+        if result is None or result.classmanager is not manager:
+            result = d['_ming_m'] = manager.InstanceManagerClass(manager, inst)
+        return result
 
 class _FieldDescriptor(object):
 
@@ -356,6 +357,12 @@ class _Document(Object):
             data = Object.from_bson(data)
         dict.update(self, data)
 
+    def __getstate__(self):
+        # Copies get their own instance manager
+        state = dict(self.__dict__)
+        state.pop('_ming_m', None)
+        return state
+
     @classmethod
     def make(cls, data, **kwargs):
         'Kind of a virtual constructor'
@@ -0,0 +1,106 @@
+'''Counters and histograms describing how connections are used.  They can be
+polled with Metrics.snapshot(), or pushed to listeners as they change.'''
+from __future__ import with_statement
+import time
+import bisect
+from threading import Lock
+from contextlib import contextmanager
+
+# Default histogram bucket bounds, in seconds
+DEFAULT_BOUNDS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0)
+
+class Histogram(object):
+    '''Distribution of observed values: count, total, min, max and the number
+    of values at or below each bound (the last bucket counts the rest)'''
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = tuple(bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = self.max = None
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min: self.min = value
+        if self.max is None or value > self.max: self.max = value
+
+    def snapshot(self):
+        if self.count:
+            mean = self.total / self.count
+        else:
+            mean = None
+        return dict(
+            count=self.count, total=self.total, min=self.min, max=self.max,
+            mean=mean,
+            buckets=zip(self.bounds + (None,), self.buckets))
+
+class Metrics(object):
+    '''A set of named counters, gauges, and histograms.
+
+    Listeners are called as listener(name, value) for every change: value is
+    the increment for counters, the new value for gauges, and the observed
+    value for histograms.  They are called without the lock held, so they
+    may take snapshots.'''
+
+    def __init__(self):
+        self._lock = Lock()
+        self._listeners = []
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+        self._notify(name, amount)
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+        self._notify(name, value)
+
+    def observe(self, name, value):
+        with self._lock:
+            try:
+                histogram = self.histograms[name]
+            except KeyError:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+        self._notify(name, value)
+
+    @contextmanager
+    def timer(self, name):
+        'Observe the time taken by the with block (even if it raises)'
+        begin = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - begin)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(
+                counters=dict(self.counters),
+                gauges=dict(self.gauges),
+                histograms=dict(
+                    (name, h.snapshot())
+                    for name, h in self.histograms.iteritems()))
+
+    def _notify(self, name, value):
+        for listener in self._listeners:
+            listener(name, value)
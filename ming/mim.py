@@ -2,6 +2,7 @@
 non-persistent and hopefully much, much faster
 '''
 import sys
+import bisect
 import itertools
 import collections
 from datetime import datetime
@@ -27,8 +28,11 @@ class Connection(object):
             cls._singleton = cls()
         return cls._singleton
 
-    def __init__(self):
+    def __init__(self, copy_on_write=False):
         self._databases = {}
+        # When set, documents are stored frozen and returned as views which
+        # copy their sub-documents on first access
+        self.copy_on_write = copy_on_write
 
     def drop_all(self):
         self._databases = {}
@@ -224,11 +228,14 @@ class Collection(collection.Collection):
         self._data = {}
         self._unique_indexes = {}
         self._indexes = {}
+        self._field_indexes = {} # first key of each index => FieldIndex
 
     def clear(self):
         self._data = {}
         for ui in self._unique_indexes.values():
             ui.clear()
+        for fi in self._field_indexes.values():
+            fi.clear()
 
     @property
     def name(self):
@@ -246,16 +253,64 @@ class Collection(collection.Collection):
 
     def _find(self, spec, sort=None):
         bson_safe(spec)
-        def _gen():
-            for doc in self._data.itervalues():
-                if match(spec, doc): yield doc
-        return _gen()
+        return self._iter(spec, sort)
+
+    def _iter(self, spec, sort=None):
+        predicate = compile_spec(spec)
+        ids = self._plan(spec)
+        if sort:
+            ordered = self._ordered_ids(sort)
+            if ordered is not None:
+                if ids is not None:
+                    ordered = [ i for i in ordered if i in ids ]
+                data = self._data
+                return (
+                    doc for doc in (data[i] for i in ordered)
+                    if predicate(doc))
+        if ids is None:
+            docs = self._data.itervalues()
+        else:
+            docs = [ self._data[i] for i in ids ]
+        result = (doc for doc in docs if predicate(doc))
+        if sort:
+            result = sorted(result, cmp=cursor_comparator(sort))
+        return result
+
+    def _plan(self, spec):
+        '''Use the _id and field indexes to find a set of _ids that is a
+        superset of the documents matching spec.  Returns None if no index
+        applies (so every document must be scanned).'''
+        best = None
+        for k, v in spec.iteritems():
+            if k.startswith('$'): continue
+            op, value = _parse_query(v)
+            if k == '_id' and op in ('$eq', '$in'):
+                values = FieldIndex.hashable_values(op, value)
+                if values is None: continue
+                ids = set(v for v in values if v in self._data)
+            else:
+                index = self._field_indexes.get(k)
+                if index is None: continue
+                ids = index.lookup(op, value)
+                if ids is None: continue
+            if best is None or len(ids) < len(best):
+                best = ids
+                if not best: break
+        return best
+
+    def _ordered_ids(self, sort):
+        if len(sort) != 1: return None
+        key, direction = sort[0]
+        index = self._field_indexes.get(key)
+        if index is None: return None
+        return index.ordered_ids(direction)
 
     def find(self, spec=None, fields=None, as_class=dict, **kwargs):
         if spec is None:
             spec = {}
         sort = kwargs.pop('sort', None)
-        cur = Cursor(lambda:self._find(spec, **kwargs), fields=fields, as_class=as_class)
+        cur = Cursor(lambda sort=None:self._find(spec, sort=sort, **kwargs),
+                     fields=fields, as_class=as_class)
         if sort:
             cur = cur.sort(sort)
         return cur
@@ -285,18 +340,28 @@ class Collection(collection.Collection):
 
     def insert(self, doc_or_docs, safe=False):
         if not isinstance(doc_or_docs, list):
-            doc_or_docs = [ doc_or_docs ]
+            return self.insert([ doc_or_docs ], safe=safe)[0]
+        ids = []
         for doc in doc_or_docs:
             bson_safe(doc)
             _id = doc.get('_id', ())
             if _id == ():
                 _id = doc['_id'] = bson.ObjectId()
+            ids.append(_id)
             if _id in self._data:
                 if safe: raise OperationFailure('duplicate ID on insert')
                 continue
-            self._index(doc)
-            self._data[_id] = bcopy(doc)
-        return _id
+            stored = self._store(doc)
+            self._index(stored)
+            self._data[_id] = stored
+        return ids
+
+    def _store(self, doc):
+        '''Return the form of doc to keep in the collection'''
+        stored = bcopy(doc)
+        if self._database._connection.copy_on_write:
+            stored = _freeze(stored)
+        return stored
 
     def save(self, doc, safe=False):
         _id = doc.get('_id', ())
@@ -312,7 +377,15 @@ class Collection(collection.Collection):
         updated = False
         for doc in self._find(spec):
             self._deindex(doc) 
-            update(doc, document)
+            _id = doc.get('_id', ())
+            if isinstance(doc, FrozenDict):
+                doc = wrap_as_class(doc, dict)
+            # copy the update so stored documents never share its values
+            update(doc, bcopy(document))
+            if _id != ():
+                doc.setdefault('_id', _id)
+            if self._database._connection.copy_on_write:
+                doc = self._data[doc['_id']] = _freeze(doc)
             self._index(doc) 
             updated = True
             if not multi: break
@@ -323,19 +396,16 @@ class Collection(collection.Collection):
             _id = doc.get('_id', ())
             if _id == ():
                 _id = doc['_id'] = bson.ObjectId()
-            self._index(doc) 
-            self._data[_id] = bcopy(doc)
+            stored = self._store(doc)
+            self._index(stored)
+            self._data[_id] = stored
             return _id
 
     def remove(self, spec=None, **kwargs):
         if spec is None: spec = {}
-        new_data = {}
-        for id, doc in self._data.iteritems():
-            if match(spec, doc):
-                self._deindex(doc)
-            else:
-                new_data[id] = doc
-        self._data = new_data
+        for doc in list(self._iter(spec)):
+            self._deindex(doc)
+            del self._data[doc['_id']]
 
     def ensure_index(self, key_or_list, unique=False, ttl=300,
                      name=None, background=None, sparse=False):
@@ -345,6 +415,10 @@ class Collection(collection.Collection):
             keys = (key_or_list,)
         index_name = '_'.join(keys)
         self._indexes[index_name] =[ (k, 0) for k in keys ]
+        if keys[0] not in self._field_indexes:
+            self._field_indexes[keys[0]] = index = FieldIndex(keys[0])
+            for id, doc in self._data.iteritems():
+                index.insert(id, doc)
         if not unique: return
         self._unique_indexes[keys] = index = {}
         for id, doc in self._data.iteritems():
@@ -362,6 +436,10 @@ class Collection(collection.Collection):
         if index is None: return
         keys = tuple(i[0] for i in index)
         self._unique_indexes.pop(keys, None)
+        first_keys = set(i[0][0] for i in self._indexes.itervalues())
+        for key in self._field_indexes.keys():
+            if key not in first_keys:
+                del self._field_indexes[key]
 
     def __repr__(self):
         return 'mim.Collection(%r, %s)' % (self._database, self.name)
@@ -375,11 +453,167 @@ class Collection(collection.Collection):
             if old_id in self._data:
                 raise DuplicateKeyError, '%r: %s' % (self, keys)
             index[key_values] = doc['_id']
+        for index in self._field_indexes.itervalues():
+            index.insert(doc['_id'], doc)
 
     def _deindex(self, doc):
         for keys, index in self._unique_indexes.iteritems():
             key_values = tuple(doc.get(key, None) for key in keys)
             index.pop(key_values, None)
+        if '_id' not in doc: return
+        for index in self._field_indexes.itervalues():
+            index.remove(doc['_id'])
+
+class FieldIndex(object):
+    '''Secondary index on one (possibly dotted) key.  Maintains a hash from
+    values to _ids for equality and $in, and sorted lists of values per type
+    for ranges and sorting.
+
+    Lookups return a superset of the matching _ids; the spec is still applied
+    to each candidate, so the index only needs to be conservative.'''
+    range_types = (
+        ('number', (int, long, float)),
+        ('string', basestring),
+        ('datetime', datetime),
+        ('objectid', bson.ObjectId))
+
+    def __init__(self, key):
+        self.key = key
+        self._key_parts = key.split('.')
+        self.clear()
+
+    def clear(self):
+        self._hash = {}     # value => set(_id)
+        self._sorted = {}   # range type => ([ value ], [ _id ])
+        self._unsorted = set() # _ids with values of no range type
+        self._multi = set() # _ids with other than one value
+        self._entries = {}  # _id => (hash keys, [ (range type, value) ])
+
+    def insert(self, _id, doc):
+        self.remove(_id)
+        leaves = list(_leaves(doc, self._key_parts))
+        if len(leaves) != 1:
+            self._multi.add(_id)
+        hash_keys = set()
+        ranged = []
+        for leaf in leaves:
+            if isinstance(leaf, list):
+                hash_keys.update(v for v in leaf if _hashable(v))
+            elif _hashable(leaf):
+                hash_keys.add(leaf)
+            rtype = self._range_type(leaf)
+            if rtype is None:
+                self._unsorted.add(_id)
+            else:
+                values, ids = self._sorted.setdefault(rtype, ([], []))
+                pos = bisect.bisect_right(values, leaf)
+                values.insert(pos, leaf)
+                ids.insert(pos, _id)
+                ranged.append((rtype, leaf))
+        for k in hash_keys:
+            self._hash.setdefault(k, set()).add(_id)
+        self._entries[_id] = (hash_keys, ranged)
+
+    def remove(self, _id):
+        entry = self._entries.pop(_id, None)
+        if entry is None: return
+        hash_keys, ranged = entry
+        for k in hash_keys:
+            ids = self._hash[k]
+            ids.discard(_id)
+            if not ids: del self._hash[k]
+        for rtype, value in ranged:
+            values, ids = self._sorted[rtype]
+            lo = bisect.bisect_left(values, value)
+            hi = bisect.bisect_right(values, value)
+            for i in xrange(lo, hi):
+                if ids[i] == _id:
+                    del values[i]
+                    del ids[i]
+                    break
+            if not values: del self._sorted[rtype]
+        self._unsorted.discard(_id)
+        self._multi.discard(_id)
+
+    def lookup(self, op, value):
+        '''Return a set of candidate _ids for the query {key: {op: value}},
+        or None if the index cannot help'''
+        values = self.hashable_values(op, value)
+        if values is not None:
+            result = set()
+            for v in values:
+                result.update(self._hash.get(v, ()))
+            return result
+        if op in ('$gt', '$gte', '$lt', '$lte'):
+            return self._lookup_range(op, value)
+        return None
+
+    def ordered_ids(self, direction):
+        '''Return all the _ids in sort order, or None if the values are not
+        all of a single sortable type'''
+        if self._unsorted or self._multi or len(self._sorted) > 1:
+            return None
+        if not self._sorted:
+            return []
+        values, ids = self._sorted.values()[0]
+        if direction < 0:
+            return ids[::-1]
+        return list(ids)
+
+    @classmethod
+    def hashable_values(cls, op, value):
+        '''Return the values to look up in a hash index for an $eq or $in
+        query, or None if a hash lookup is not possible'''
+        if op == '$eq':
+            values = [ value ]
+        elif op == '$in' and isinstance(value, (list, tuple)):
+            values = value
+        else:
+            return None
+        for v in values:
+            if hasattr(v, 'match') or not _hashable(v): return None
+        return values
+
+    def _lookup_range(self, op, value):
+        rtype = self._range_type(value)
+        if rtype is None: return None
+        # Values of other types may compare either way, so they are always
+        # candidates
+        result = set(self._unsorted)
+        for t, (values, ids) in self._sorted.iteritems():
+            if t != rtype:
+                result.update(ids)
+                continue
+            lo, hi = 0, len(values)
+            if op == '$gt':
+                lo = bisect.bisect_right(values, value)
+            elif op == '$gte':
+                lo = bisect.bisect_left(values, value)
+            elif op == '$lt':
+                hi = bisect.bisect_left(values, value)
+            else:
+                hi = bisect.bisect_right(values, value)
+            result.update(ids[lo:hi])
+        return result
+
+    @classmethod
+    def _range_type(cls, value):
+        for name, types in cls.range_types:
+            if isinstance(value, types): return name
+        return None
+
+def _project(doc, fields):
+    '''Apply a top-level projection the way mongodb does: _id is included
+    unless excluded, and missing fields are skipped'''
+    if not isinstance(fields, dict):
+        fields = dict((k, 1) for k in fields)
+    if any(v for k,v in fields.iteritems() if k != '_id'):
+        result = dict((k, doc[k]) for k,v in fields.iteritems()
+                      if v and k in doc)
+        if fields.get('_id', 1) and '_id' in doc:
+            result['_id'] = doc['_id']
+        return result
+    return dict((k, v) for k,v in doc.iteritems() if fields.get(k, 1))
 
 class Cursor(object):
 
@@ -395,9 +629,7 @@ class Cursor(object):
     @LazyProperty
     def iterator(self):
         self._safe_to_chain = False
-        result = self._iterator_gen()
-        if self._sort is not None:
-            result = sorted(result, cmp=cursor_comparator(self._sort))
+        result = self._iterator_gen(self._sort)
         if self._skip is not None:
             result = itertools.islice(result, self._skip, sys.maxint)
         if self._limit is not None:
@@ -412,10 +644,14 @@ class Cursor(object):
 
     def next(self):
         value = self.iterator.next()
-        value = bcopy(value)
+        frozen = isinstance(value, FrozenDict)
         if self._fields:
-            value = dict((k, value[k]) for k in self._fields)
-        return wrap_as_class(value, self._as_class)
+            value = _project(value, self._fields)
+        if frozen:
+            return _cow_class(self._as_class)(value)
+        # Stored documents are already BSON-normalized, so a single
+        # round-trip both copies and wraps them
+        return bson.BSON.encode(value).decode(as_class=self._as_class)
 
     def sort(self, key_or_list, direction=ASCENDING):
         if not self._safe_to_chain:
@@ -446,6 +682,11 @@ class Cursor(object):
         self._limit = limit
         return self
 
+    def batch_size(self, batch_size):
+        if not self._safe_to_chain:
+            raise InvalidOperation('cannot set options after executing query')
+        return self
+
 def cursor_comparator(keys):
     def comparator(a, b):
         for k,d in keys:
@@ -459,22 +700,22 @@ def match(spec, doc):
     currently this should match, but it doesn't:
     match({'tags.tag':'test'}, {'tags':[{'tag':'test'}]})
     '''
-    try:
-        for k,v in spec.iteritems():
-            if k == '$or':
-                if not isinstance(spec[k], list):
-                    raise InvalidOperation('$or clauses must be provided in a list')
-                for query in v:
-                    if match(query, doc): break
-                else:
-                    return False
-            else:
-                op, value = _parse_query(v)
-                if not _part_match(op, value, k.split('.'), doc):
-                    return False
-    except (AttributeError, KeyError), ex:
-        return False
-    return True
+    return compile_spec(spec)(doc)
+
+_compiled_specs = {} # spec shape => predicate factory
+
+def compile_spec(spec):
+    '''Return a predicate equivalent to lambda doc:match(spec, doc).  The
+    parsing of the spec is cached by its shape (keys and operators), so only
+    the values are bound per query.'''
+    values = []
+    shape = _spec_shape(spec, values)
+    factory = _compiled_specs.get(shape)
+    if factory is None:
+        if len(_compiled_specs) >= 1000:
+            _compiled_specs.clear()
+        factory = _compiled_specs[shape] = _compile_shape(shape)
+    return factory(iter(values))
 
 def _parse_query(v):
     if isinstance(v, dict) and len(v) == 1 and v.keys()[0].startswith('$'):
@@ -482,17 +723,145 @@ def _parse_query(v):
     else:
         return '$eq', v
 
-def _part_match(op, value, key_parts, doc, allow_list_compare=True):
+def _spec_shape(spec, values):
+    shape = []
+    for k, v in spec.iteritems():
+        if k == '$or':
+            if not isinstance(v, list):
+                raise InvalidOperation('$or clauses must be provided in a list')
+            shape.append((k, tuple(_spec_shape(q, values) for q in v)))
+        else:
+            op, value = _parse_query(v)
+            shape.append((k, op, op == '$eq' and hasattr(value, 'match')))
+            values.append(value)
+    return tuple(shape)
+
+def _compile_shape(shape):
+    clause_factories = []
+    for clause in shape:
+        if clause[0] == '$or':
+            clause_factories.append(_or_factory(
+                    [ _compile_shape(s) for s in clause[1] ]))
+        else:
+            key, op, is_regex = clause
+            clause_factories.append(_key_factory(
+                    key.split('.'), _test_factory(op, is_regex)))
+    def factory(values):
+        clauses = [ f(values) for f in clause_factories ]
+        if len(clauses) == 1:
+            clause = clauses[0]
+            def predicate(doc):
+                try:
+                    return bool(clause(doc))
+                except (AttributeError, KeyError):
+                    return False
+        else:
+            def predicate(doc):
+                try:
+                    for clause in clauses:
+                        if not clause(doc): return False
+                except (AttributeError, KeyError):
+                    return False
+                return True
+        return predicate
+    return factory
+
+def _or_factory(factories):
+    def factory(values):
+        predicates = [ f(values) for f in factories ]
+        def match_or(doc):
+            for predicate in predicates:
+                if predicate(doc): return True
+            return False
+        return match_or
+    return factory
+
+def _key_factory(key_parts, make_test):
+    def factory(values):
+        return _compile_path(key_parts, make_test(values.next()))
+    return factory
+
+def _compile_path(key_parts, test):
+    if not key_parts: return test
+    key = key_parts[0]
+    child = _compile_path(key_parts[1:], test)
+    def match_path(doc):
+        if isinstance(doc, list):
+            for v in doc:
+                if child(v.get(key, ())): return True
+            return False
+        return child(doc.get(key, ()))
+    return match_path
+
+def _test_factory(op, is_regex):
+    '''Return a function which, given the query value b, returns a test
+    equivalent to lambda a:compare(op, a, b)'''
+    if op == '$gt': return lambda b: lambda a: a > b
+    if op == '$gte': return lambda b: lambda a: a >= b
+    if op == '$lt': return lambda b: lambda a: a < b
+    if op == '$lte': return lambda b: lambda a: a <= b
+    if op == '$eq':
+        if is_regex: return lambda b: b.match
+        def make_eq(b):
+            def test_eq(a):
+                if isinstance(a, list):
+                    return a == b or b in a
+                return a == b
+            return test_eq
+        return make_eq
+    if op == '$ne': return lambda b: lambda a: a != b
+    if op == '$in':
+        def make_in(b):
+            contains = _container(b)
+            def test_in(a):
+                if isinstance(a, list):
+                    for ele in a:
+                        if contains(ele): return True
+                    return False
+                return contains(a)
+            return test_in
+        return make_in
+    if op == '$nin':
+        def make_nin(b):
+            contains = _container(b)
+            return lambda a: not contains(a)
+        return make_nin
+    if op == '$exists':
+        return lambda b: (lambda a: a != ()) if b else (lambda a: a == ())
+    if op == '$all': return lambda b: lambda a: set(a).issuperset(b)
+    raise NotImplementedError, op
+
+def _container(b):
+    '''Return a function equivalent to lambda a: a in b, using a set when
+    the members of b allow it'''
+    if not isinstance(b, (list, tuple)) or not all(_hashable(v) for v in b):
+        return lambda a: a in b
+    members = frozenset(b)
+    def contains(a):
+        try:
+            return a in members
+        except TypeError:
+            return a in b
+    return contains
+
+def _leaves(doc, key_parts, allow_list_compare=True):
+    '''Generate the values that a compiled key path would test'''
     if not key_parts:
-        return compare(op, doc, value)
+        yield doc
     elif isinstance(doc, list) and allow_list_compare:
         for v in doc:
-            if _part_match(op, value, key_parts, v, allow_list_compare=False):
-                return True
-        else:
-            return False
-    else:
-        return _part_match(op, value, key_parts[1:], doc.get(key_parts[0], ()))
+            for leaf in _leaves(v, key_parts, allow_list_compare=False):
+                yield leaf
+    elif isinstance(doc, dict):
+        for leaf in _leaves(doc.get(key_parts[0], ()), key_parts[1:]):
+            yield leaf
+
+def _hashable(value):
+    try:
+        hash(value)
+        return True
+    except TypeError:
+        return False
 
 def _lookup(doc, k, default=()):
     try:
@@ -557,6 +926,9 @@ def update(doc, updates):
                     vvv for vvv in doc[kk] if vvv != vv ]
         elif k == '$set':
             doc.update(v)
+        elif k == '$unset':
+            for kk in v:
+                doc.pop(kk, None)
         elif k.startswith('$'):
             raise NotImplementedError, k
     validate(doc)
@@ -577,6 +949,129 @@ def bcopy(obj):
     else:
         return obj
         
+def _freeze(value):
+    if isinstance(value, dict):
+        return FrozenDict((k, _freeze(v)) for k,v in value.iteritems())
+    elif isinstance(value, list):
+        return FrozenList(_freeze(v) for v in value)
+    else:
+        return value
+
+def _view(value, as_class):
+    if isinstance(value, FrozenDict):
+        return _cow_class(as_class)(value)
+    elif isinstance(value, FrozenList):
+        return [ _view(v, as_class) for v in value ]
+    else:
+        return value
+
+def _read_only(self, *args, **kwargs):
+    raise TypeError, 'stored mim documents are read-only'
+
+class FrozenDict(dict):
+    '''Read-only dict used to store documents in copy_on_write mode.  Copies
+    (including deep copies and unpickled copies) are ordinary dicts.'''
+    __slots__ = ()
+    __setitem__ = __delitem__ = clear = pop = popitem = _read_only
+    setdefault = update = _read_only
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return wrap_as_class(self, dict)
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+class FrozenList(list):
+    'Read-only list used to store arrays in copy_on_write mode'
+    __slots__ = ()
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _read_only
+    __iadd__ = __imul__ = append = extend = insert = pop = _read_only
+    remove = reverse = sort = _read_only
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return wrap_as_class(self, dict)
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+_frozen_types = (FrozenDict, FrozenList)
+
+class _CopyOnWrite(object):
+    '''Mixin for the documents returned in copy_on_write mode.  They share
+    sub-documents with the stored (frozen) document until a value is fetched,
+    at which point it is replaced with a writable copy.  Sub-documents reached
+    without going through the mapping methods (e.g. dict.get(doc, k)) are
+    read-only.'''
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if isinstance(value, _frozen_types):
+            value = _view(value, self._as_class)
+            dict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return _CopyOnWrite.__getitem__(self, key)
+        return default
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return _CopyOnWrite.__getitem__(self, key)
+        self[key] = default
+        return default
+
+    def pop(self, key, *args):
+        return _view(dict.pop(self, key, *args), self._as_class)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        return key, _view(value, self._as_class)
+
+    def copy(self):
+        return type(self)(self)
+
+    def _thaw(self):
+        for key in self.keys():
+            _CopyOnWrite.__getitem__(self, key)
+
+    def values(self):
+        self._thaw()
+        return dict.values(self)
+
+    def items(self):
+        self._thaw()
+        return dict.items(self)
+
+    def itervalues(self):
+        self._thaw()
+        return dict.itervalues(self)
+
+    def iteritems(self):
+        self._thaw()
+        return dict.iteritems(self)
+
+    def __reduce__(self):
+        return self._as_class, (dict(self.iteritems()),)
+
+_cow_classes = {}
+
+def _cow_class(as_class):
+    try:
+        return _cow_classes[as_class]
+    except KeyError:
+        cls = _cow_classes[as_class] = type(
+            'CopyOnWrite' + as_class.__name__, (_CopyOnWrite, as_class),
+            dict(__slots__=(), _as_class=as_class))
+        return cls
+
 def wrap_as_class(value, as_class):
     if isinstance(value, dict):
         return as_class(dict(
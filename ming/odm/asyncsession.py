@@ -0,0 +1,55 @@
+from multiprocessing.pool import ThreadPool
+
+from ming.asyncsession import AsyncCursor, _deferred
+
+class AsyncODMSession(object):
+    '''Runs the operations of an ODMSession on a worker thread, returning
+    pending results as ming.asyncsession.AsyncSession does.
+
+    The identity map and unit of work are not thread-safe, so a single
+    worker runs the operations one at a time, in the order they were
+    requested.  Objects should not be changed while a flush is pending.'''
+
+    def __init__(self, session):
+        self.session = session
+        self.pool = ThreadPool(1)
+
+    def close(self):
+        'Wait for the pending operations and stop the worker thread'
+        self.pool.close()
+        self.pool.join()
+
+    def _run(self, name, args, kwargs):
+        callback = kwargs.pop('callback', None)
+        return self.pool.apply_async(
+            getattr(self.session, name), args, kwargs, _deferred(callback))
+
+    def get(self, cls, idvalue, callback=None):
+        return self._run('get', (cls, idvalue), dict(callback=callback))
+
+    def find(self, cls, *args, **kwargs):
+        '''Return a pending AsyncCursor of mapped objects (batch_size= sets
+        the size of its batches)'''
+        callback = kwargs.pop('callback', None)
+        batch_size = kwargs.pop('batch_size', None)
+        def find():
+            return AsyncCursor(
+                self.session.find(cls, *args, **kwargs), self.pool,
+                batch_size)
+        return self.pool.apply_async(find, callback=_deferred(callback))
+
+    def find_and_modify(self, cls, *args, **kwargs):
+        return self._run('find_and_modify', (cls,) + args, kwargs)
+
+    def save(self, obj, callback=None):
+        'Add obj to the session (it is written by the next flush)'
+        return self._run('save', (obj,), dict(callback=callback))
+
+    def flush(self, obj=None, callback=None):
+        return self._run('flush', (obj,), dict(callback=callback))
+
+    def remove(self, cls, *args, **kwargs):
+        return self._run('remove', (cls,) + args, kwargs)
+
+    def update(self, cls, spec, fields, **kwargs):
+        return self._run('update', (cls, spec, fields), kwargs)
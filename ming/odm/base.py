@@ -1,5 +1,8 @@
+import weakref
 from copy import deepcopy
 
+from ming.base import Missing
+
 def state(obj):
     '''The state of a mapped object'''
     return obj.__ming__.state
@@ -35,25 +38,94 @@ class with_hooks(object):
 
 class ObjectState(object):
     new, clean, dirty, deleted = 'new clean dirty deleted'.split()
+    __slots__ = (
+        '_status', 'uow', 'original_document', 'document',
+        'validated_fields', '_i_document', '_extra_state', 'options',
+        'dirty_fields', 'loaded_fields', '__weakref__')
 
     def __init__(self, options):
-        self.status = self.new
-        self.original_document = None # unvalidated, as loaded from mongodb
+        self._status = self.new
+        self.uow = None # the UnitOfWork to notify of status changes
+        # unvalidated, as loaded from mongodb (None if the Mapper option
+        # original_document is false)
+        self.original_document = None
         self.document = None
-        self.i_document = {}
-        self.extra_state = {}
-        self.tracker = _DocumentTracker(self)
+        # None if document is fully validated, else the names of the fields
+        # validated so far (see Mapper option lazy_validate)
+        self.validated_fields = None
+        # i_document and extra_state are created when first needed
+        self._i_document = None
+        self._extra_state = None
         self.options = options
-
-    def soil(self):
+        # The top-level fields changed since the object was clean, or None if
+        # unknown (in which case the whole document is saved)
+        self.dirty_fields = None
+        # None if the whole document was loaded, else the names of the
+        # top-level fields loaded by a projected query
+        self.loaded_fields = None
+
+    @property
+    def i_document(self):
+        if self._i_document is None:
+            self._i_document = {}
+        return self._i_document
+
+    @property
+    def extra_state(self):
+        if self._extra_state is None:
+            self._extra_state = {}
+        return self._extra_state
+
+    @property
+    def tracker(self):
+        return _DocumentTracker(self)
+
+    def _uninstrument(self, name):
+        if self._i_document is not None:
+            self._i_document.pop(name, None)
+
+    def _get_status(self):
+        return self._status
+
+    def _set_status(self, value):
+        self._status = value
+        if self.uow is not None:
+            self.uow.status_changed(self)
+
+    status = property(_get_status, _set_status)
+
+    def soil(self, name=None):
         if self.status == self.clean:
             self.status = self.dirty
-
-    def validate(self, schema):
+            self.dirty_fields = set()
+        if self.dirty_fields is not None:
+            if name is None:
+                self.dirty_fields = None
+            else:
+                self.dirty_fields.add(name)
+
+    def validate(self, schema, **kw):
         status = self.status
-        self.document = schema.validate(self.document)
+        self.document = schema.validate(self.document, **kw)
+        self.validated_fields = None
+        self._i_document = None
         self.status = status
 
+    def validate_field(self, name, schema):
+        '''Validate a single field of a lazily-validated document, leaving
+        the rest of the document as loaded'''
+        value = schema.compiled(allow_extra=True, strip_extra=True)(
+            self.document.get(name, Missing))
+        if value is Missing:
+            self.document.pop(name, None)
+        else:
+            self.document[name] = value
+        self.validated_fields.add(name)
+        self._uninstrument(name)
+
+    def is_loaded(self, name):
+        return self.loaded_fields is None or name in self.loaded_fields
+
     def clone(self):
         return deepcopy(self.document)
 
@@ -61,34 +133,52 @@ class ObjectState(object):
         return '<ObjectState status=%s>' % self.status
 
     def instrumented(self, name):
+        i_document = self.i_document
         try:
-            return self.i_document[name]
+            return i_document[name]
         except KeyError:
             from .icollection import instrument
-            result = instrument(self.document[name], self.tracker)
-            self.i_document[name] = result
+            result = instrument(
+                self.document[name], _DocumentTracker(self, name))
+            i_document[name] = result
         return result
 
     def update(self, *a, **kw):
         self.document.update(*a, **kw)
-        self.i_document = {}
+        self._i_document = None
 
     def set(self, name, value):
         self.document[name] = value
-        self.i_document.pop(name, None)
+        self._uninstrument(name)
+        if self.validated_fields is not None:
+            self.validated_fields.add(name)
+        if self.loaded_fields is not None:
+            self.loaded_fields.add(name)
 
     def delete(self, name):
         del self.document[name]
-        self.i_document.pop(name, None)
+        self._uninstrument(name)
+        if self.validated_fields is not None:
+            self.validated_fields.add(name)
+        if self.loaded_fields is not None:
+            self.loaded_fields.add(name)
 
 class _DocumentTracker(object):
-    __slots__ = ('state',)
+    __slots__ = ('_state', 'name')
+
+    def __init__(self, state, name=None):
+        # the state refers to its trackers, so avoid a reference cycle
+        self._state = weakref.ref(state)
+        self.name = name
 
-    def __init__(self, state):
-        self.state = state
+    @property
+    def state(self):
+        return self._state()
 
     def soil(self, value):
-        self.state.soil()
+        state = self._state()
+        if state is not None:
+            state.soil(self.name)
     added_items = soil
     added_item = soil
     removed_item = soil
@@ -1,9 +1,12 @@
+from weakref import WeakValueDictionary
+
 from ming.utils import indent
 
 class IdentityMap(object):
 
-    def __init__(self):
-        self._objects = {}
+    def __init__(self, weak=False):
+        self._weak = weak
+        self.clear()
 
     def get(self, cls, id):
         return self._objects.get((cls, id), None)
@@ -14,7 +17,10 @@ class IdentityMap(object):
             self._objects[value.__class__, vid] = value
 
     def clear(self):
-        self._objects = {}
+        if self._weak:
+            self._objects = WeakValueDictionary()
+        else:
+            self._objects = {}
 
     def expunge(self, obj):
         vid = getattr(obj, '_id', ())
@@ -26,7 +32,7 @@ class IdentityMap(object):
 
     def __repr__(self):
         l = [ '<imap (%d)>' % len(self._objects) ]
-        for k,v in sorted(self._objects.iteritems()):
+        for k,v in sorted(self._objects.items()):
             l.append(indent('  %s : %s => %r'
                             % (k[0].__name__, k[1], v),
                             4))
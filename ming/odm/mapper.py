@@ -1,8 +1,10 @@
+import weakref
 from copy import copy
 from ming.base import Object
 from ming.utils import wordwrap
+from ming import schema as S
 
-from .base import ObjectState, state, with_hooks
+from .base import ObjectState, state, with_hooks, call_hook
 from .property import FieldProperty
 
 def mapper(cls, collection=None, session=None, **kwargs):
@@ -38,7 +40,8 @@ class Mapper(object):
         exclude_properties = kwargs.pop('exclude_properties', [])
         extensions = kwargs.pop('extensions', [])
         self.extensions = [e(self) for e in extensions]
-        self.options = Object(kwargs.pop('options', dict(refresh=False, instrument=True)))
+        self.options = Object(kwargs.pop('options', dict(
+                    refresh=False, instrument=True, lazy_validate=False)))
         if kwargs:
             raise TypeError, 'Unknown kwd args: %r' % kwargs
         self._instrument_class(properties, include_properties, exclude_properties)
@@ -52,12 +55,69 @@ class Mapper(object):
         doc = self.collection(state.document, skip_from_bson=True)
         session.impl.insert(doc, validate=False)
         state.status = state.clean
+        state.dirty_fields = None
+
+    def before_insert_many(self, obj, state, session):
+        '''The first half of insert(), for batched inserts.  Returns the
+        document to insert.'''
+        call_hook(self, 'before_insert', obj, state, session)
+        return self.collection(state.document, skip_from_bson=True)
+
+    def after_insert_many(self, obj, state, session):
+        state.status = state.clean
+        state.dirty_fields = None
+        call_hook(self, 'after_insert', obj, state, session)
 
     @with_hooks('update')
     def update(self, obj, state, session, **kwargs):
+        if state.loaded_fields is not None:
+            return self._update_loaded(state, session)
+        if state.validated_fields is not None:
+            state.validate(
+                self.collection.m.schema, allow_extra=True, strip_extra=True)
         doc = self.collection(state.document, skip_from_bson=True)
-        session.impl.save(doc, validate=False)
+        fields = state.dirty_fields
+        if fields is None or doc.m.before_save or '_id' not in doc:
+            session.impl.save(doc, validate=False)
+        else:
+            # Only send the top-level fields that changed
+            update = {}
+            for name in fields:
+                if name in doc:
+                    update.setdefault('$set', {})[name] = doc[name]
+                else:
+                    update.setdefault('$unset', {})[name] = 1
+            if update:
+                session.impl.update_partial(
+                    self.collection, {'_id':doc['_id']}, update)
         state.status = state.clean
+        state.dirty_fields = None
+
+    def _update_loaded(self, state, session):
+        '''Update an object loaded by a projected query.  Only the loaded
+        fields are validated, and the document is never saved whole since
+        that would drop the fields that were not loaded.'''
+        schema = self.collection.m.schema
+        fields = state.dirty_fields
+        if fields is None:
+            fields = state.loaded_fields
+        update = {}
+        for name in fields:
+            if name == '_id': continue
+            if (state.validated_fields is not None
+                and name not in state.validated_fields):
+                field = schema.fields.get(name)
+                if field is not None:
+                    state.validate_field(name, field)
+            if name in state.document:
+                update.setdefault('$set', {})[name] = state.document[name]
+            else:
+                update.setdefault('$unset', {})[name] = 1
+        if update:
+            session.impl.update_partial(
+                self.collection, {'_id':state.document['_id']}, update)
+        state.status = state.clean
+        state.dirty_fields = None
 
     @with_hooks('delete')
     def delete(self, obj, state, session, **kwargs):
@@ -69,9 +129,22 @@ class Mapper(object):
         session.impl.remove(self.collection, *args, **kwargs)
 
     def create(self, doc, options):
-        doc = self.collection.make(doc)
+        options = Object(self.options, **options)
+        schema = self.collection.m.schema
+        fields = options.get('fields')
+        if ((fields is not None or options.get('lazy_validate'))
+            and isinstance(schema, S.Document)):
+            # Defer validation to first access of each field (or flush)
+            mapper = self.by_collection(schema.get_polymorphic_cls(doc))
+            obj = mapper._from_doc(doc, options, validate=False)
+            if fields is not None:
+                state(obj).loaded_fields = set(fields)
+            return obj
+        if not options.get('validated'):
+            doc = self.collection.make(
+                doc, allow_extra=True, strip_extra=True)
         mapper = self.by_collection(type(doc))
-        return mapper._from_doc(doc, Object(self.options, **options))
+        return mapper._from_doc(doc, options)
 
     def base_mappers(self):
         for base in self.mapped_class.__bases__:
@@ -131,12 +204,17 @@ class Mapper(object):
     def update_partial(self, session, *args, **kwargs):
         session.impl.update_partial(self.collection, *args, **kwargs)
 
-    def _from_doc(self, doc, options):
+    def _from_doc(self, doc, options, validate=True):
         obj = self.mapped_class.__new__(self.mapped_class)
         obj.__ming__ = _ORMDecoration(self, obj, options)
         st = state(obj)
-        st.original_document = doc
-        st.document = self.collection.m.schema.validate(doc)
+        if options.get('original_document', True):
+            st.original_document = doc
+        if validate:
+            st.document = self.collection.m.schema.compiled()(doc)
+        else:
+            st.document = Object(doc)
+            st.validated_fields = set()
         st.status = st.new
         # self.session.save(obj)
         return obj
@@ -226,13 +304,23 @@ class MapperExtension(object):
     def after_remove(self, sess): pass
 
 class _ORMDecoration(object):
+    __slots__ = ('mapper', '_instance', 'state')
 
     def __init__(self, mapper, instance, options):
         self.mapper = mapper
-        self.instance = instance
+        # Avoid a reference cycle, so that instances are freed promptly
+        try:
+            self._instance = weakref.ref(instance)
+        except TypeError:
+            self._instance = lambda: instance
         self.state = ObjectState(options)
         self.state.document = Object()
-        self.state.original_document = Object()
+        if options.get('original_document', True):
+            self.state.original_document = Object()
+
+    @property
+    def instance(self):
+        return self._instance()
 
 class _QueryDescriptor(object):
 
@@ -271,30 +359,36 @@ class _ClassQuery(object):
         return self.find(kwargs)
 
 class _InstQuery(object):
-    _proxy_methods = (
-        'update_if_not_modified',
-        )
+    __slots__ = ('classquery', 'instance')
 
     def __init__(self, classquery, instance):
         self.classquery = classquery
-        self.mapper = classquery.mapper
-        self.session = classquery.session
-        self.mapped_class = classquery.mapped_class
         self.instance = instance
 
-        def _proxy(name):
-            def inner(*args, **kwargs):
-                method = getattr(self.session, name)
-                return method(self.instance, *args, **kwargs)
-            inner.__name__ = name
-            return inner
+    @property
+    def mapper(self):
+        return self.classquery.mapper
 
-        for method_name in self._proxy_methods:
-            setattr(self, method_name, _proxy(method_name))
+    @property
+    def session(self):
+        return self.classquery.session
+
+    @property
+    def mapped_class(self):
+        return self.classquery.mapped_class
+
+    # Some methods are just convenient (and safe)
+    @property
+    def find(self):
+        return self.classquery.find
+
+    @property
+    def get(self):
+        return self.classquery.get
 
-        # Some methods are just convenient (and safe)
-        self.find = self.classquery.find
-        self.get = self.classquery.get
+    def update_if_not_modified(self, *args, **kwargs):
+        return self.classquery.session.update_if_not_modified(
+            self.instance, *args, **kwargs)
 
     def delete(self):
         st = state(self.instance)
@@ -1,24 +1,35 @@
-from collections import defaultdict
+from collections import defaultdict, deque
 
 from ming.session import Session
 from ming.utils import ThreadLocalProxy, ContextualProxy, indent
 from ming.base import Object
+from ming import schema as S
 from .base import state, ObjectState, session, with_hooks, call_hook
-from .mapper import mapper
+from .mapper import mapper, Mapper
 from .unit_of_work import UnitOfWork
 from .identity_map import IdentityMap
 
+def _overrides(obj, cls, name):
+    'True if obj.<name> is not the implementation defined on cls'
+    method = getattr(obj, name)
+    return getattr(method, 'im_func', None) is not cls.__dict__[name]
+
 class ODMSession(object):
 
     _registry = {}
 
-    def __init__(self, doc_session=None, bind=None, extensions=None):
+    def __init__(self, doc_session=None, bind=None, extensions=None,
+                 weak_identity_map=False):
+        '''If weak_identity_map is set, clean objects are only weakly
+        referenced by the session, so they are released as soon as the
+        application drops them.  New, dirty, and deleted objects are held
+        until they are flushed.'''
         if doc_session is None:
             doc_session = Session(bind)
         if extensions is None: extensions = []
         self.impl = doc_session
-        self.uow = UnitOfWork(self)
-        self.imap = IdentityMap()
+        self.uow = UnitOfWork(self, weak=weak_identity_map)
+        self.imap = IdentityMap(weak=weak_identity_map)
         self.extensions = [ e(self) for e in extensions ]
         self.autoflush = False
 
@@ -63,6 +74,35 @@ class ODMSession(object):
     def insert_now(self, obj, st, **kwargs):
         mapper(obj).insert(obj, st, self, **kwargs)
 
+    def insert_many_now(self, objs, **kwargs):
+        '''Insert new objects using as few round trips as possible.  The
+        before_insert hooks are called for every object before the insert,
+        and the after_insert hooks for every object after it.  Objects whose
+        insert is overridden (by a subclass of this session or of their
+        Mapper) are inserted one at a time with insert_now.'''
+        if _overrides(self, ODMSession, 'insert_now'):
+            batch = []
+        else:
+            batch = [ obj for obj in objs
+                      if not _overrides(mapper(obj), Mapper, 'insert') ]
+        if len(batch) != len(objs):
+            batched = set(map(id, batch))
+            for obj in objs:
+                if id(obj) not in batched:
+                    self.insert_now(obj, state(obj), **kwargs)
+        if not batch: return
+        objs = batch
+        docs = []
+        for obj in objs:
+            st = state(obj)
+            call_hook(self, 'before_insert', obj, st, **kwargs)
+            docs.append(mapper(obj).before_insert_many(obj, st, self))
+        self.impl.insert_many(docs, validate=False)
+        for obj in objs:
+            st = state(obj)
+            mapper(obj).after_insert_many(obj, st, self)
+            call_hook(self, 'after_insert', obj, st, **kwargs)
+
     @with_hooks('update')
     def update_now(self, obj, st, **kwargs):
         mapper(obj).update(obj, st, self, **kwargs)
@@ -88,12 +128,27 @@ class ODMSession(object):
     def find(self, cls, *args, **kwargs):
         refresh = kwargs.pop('refresh', False)
         decorate = kwargs.pop('decorate', None)
+        eager = kwargs.pop('eager', ())
         if self.autoflush:
             self.flush()
         m = mapper(cls)
+        lazy_validate = kwargs.pop(
+            'lazy_validate', m.options.get('lazy_validate', False))
+        args = list(args)
+        if len(args) > 1:
+            args[1], fields = _projection(m, args[1])
+        elif kwargs.get('fields'):
+            kwargs['fields'], fields = _projection(m, kwargs['fields'])
+        else:
+            fields = None
+        if lazy_validate or fields is not None:
+            # Partial objects are validated field by field
+            kwargs['validate'] = False
         # args = map(deinstrument, args)
         ming_cursor = self.impl.find(m.collection, *args, **kwargs)
-        odm_cursor = ODMCursor(self, cls, ming_cursor, refresh=refresh, decorate=decorate)
+        odm_cursor = ODMCursor(self, cls, ming_cursor, refresh=refresh,
+                               decorate=decorate, lazy_validate=lazy_validate,
+                               eager=eager, fields=fields)
         call_hook(self, 'cursor_created', odm_cursor, 'find', cls, *args, **kwargs)
         return odm_cursor
 
@@ -119,7 +174,12 @@ class ODMSession(object):
         m.update_partial(self, spec, fields, **kwargs)
 
     def update_if_not_modified(self, obj, fields, upsert=False):
-        self.update(obj.__class__, state(obj).original_document, fields, upsert)
+        original = state(obj).original_document
+        if original is None:
+            raise ValueError, (
+                'The original document of %r was not kept (see the Mapper '
+                'option original_document)' % obj)
+        self.update(obj.__class__, original, fields, upsert)
         err = self.impl.db.command(dict(getlasterror=1))
         if err['n'] and err['updatedExisting']: return True
         return False
@@ -142,6 +202,33 @@ class ODMSession(object):
     def update_indexes(self, cls, **kwargs):
         return self.impl.update_indexes(cls, **kwargs)
 
+def _projection(mapper, fields):
+    '''Return (fields, loaded) for the fields argument of a query: the
+    projection to send, and the names of the top-level fields it loads (or
+    None if it loads whole objects).  Fields that are excluded, or only
+    partly loaded through a dotted name, are not loaded.  _id and the
+    polymorphic discriminator are always loaded.'''
+    if not fields: return fields, None
+    schema = mapper.collection.m.schema
+    if not isinstance(schema, S.Document): return fields, None
+    always = set([ '_id' ])
+    if schema.polymorphic_on:
+        # needed to pick the class of each object
+        always.add(schema.polymorphic_on)
+    if isinstance(fields, dict):
+        included = [ k for k, v in fields.iteritems() if v ]
+        excluded = [ k for k, v in fields.iteritems()
+                     if not v and k not in always ]
+    else:
+        included, excluded = list(fields), []
+    if excluded and not included:
+        loaded = set(schema.fields).difference(
+            k.split('.')[0] for k in excluded)
+        return dict((k, 0) for k in excluded), loaded | always
+    if not included: return None, None
+    loaded = set(k for k in included if '.' not in k)
+    return list(always.union(included)), loaded | always
+
 class SessionExtension(object):
 
     def __init__(self, session):
@@ -228,8 +315,11 @@ class ContextualODMSession(ContextualProxy):
         del cls._session_registry[context]
 
 class ODMCursor(object):
+    # Number of objects loaded at a time when eager-loading relations
+    eager_batch_size = 100
 
-    def __init__(self, session, cls, ming_cursor, refresh=False, decorate=None):
+    def __init__(self, session, cls, ming_cursor, refresh=False, decorate=None,
+                 lazy_validate=False, eager=(), fields=None):
         self.session = session
         self.cls = cls
         self.mapper = mapper(cls)
@@ -237,7 +327,11 @@ class ODMCursor(object):
         self._options = Object(
             refresh=refresh,
             decorate=decorate,
-            instrument=True)
+            instrument=True,
+            lazy_validate=lazy_validate,
+            eager=eager,
+            fields=fields)
+        self._buffer = deque()
 
     def __iter__(self):
         return self
@@ -253,7 +347,34 @@ class ODMCursor(object):
         return self.ming_cursor.count()
 
     def _next_impl(self):
-        doc = self.ming_cursor.next()
+        if self._options.get('eager'):
+            if not self._buffer:
+                self._load_batch()
+            obj = self._buffer.popleft()
+        else:
+            obj = self._load(self.ming_cursor.next())
+        if self._options.decorate is not None:
+            return self._options.decorate(obj)
+        else:
+            return obj
+
+    def _load_batch(self):
+        '''Load the next batch of objects along with the relations named in
+        the eager option, using one query per relation for the batch'''
+        objs = []
+        for doc in self.ming_cursor:
+            objs.append(self._load(doc))
+            if len(objs) >= self.eager_batch_size: break
+        if not objs:
+            raise StopIteration
+        for name in self._options.eager:
+            prop = getattr(self.cls, name)
+            if not hasattr(prop, 'load_many'):
+                raise TypeError, '%s is not a relation' % name
+            prop.load_many(objs)
+        self._buffer.extend(objs)
+
+    def _load(self, doc):
         obj = self.session.imap.get(self.cls, doc['_id'])
         if obj is None:
             obj = self.mapper.create(doc, self._options)
@@ -261,8 +382,22 @@ class ODMCursor(object):
             self.session.save(obj)
         elif self._options.refresh:
             # Refresh object
-            state(obj).update(doc)
-            state(obj).status = ObjectState.clean
+            st = state(obj)
+            st.update(doc)
+            if self._options.lazy_validate or self._options.get('fields'):
+                st.validated_fields = set()
+            else:
+                st.validated_fields = None
+            self._loaded(st)
+            st.status = ObjectState.clean
+        elif state(obj).loaded_fields is not None:
+            # Fill in the fields an earlier projected query did not load,
+            # leaving those already loaded (and perhaps changed) alone
+            st = state(obj)
+            for name, value in doc.iteritems():
+                if name not in st.loaded_fields:
+                    st.document[name] = value
+            self._loaded(st)
         else:
             # Never refresh objects from the DB unless explicitly requested
             pass
@@ -270,10 +405,14 @@ class ODMCursor(object):
         if other_session is not None and other_session != self:
             other_session.expunge(obj)
             self.session.save(obj)
-        if self._options.decorate is not None:
-            return self._options.decorate(obj)
-        else:
-            return obj
+        return obj
+
+    def _loaded(self, st):
+        fields = self._options.get('fields')
+        if fields is None:
+            st.loaded_fields = None
+        elif st.loaded_fields is not None:
+            st.loaded_fields.update(fields)
 
     def next(self):
         call_hook(self, 'before_cursor_next', self)
@@ -282,36 +421,70 @@ class ODMCursor(object):
         finally:
             call_hook(self, 'after_cursor_next', self)
 
+    def stream(self, batch_size=None, **options):
+        '''Iterate over the results as detached, read-only objects.  They
+        are not looked up in or added to the identity map or unit of work
+        (so changes to them are never flushed), and are not instrumented
+        unless instrument=True is passed.  Memory use is constant however
+        many documents are read.'''
+        ming_cursor = self.ming_cursor
+        if batch_size is not None:
+            ming_cursor = ming_cursor.batch_size(batch_size)
+        options.setdefault('instrument', False)
+        options = Object(self._options, **options)
+        create = self.mapper.create
+        decorate = options.decorate
+        for doc in ming_cursor:
+            obj = create(doc, options)
+            state(obj).status = ObjectState.clean
+            if decorate is not None:
+                obj = decorate(obj)
+            yield obj
+
+    def _clone(self, ming_cursor, **options):
+        odm_cursor = ODMCursor(self.session, self.cls, ming_cursor)
+        odm_cursor._options = Object(self._options, **options)
+        return odm_cursor
+
     def options(self, **kwargs):
-        odm_cursor = ODMCursor(self.session, self.cls,self.ming_cursor)
-        odm_cursor._options = Object(self._options, **kwargs)
+        odm_cursor = self._clone(self.ming_cursor, **kwargs)
         call_hook(self, 'cursor_created', odm_cursor, 'options', self, **kwargs)
         return odm_cursor
 
     def limit(self, limit):
-        odm_cursor = ODMCursor(self.session, self.cls,
-                               self.ming_cursor.limit(limit))
+        odm_cursor = self._clone(self.ming_cursor.limit(limit))
         call_hook(self, 'cursor_created', odm_cursor, 'limit', self, limit)
         return odm_cursor
 
     def skip(self, skip):
-        odm_cursor = ODMCursor(self.session, self.cls,
-                               self.ming_cursor.skip(skip))
+        odm_cursor = self._clone(self.ming_cursor.skip(skip))
         call_hook(self, 'cursor_created', odm_cursor, 'skip', self, skip)
         return odm_cursor
 
     def hint(self, index_or_name):
-        odm_cursor = ODMCursor(self.session, self.cls,
-                               self.ming_cursor.hint(index_or_name))
+        odm_cursor = self._clone(self.ming_cursor.hint(index_or_name))
         call_hook(self, 'cursor_created', odm_cursor, 'hint', self, index_or_name)
         return odm_cursor
 
     def sort(self, *args, **kwargs):
-        odm_cursor = ODMCursor(self.session, self.cls,
-                               self.ming_cursor.sort(*args, **kwargs))
+        odm_cursor = self._clone(self.ming_cursor.sort(*args, **kwargs))
         call_hook(self, 'cursor_created', odm_cursor, 'sort', self, *args, **kwargs)
         return odm_cursor
 
+    def prefetch(self, batch_size=100, depth=2):
+        '''Read and validate the documents on a background thread (see
+        ming.base.Cursor.prefetch); the objects are still created and added
+        to the session on the caller's thread'''
+        ming_cursor = self.ming_cursor.prefetch(batch_size, depth)
+        odm_cursor = self._clone(
+            ming_cursor, validated=ming_cursor._validate)
+        call_hook(self, 'cursor_created', odm_cursor, 'prefetch', self,
+                  batch_size, depth)
+        return odm_cursor
+
+    def close(self):
+        self.ming_cursor.close()
+
     def one(self):
         try:
             result = self.next()
@@ -320,14 +493,23 @@ class ODMCursor(object):
         try:
             self.next()
         except StopIteration:
+            self._finish()
             return result
+        self._finish()
         raise ValueError, 'More than one result from .one()'
 
     def first(self):
         try:
-            return self.next()
+            result = self.next()
         except StopIteration:
             return None
+        self._finish()
+        return result
+
+    def _finish(self):
+        # report the query to the profilers, if any, without reading on
+        finish = getattr(self.ming_cursor, '_finish', None)
+        if finish is not None: finish()
 
     def all(self):
         return list(self)
@@ -51,6 +51,8 @@ class FieldProperty(ORMProperty):
         return True
 
     def repr(self, doc):
+        if not state(doc).is_loaded(self.name):
+            return '<unloaded>'
         try:
             return repr(self.__get__(doc))
         except AttributeError:
@@ -59,6 +61,11 @@ class FieldProperty(ORMProperty):
     def __get__(self, instance, cls=None):
         if instance is None: return self
         st = state(instance)
+        if not st.is_loaded(self.name):
+            raise AttributeError, '%s was not loaded by the query' % self.name
+        if (st.validated_fields is not None
+            and self.name not in st.validated_fields):
+            st.validate_field(self.name, self.field.schema)
         if not st.options.instrument:
             return st.document[self.name]
         try:
@@ -85,11 +92,12 @@ class FieldProperty(ORMProperty):
         value = deinstrument(value)
         value = self.field.schema.validate(value)
         st.set(self.name, value)
-        st.soil()
+        st.soil(self.name)
 
     def __delete__(self, instance, cls=None):
         st = state(instance)
         st.delete(self.name)
+        st.soil(self.name)
 
 
 class FieldPropertyWithMissingNone(FieldProperty):
@@ -101,6 +109,11 @@ class FieldPropertyWithMissingNone(FieldProperty):
     def __get__(self, instance, cls=None):
         if instance is None: return self
         st = state(instance)
+        if not st.is_loaded(self.name):
+            raise AttributeError, '%s was not loaded by the query' % self.name
+        if (st.validated_fields is not None
+            and self.name not in st.validated_fields):
+            st.validate_field(self.name, self.field.schema)
         if not st.options.instrument:
             return st.document[self.name]
         try:
@@ -194,6 +207,8 @@ class RelationProperty(ORMProperty):
                 cls, rel)
 
     def repr(self, doc):
+        if not state(doc).is_loaded(self.join.key_name):
+            return '<unloaded>'
         try:
             return repr(self.__get__(doc))
         except AttributeError:
@@ -213,15 +228,50 @@ class RelationProperty(ORMProperty):
     def __set__(self, instance, value):
         self.join.set(instance, value)
 
+    def load_many(self, instances):
+        '''Load the related objects of several instances with a single query,
+        caching them for __get__'''
+        if not self.fetch: return
+        # Instances whose key was not loaded (by a projected query) are
+        # left to load on access
+        key_name = self.join.key_name
+        states = [ state(i) for i in instances ]
+        todo = [ (i, st) for i, st in zip(instances, states)
+                 if self not in st.extra_state and st.is_loaded(key_name) ]
+        if not todo: return
+        results = self.join.load_many([ i for i, st in todo ])
+        for (instance, st), result in zip(todo, results):
+            st.extra_state[self] = result
+
 class ManyToOneJoin(object):
 
     def __init__(self, own_cls, rel_cls, prop):
         self.own_cls, self.rel_cls, self.prop = own_cls, rel_cls, prop
+        self.key_name = prop.name
 
     def load(self, instance):
         key_value = self.prop.__get__(instance, self.own_cls)
         return self.rel_cls.query.get(_id=key_value)
 
+    def load_many(self, instances):
+        from .mapper import mapper
+        key_values = [ self.prop.__get__(i, self.own_cls) for i in instances ]
+        imap = mapper(self.rel_cls).session.imap
+        related = {}
+        missing = set()
+        for key_value in key_values:
+            if key_value is None or key_value in related: continue
+            obj = imap.get(self.rel_cls, key_value)
+            if obj is None:
+                missing.add(key_value)
+            else:
+                related[key_value] = obj
+        if missing:
+            for obj in self.rel_cls.query.find(
+                {'_id':{'$in':list(missing)}}):
+                related[obj._id] = obj
+        return [ related.get(k) for k in key_values ]
+
     def iterator(self, instance):
         return [ self.load(instance) ]
 
@@ -232,12 +282,28 @@ class OneToManyJoin(object):
 
     def __init__(self, own_cls, rel_cls, prop):
         self.own_cls, self.rel_cls, self.prop = own_cls, rel_cls, prop
+        self.key_name = '_id'
 
     def load(self, instance):
         return instrument(
             list(self.iterator(instance)), 
             OneToManyTracker(state(instance)))
         
+    def load_many(self, instances):
+        key_values = [ i._id for i in instances ]
+        related = dict((k, []) for k in key_values)
+        for obj in self.rel_cls.query.find(
+            {self.prop.name:{'$in':key_values}}):
+            obj_keys = self.prop.__get__(obj, self.rel_cls)
+            if not isinstance(obj_keys, list):
+                obj_keys = [ obj_keys ]
+            for k in set(obj_keys):
+                children = related.get(k)
+                if children is not None:
+                    children.append(obj)
+        return [ instrument(related[k], OneToManyTracker(state(i)))
+                 for i, k in zip(instances, key_values) ]
+
     def iterator(self, instance):
         key_value = instance._id
         return self.rel_cls.query.find({self.prop.name:key_value})
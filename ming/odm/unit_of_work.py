@@ -1,60 +1,77 @@
+from weakref import WeakValueDictionary
+
 from ming.utils import indent
 from .base import state, ObjectState
 
 class UnitOfWork(object):
 
-    def __init__(self, session):
+    def __init__(self, session, weak=False):
         self.session = session
-        self._objects = {}
+        self._weak = weak
+        self.clear()
 
     def save(self, obj):
-        self._objects[id(obj)] = obj
+        st = state(obj)
+        self._objects[id(st)] = obj
+        st.uow = self
+        self.status_changed(st)
+
+    def status_changed(self, st):
+        key = id(st)
+        if st.status == ObjectState.clean:
+            self._pending.pop(key, None)
+        else:
+            obj = self._objects.get(key)
+            if obj is not None:
+                self._pending[key] = obj
+
+    def _with_status(self, status):
+        return (obj for obj in self._pending.values()
+                if state(obj).status == status)
 
     @property
     def new(self):
-        return (obj for obj in self._objects.itervalues()
-                if state(obj).status == ObjectState.new)
+        return self._with_status(ObjectState.new)
 
     @property
     def clean(self):
-        return (obj for obj in self._objects.itervalues()
-                if state(obj).status == ObjectState.clean)
+        return (obj for key, obj in self._objects.items()
+                if key not in self._pending)
 
     @property
     def dirty(self):
-        return (obj for obj in self._objects.itervalues()
-                if state(obj).status == ObjectState.dirty)
+        return self._with_status(ObjectState.dirty)
 
     @property
     def deleted(self):
-        return (obj for obj in self._objects.itervalues()
-                if state(obj).status == ObjectState.deleted)
+        return self._with_status(ObjectState.deleted)
 
     def flush(self):
-        new_objs = {}
-        inow = self.session.insert_now
+        imap = self.session.imap
         unow = self.session.update_now
         dnow = self.session.delete_now
-        for i, obj in self._objects.items():
+        # Insert new objects (in one batch) before any updates or deletes,
+        # which may refer to them
+        inserts = list(self.new)
+        if inserts:
+            self.session.insert_many_now(inserts)
+            for obj in inserts:
+                state(obj).status = ObjectState.clean
+                imap.save(obj)
+        for key, obj in self._pending.items():
             st = state(obj)
-            if st.status == ObjectState.new:
-                inow(obj, st)
-                st.status = ObjectState.clean
-                new_objs[i] = obj
-            elif st.status == ObjectState.dirty:
+            if st.status == ObjectState.dirty:
                 unow(obj, st)
                 st.status = ObjectState.clean
-                new_objs[i] = obj
+                imap.save(obj)
             elif st.status == ObjectState.deleted:
                 dnow(obj, st)
+                self.expunge(obj)
+                imap.expunge(obj)
             elif st.status == ObjectState.clean:
-                new_objs[i] = obj
+                self._pending.pop(key, None)
             else:
                 assert False, 'Unknown obj state: %s' % st.status
-        self._objects = new_objs
-        self.session.imap.clear()
-        for obj in new_objs.itervalues():
-            self.session.imap.save(obj)
 
     def __repr__(self):
         l = ['<UnitOfWork>']
@@ -69,11 +86,17 @@ class UnitOfWork(object):
         return '\n'.join(l)
 
     def clear(self):
-        self._objects = {} # dict[id(obj)] = obj
+        if self._weak:
+            self._objects = WeakValueDictionary() # dict[id(state)] = obj
+        else:
+            self._objects = {}
+        # The objects in _objects which are not clean (always held strongly)
+        self._pending = {}
 
     def expunge(self, obj):
-        try:
-            del self._objects[id(obj)]
-        except KeyError:
-            pass
+        st = state(obj)
+        self._objects.pop(id(st), None)
+        self._pending.pop(id(st), None)
+        if st.uow is self:
+            st.uow = None
 
@@ -0,0 +1,164 @@
+'''Profiling of the operations done by a ming.Session.
+
+Each operation is described by a QueryRecord, passed to the record() method
+of every profiler in Session.profilers once the operation is complete.  For
+find() that is when the cursor is exhausted (or first()/one() is called).'''
+from __future__ import with_statement
+import time
+import logging
+from threading import Lock
+
+from .utils import LazyProperty
+
+def query_shape(spec):
+    '''Return a string describing spec with its values redacted (field names
+    and operators are kept), so that queries differing only in their values
+    have the same shape.'''
+    if spec is None: return '{}'
+    return _shape(spec)
+
+def _shape(value):
+    if not isinstance(value, dict): return '?'
+    parts = []
+    for k, v in sorted(value.iteritems()):
+        if _is_operator(k):
+            parts.append('%s: %s' % (k, _operator_shape(k, v)))
+        else:
+            parts.append('%s: %s' % (k, _field_shape(v)))
+    return '{%s}' % ', '.join(parts)
+
+def _is_operator(key):
+    return isinstance(key, basestring) and key.startswith('$')
+
+def _field_shape(value):
+    # a dict without operators is an embedded document to match
+    if isinstance(value, dict) and any(_is_operator(k) for k in value):
+        return _shape(value)
+    return '?'
+
+def _operator_shape(op, value):
+    if op in ('$and', '$or', '$nor') and isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join(_shape(v) for v in value)
+    if op in ('$not', '$elemMatch') and isinstance(value, dict):
+        return _shape(value)
+    return '?'
+
+class QueryRecord(object):
+    '''A single operation: its name ('find', 'save', ...), collection and spec
+    (the query for reads, updates and removes, {_id:...} for writes of a
+    document).  duration is the time spent in the operation, including
+    validation_time; documents is the number of documents returned or
+    written.
+
+    Used as a context manager, the duration is the time from the record's
+    creation to the end of the with block, after which it is reported.'''
+
+    def __init__(self, operation, collection, spec, profilers):
+        self.operation = operation
+        self.collection = collection
+        self.spec = spec
+        self.timestamp = time.time()
+        self.duration = 0.0
+        self.validation_time = 0.0
+        self.documents = 0
+        self._profilers = profilers
+
+    def __repr__(self):
+        return '<QueryRecord %s %s %s %.4fs %d docs>' % (
+            self.operation, self.collection, self.shape, self.duration,
+            self.documents)
+
+    @LazyProperty
+    def shape(self):
+        return query_shape(self.spec)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.duration = time.time() - self.timestamp
+        self.finish()
+
+    def validate(self, func, *args, **kwargs):
+        'Call func, counting the time taken as validation'
+        begin = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.validation_time += time.time() - begin
+
+    def finish(self):
+        for profiler in self._profilers:
+            profiler.record(self)
+
+class _NullRecord(object):
+    'Stands in for a QueryRecord when there are no profilers'
+    spec = None
+    documents = 0
+    def __setattr__(self, name, value): pass
+    def __enter__(self): return self
+    def __exit__(self, exc_type, exc_value, tb): pass
+    def validate(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+null_record = _NullRecord()
+
+class Profiler(object):
+    '''Base class for profilers'''
+
+    def record(self, record):
+        'Receive a completed QueryRecord'
+        pass
+
+class SlowQueryLogger(Profiler):
+    '''Log the operations taking at least threshold seconds'''
+
+    def __init__(self, threshold=0.1, log=None, level=logging.WARNING):
+        if log is None: log = logging.getLogger('ming.profiling.slow')
+        self.threshold = threshold
+        self.log = log
+        self.level = level
+
+    def record(self, record):
+        if record.duration < self.threshold: return
+        self.log.log(
+            self.level,
+            'Slow %s on %s: %.3fs (%.3fs validating), %d documents: %s',
+            record.operation, record.collection, record.duration,
+            record.validation_time, record.documents, record.shape)
+
+class ShapeAggregator(Profiler):
+    '''Aggregate the operations by (operation, collection, shape)'''
+
+    def __init__(self):
+        self._lock = Lock()
+        self._stats = {}
+
+    def record(self, record):
+        key = (record.operation, record.collection, record.shape)
+        with self._lock:
+            try:
+                stats = self._stats[key]
+            except KeyError:
+                stats = self._stats[key] = dict(
+                    operation=record.operation,
+                    collection=record.collection,
+                    shape=record.shape,
+                    count=0, duration=0.0, max_duration=0.0,
+                    validation_time=0.0, documents=0)
+            stats['count'] += 1
+            stats['duration'] += record.duration
+            stats['max_duration'] = max(stats['max_duration'], record.duration)
+            stats['validation_time'] += record.validation_time
+            stats['documents'] += record.documents
+
+    def stats(self):
+        'The aggregates, most total time first'
+        with self._lock:
+            result = [ dict(s) for s in self._stats.itervalues() ]
+        result.sort(key=lambda s: -s['duration'])
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
@@ -1,3 +1,4 @@
+import time
 import types
 import logging
 
@@ -8,12 +9,15 @@ import bson
 import pymongo
 
 from .utils import LazyProperty
-from .base import Object as BaseObject, Missing, NoDefault
+from .base import Object as BaseObject, Missing, NoDefault, _make_safe
 
 log = logging.getLogger(__name__)
 
 NoneType = type(None)
 
+# Bumped by invalidate_compiled() to discard every compiled() cache
+_compiled_generation = 0
+
 
 # lifted from formencode.validators
 # but separate, so TurboGears special handling of formencode.validators.Invalid won't kick in incorrectly
@@ -82,6 +86,76 @@ class SchemaItem(object):
         'convert/validate an object or raise an Invalid exception'
         raise NotImplementedError, 'validate'
 
+    def compiled(self, allow_extra=False, strip_extra=False, safe=False,
+                 _collection=None, _path=''):
+        '''Return a function of one argument equivalent to
+        ``self.validate(value, allow_extra=allow_extra, strip_extra=strip_extra)``.
+
+        The schema tree is walked once and flattened into closures, so the
+        returned function does no kwargs threading or per-field method
+        lookup.  The result is cached on the SchemaItem until any schema is
+        changed with invalidate_compiled(), since the compiled functions of
+        parents capture those of their children.
+
+        If safe is True, the function also does the work of
+        Object.make_safe() as it goes: Decimals are converted to floats and
+        values that cannot be stored in BSON raise AssertionError.
+
+        While a ValidationProfiler is enabled (see enable_profiling), the
+        functions compiled also time each part of the schema.  _collection
+        and _path are passed down the schema tree to identify the parts.'''
+        profiler = _profiler
+        if profiler is None:
+            key = (allow_extra, strip_extra, safe)
+        else:
+            if _collection is None:
+                _collection = self._collection_name()
+            key = (allow_extra, strip_extra, safe, profiler, _collection, _path)
+        cache = self._get_compiled_cache()
+        try:
+            return cache[key]
+        except KeyError:
+            kw = dict(allow_extra=allow_extra, strip_extra=strip_extra)
+            if safe: kw['safe'] = True
+            if profiler is None:
+                result = self._compile(kw)
+            else:
+                kw.update(_collection=_collection, _path=_path)
+                result = profiler.wrap(
+                    (_collection, _path, type(self).__name__),
+                    self._compile(kw))
+            cache[key] = result
+            return result
+
+    def _collection_name(self):
+        return None
+
+    def invalidate_compiled(self):
+        '''Discard any functions cached by compiled(), here and in every
+        other SchemaItem (which may have captured ours)'''
+        global _compiled_generation
+        _compiled_generation += 1
+        self.__dict__.pop('_compiled_cache', None)
+
+    def _get_compiled_cache(self):
+        try:
+            generation, cache = self.__dict__['_compiled_cache']
+            if generation == _compiled_generation: return cache
+        except KeyError:
+            pass
+        cache = {}
+        self.__dict__['_compiled_cache'] = (_compiled_generation, cache)
+        return cache
+
+    def _compile(self, kw):
+        return _interpreted(self.validate, kw)
+
+    def _validates_with(self, cls, name='_validate'):
+        '''True if self.<name> is the implementation defined on cls (i.e.
+        it has not been overridden by a subclass or instance)'''
+        method = getattr(self, name)
+        return getattr(method, 'im_func', None) is cls.__dict__[name]
+
     @classmethod
     def make(cls, field, *args, **kwargs):
         '''Build a SchemaItem from a "shorthand" schema.  The `field` param:
@@ -119,6 +193,47 @@ class SchemaItem(object):
             field = Value(field, *args, **kwargs)
         return field
 
+def _identity(value):
+    return value
+
+_immutable_types = (
+    NoneType, basestring, int, long, float, bool, datetime, bson.ObjectId)
+
+def _copier(value):
+    '''Return a function of no arguments returning a deep copy of value.
+    Lists and dicts of simple values are rebuilt directly, so only exotic
+    values need copy.deepcopy.'''
+    if isinstance(value, _immutable_types):
+        return lambda: value
+    if type(value) is list:
+        copiers = [ _copier(v) for v in value ]
+        if all(isinstance(v, _immutable_types) for v in value):
+            return lambda: value[:]
+        return lambda: [ copy() for copy in copiers ]
+    if type(value) in (dict, BaseObject):
+        cls = type(value)
+        copiers = [ (k, _copier(v)) for k, v in value.iteritems() ]
+        if all(isinstance(v, _immutable_types) for v in value.itervalues()):
+            return lambda: cls(value)
+        return lambda: cls((k, copy()) for k, copy in copiers)
+    return lambda: deepcopy(value)
+
+def _interpreted(validate, kw):
+    '''Call an uncompiled validate method.  Those know nothing of the safe
+    option, so the value is made safe for BSON up front.'''
+    safe = kw.get('safe')
+    kw = dict(allow_extra=kw['allow_extra'], strip_extra=kw['strip_extra'])
+    if safe:
+        return lambda value: validate(_make_safe(value), **kw)
+    return lambda value: validate(value, **kw)
+
+def _child_kw(kw, name):
+    'The compile options for the field name of a schema compiled with kw'
+    if '_path' not in kw: return kw
+    if kw['_path']:
+        name = '%s.%s' % (kw['_path'], name)
+    return dict(kw, _path=name)
+
 class Migrate(SchemaItem):
     '''Use when migrating from one field type to another
     '''
@@ -136,6 +251,21 @@ class Migrate(SchemaItem):
             value = self.migration_function(value)
             return self.new.validate(value, **kw)
 
+    def _compile(self, kw):
+        if not self._validates_with(Migrate, 'validate'):
+            return SchemaItem._compile(self, kw)
+        new = self.new.compiled(**kw)
+        old = self.old.compiled(**kw)
+        migration_function = self.migration_function
+        def validate(value):
+            try:
+                return new(value)
+            except Invalid:
+                value = old(value)
+                value = migration_function(value)
+                return new(value)
+        return validate
+
     @classmethod
     def obj_to_list(cls, key_name, value_name=None):
         '''Migration function to go from object ``{ key: value }`` to
@@ -165,6 +295,11 @@ class Deprecated(SchemaItem):
             pass
         return Missing
 
+    def _compile(self, kw):
+        if not self._validates_with(Deprecated, 'validate'):
+            return SchemaItem._compile(self, kw)
+        return lambda value: Missing
+
 class FancySchemaItem(SchemaItem):
     '''Simple SchemaItem wrapper providing required and if_missing fields.
 
@@ -222,13 +357,82 @@ class FancySchemaItem(SchemaItem):
             elif self.if_missing is Missing:
                 return self.if_missing
             else:
-                return deepcopy(self.if_missing) # handle mutable defaults
+                return self._copy_if_missing() # handle mutable defaults
         if value == self.if_missing:
             return value
         return self._validate(value, **kw)
 
     def _validate(self, value, **kw): return value
 
+    def _compile(self, kw):
+        dispatch = getattr(self.validate, 'im_func', None)
+        l_Missing = Missing
+        if dispatch is FancySchemaItem._validate_required.im_func:
+            core = self._compile_checked(kw)
+            def validate(value):
+                if value is l_Missing:
+                    raise Invalid('Missing field', value, None)
+                return core(value)
+        elif dispatch is FancySchemaItem._validate_fast_missing.im_func:
+            core = self._compile_checked(kw)
+            if_missing = self.if_missing
+            def validate(value):
+                if value is l_Missing or value == if_missing:
+                    return if_missing
+                return core(value)
+        elif dispatch is FancySchemaItem._validate_optional.im_func:
+            core = self._compile_checked(kw)
+            if_missing = self.if_missing
+            make_default = self._compile_if_missing()
+            if kw.get('safe'):
+                # defaults, and values equal to them, bypass core
+                unsafe_default = make_default
+                make_default = lambda: _make_safe(unsafe_default())
+                safe = _make_safe
+            else:
+                safe = _identity
+            def validate(value):
+                if value is l_Missing:
+                    return make_default()
+                if value == if_missing:
+                    return safe(value)
+                return core(value)
+        else:
+            return SchemaItem._compile(self, kw)
+        return validate
+
+    def _compile_checked(self, kw):
+        '''_compile_validate, making scalars safe for BSON first if kw asks
+        for it (Object and Array check their contents themselves)'''
+        core = self._compile_validate(kw)
+        if not kw.get('safe') or isinstance(self, (Object, Array)):
+            return core
+        if core is _identity:
+            return _make_safe
+        return lambda value: core(_make_safe(value))
+
+    @LazyProperty
+    def _copy_if_missing(self):
+        return _copier(self.if_missing)
+
+    def _compile_if_missing(self):
+        'Return a function of no arguments building the if_missing value'
+        if_missing = self.if_missing
+        if if_missing == []:
+            return list
+        elif self._callable_if_missing:
+            return if_missing
+        elif if_missing is Missing:
+            return lambda: Missing
+        else:
+            return _copier(if_missing)
+
+    def _compile_validate(self, kw):
+        'Return a function validating a value known not to be Missing'
+        if self._validates_with(FancySchemaItem):
+            return _identity
+        return _interpreted(self._validate, kw)
+
 class Anything(FancySchemaItem):
     'Anything goes - always passes validation unchanged except dict=>Object'
 
@@ -265,10 +469,25 @@ class Object(FancySchemaItem):
         return '\n'.join(l) 
 
     def if_missing(self):
-        return BaseObject(
-            (k, v.validate(Missing))
-            for k,v in self.fields.iteritems()
-            if isinstance(k, basestring))
+        cache = self._get_compiled_cache()
+        try:
+            make_default = cache['if_missing']
+        except KeyError:
+            make_default = cache['if_missing'] = self._compile_if_missing()
+        return make_default()
+
+    def _compile_if_missing(self):
+        if not self._validates_with(Object, 'if_missing'):
+            return super(Object, self)._compile_if_missing()
+        # Build the default from the fields' compiled validators
+        l_Missing = Missing
+        defaults = [ (k, v.compiled())
+                     for k,v in self.fields.iteritems()
+                     if isinstance(k, basestring) ]
+        def make_default():
+            return BaseObject(
+                [ (k, validate(l_Missing)) for k, validate in defaults ])
+        return make_default
 
     def _validate_homogenous(self, name, field, d, **kw):
         if not isinstance(d, dict): raise Invalid('notdict: %s' % (d,), d, None)
@@ -335,9 +554,93 @@ class Object(FancySchemaItem):
                 raise Invalid('Extra keys: %r' % extra_keys, d, None)
         return result
 
+    def _compile_validate(self, kw):
+        if '_validate' in self.__dict__:
+            # homogenous object, see __init__
+            (name, field), = self.fields.items()
+            return self._compile_homogenous(name, field, kw)
+        if not self._validates_with(Object):
+            return super(Object, self)._compile_validate(kw)
+        return self._compile_object(kw, BaseObject)
+
+    def _compile_homogenous(self, name, field, kw):
+        l_Missing = Missing
+        validate_name = SchemaItem.make(name).compiled(**kw)
+        validate_value = field.compiled(**_child_kw(kw, '*'))
+        def validate(d):
+            if not isinstance(d, dict): raise Invalid('notdict: %s' % (d,), d, None)
+            to_set = []
+            errors = []
+            for k,v in d.iteritems():
+                try:
+                    k = validate_name(k)
+                    v = validate_value(v)
+                    if v is not l_Missing:
+                        to_set.append((k,v))
+                except Invalid, inv:
+                    errors.append((name, inv))
+            if errors:
+                error_dict = dict(errors)
+                msg = '\n'.join('%s:%s' % t for t in error_dict.iteritems())
+                raise Invalid(msg, d, None, error_dict=error_dict)
+            return BaseObject(to_set)
+        return validate
+
+    def _compile_object(self, kw, make_result):
+        '''Return a function validating a dict against self.fields; the
+        validated (key, value) pairs are passed to make_result'''
+        l_Missing = Missing
+        fields = [ (name, field.compiled(**_child_kw(kw, name)))
+                   for name, field in self.field_items ]
+        field_names = frozenset(self.fields)
+        allow_extra = kw['allow_extra']
+        copy_extra = allow_extra and not kw['strip_extra']
+        safe = kw.get('safe', False)
+        def validate(d):
+            if not isinstance(d, dict): raise Invalid('notdict: %s' % (d,), d, None)
+            if copy_extra and safe:
+                to_set = [ (k, _make_safe(v)) for k,v in d.iteritems()
+                           if k not in field_names ]
+            elif copy_extra:
+                to_set = d.items()
+            else:
+                to_set = []
+            get = d.get
+            # try common case (no Invalid)
+            try:
+                validated = [
+                    (name, field(get(name, l_Missing)))
+                    for name, field in fields ]
+            except Invalid:
+                # Go back and re-scan for the invalid items
+                errors = []
+                for name, field in fields:
+                    try:
+                        field(get(name, l_Missing))
+                    except Invalid, inv:
+                        errors.append((name, inv))
+                error_dict = dict(errors)
+                msg = '\n'.join('%s:%s' % t for t in errors)
+                raise Invalid(msg, d, None, error_dict=error_dict)
+            to_set.extend(
+                (name, value) for name, value in validated
+                if value is not l_Missing)
+            result = make_result(to_set)
+            if not allow_extra:
+                try:
+                    extra_keys = set(d.iterkeys()) - field_names
+                except AttributeError, ae:
+                    raise Invalid(str(ae), d, None)
+                if extra_keys:
+                    raise Invalid('Extra keys: %r' % extra_keys, d, None)
+            return result
+        return validate
+
     def extend(self, other):
         if other is None: return
         self.fields.update(other.fields)
+        self.__dict__.pop('field_items', None)
+        self.invalidate_compiled()
 
 class Document(Object):
     '''Used for dict-like validation, adding polymorphic validation (which means that
@@ -382,7 +685,36 @@ class Document(Object):
         return cls.m.make(
             d, allow_extra=allow_extra, strip_extra=strip_extra)
 
+    def _compile_validate(self, kw):
+        if ('_validate' in self.__dict__
+            or not self._validates_with(Document)
+            or not self._validates_with(Document, 'get_polymorphic_cls')
+            or self.managed_class is None):
+            return super(Document, self)._compile_validate(kw)
+        managed_class = self.managed_class
+        def make_result(to_set):
+            result = managed_class.__new__(managed_class)
+            result.update(to_set)
+            return result
+        validate_object = self._compile_object(kw, make_result)
+        if self.polymorphic_registry is None:
+            return validate_object
+        get_polymorphic_cls = self.get_polymorphic_cls
+        def validate(d):
+            cls = get_polymorphic_cls(d)
+            if cls == managed_class:
+                return validate_object(d)
+            return cls.m.make(
+                d, allow_extra=kw['allow_extra'],
+                strip_extra=kw['strip_extra'], safe=kw.get('safe', False))
+        return validate
+
+    def _collection_name(self):
+        if self.managed_class is None: return None
+        return self.managed_class.m.collection_name
+
     def set_polymorphic(self, field, registry, identity):
+        self.invalidate_compiled()
         self.polymorphic_on = field
         self.polymorphic_registry = registry
         if self.polymorphic_on:
@@ -443,7 +775,32 @@ class Array(FancySchemaItem):
                         for i,v in enumerate(error_list)
                         if v is not None)
         raise Invalid(msg, d, None, error_list=error_list)
-        
+
+    def _compile_validate(self, kw):
+        if (getattr(self._validate, 'im_func', None)
+            is not Array.__dict__['_full_validate']):
+            return super(Array, self)._compile_validate(kw)
+        validate_item = self.field_type.compiled(**kw)
+        def validate(d):
+            if not isinstance(d, (list, tuple)):
+                raise Invalid('Not a list or tuple', d, None)
+            # try common case (no Invalid)
+            try:
+                return [ validate_item(value) for value in d ]
+            except Invalid:
+                pass
+            # Find the invalid values
+            error_list = [ None ] * len(d)
+            for i, value in enumerate(d):
+                try:
+                    validate_item(value)
+                except Invalid, inv:
+                    error_list[i] = inv
+            msg = '\n'.join(('[%s]:%s' % (i,v))
+                            for i,v in enumerate(error_list)
+                            if v is not None)
+            raise Invalid(msg, d, None, error_list=error_list)
+        return validate
 
 class Scalar(FancySchemaItem):
     '''Validate that a value is NOT an array or dict'''
@@ -453,6 +810,15 @@ class Scalar(FancySchemaItem):
             raise Invalid('%r is not a scalar' % value, value, None)
         return value
 
+    def _compile_validate(self, kw):
+        if not self._validates_with(Scalar):
+            return super(Scalar, self)._compile_validate(kw)
+        def validate(value):
+            if isinstance(value, (tuple, list, dict)):
+                raise Invalid('%r is not a scalar' % value, value, None)
+            return value
+        return validate
+
 class ParticularScalar(Scalar):
     '''Validate that a value is NOT an array or dict and is a particular type
     '''
@@ -464,6 +830,16 @@ class ParticularScalar(Scalar):
                           value, None)
         return value
 
+    def _compile_validate(self, kw):
+        if not self._validates_with(ParticularScalar):
+            return super(ParticularScalar, self)._compile_validate(kw)
+        type_ = self.type
+        def validate(value):
+            if value is None or isinstance(value, type_): return value
+            raise Invalid('%s is not a %r' % (value, type_),
+                          value, None)
+        return validate
+
 class OneOf(ParticularScalar):
     def __init__(self, *options, **kwargs):
         self.options = options
@@ -475,6 +851,17 @@ class OneOf(ParticularScalar):
                           value, None)
         return value
 
+    def _compile_validate(self, kw):
+        if not self._validates_with(OneOf):
+            return super(OneOf, self)._compile_validate(kw)
+        options = self.options
+        def validate(value):
+            if value not in options:
+                raise Invalid('%s is not in %r' % (value, options),
+                              value, None)
+            return value
+        return validate
+
 class Value(FancySchemaItem):
     '''Validate that a value is equal'''
     if_missing=None
@@ -488,6 +875,17 @@ class Value(FancySchemaItem):
                           value, None)
         return value
 
+    def _compile_validate(self, kw):
+        if not self._validates_with(Value):
+            return super(Value, self)._compile_validate(kw)
+        expected = self.value
+        def validate(value):
+            if value != expected:
+                raise Invalid('%r != %r' % (value, expected),
+                              value, None)
+            return value
+        return validate
+
 class String(ParticularScalar):
     type=basestring
 class Int(ParticularScalar):
@@ -496,6 +894,18 @@ class Int(ParticularScalar):
         if isinstance(value, float) and round(value) == value:
             value = int(value)
         return super(Int, self)._validate(value, **kw)
+
+    def _compile_validate(self, kw):
+        if not self._validates_with(Int):
+            return super(ParticularScalar, self)._compile_validate(kw)
+        type_ = self.type
+        def validate(value):
+            if isinstance(value, float) and round(value) == value:
+                value = int(value)
+            if value is None or isinstance(value, type_): return value
+            raise Invalid('%s is not a %r' % (value, type_),
+                          value, None)
+        return validate
 class Float(ParticularScalar):
     type=(float,int,long)
 class DateTimeTZ(ParticularScalar):
@@ -511,6 +921,21 @@ class DateTime(DateTimeTZ):
         value = value.replace(microsecond=(value.microsecond // 1000) * 1000,
                               tzinfo=None)
         return value
+
+    def _compile_validate(self, kw):
+        if not self._validates_with(DateTime):
+            return super(ParticularScalar, self)._compile_validate(kw)
+        type_ = self.type
+        def validate(value):
+            if value is None: return value
+            if not isinstance(value, type_):
+                raise Invalid('%s is not a %r' % (value, type_),
+                              value, None)
+            # Truncate microseconds and keep milliseconds only (mimics BSON datetime)
+            return value.replace(
+                microsecond=(value.microsecond // 1000) * 1000,
+                tzinfo=None)
+        return validate
 class Bool(ParticularScalar):
     type=bool
 class Binary(ParticularScalar):
@@ -543,3 +968,58 @@ SHORTHAND={
     datetime:DateTime}
     
 
+
+class ValidationProfiler(object):
+    '''Counts the calls, time, and Invalid results of each part of the
+    schemas validated while it is enabled, keyed by (collection, dotted
+    field path, SchemaItem class name).  Times include the nested fields.
+    The counts are not locked, so they may be slightly off when validating
+    in several threads.'''
+
+    def __init__(self):
+        self._stats = {}
+
+    def wrap(self, key, validate):
+        stats = self._stats.setdefault(key, [0, 0.0, 0])
+        l_time = time.time
+        def profiled(value):
+            begin = l_time()
+            try:
+                return validate(value)
+            except Invalid:
+                stats[2] += 1
+                raise
+            finally:
+                stats[0] += 1
+                stats[1] += l_time() - begin
+        return profiled
+
+    def report(self):
+        'The stats of the parts validated, most time first'
+        result = [
+            dict(collection=collection, path=path, type=type_name,
+                 calls=calls, time=elapsed, invalid=invalid)
+            for (collection, path, type_name), (calls, elapsed, invalid)
+            in self._stats.items()
+            if calls ]
+        result.sort(key=lambda r: -r['time'])
+        return result
+
+    def reset(self):
+        for stats in self._stats.values():
+            stats[:] = [0, 0.0, 0]
+
+_profiler = None
+
+def enable_profiling(profiler=None):
+    '''Time the validation done by compiled schemas (including
+    Document.make and Session reads and writes) until disable_profiling is
+    called.  Returns the ValidationProfiler used.'''
+    global _profiler
+    if profiler is None: profiler = ValidationProfiler()
+    _profiler = profiler
+    return profiler
+
+def disable_profiling():
+    global _profiler
+    _profiler = None
@@ -2,11 +2,14 @@ from __future__ import absolute_import
 import logging
 from functools import update_wrapper
 
+import bson
 import pymongo
 import pymongo.errors
 
 from .base import Cursor, Object
 from .utils import fixup_index
+from .profiling import QueryRecord, null_record
+from .datastore import DataStore
 from . import exc
 
 log = logging.getLogger(__name__)
@@ -23,12 +26,29 @@ def annotate_doc_failure(func):
             raise
     return update_wrapper(wrapper, func)
 
+def report_connection_failure(func):
+    '''Decorator to wrap a session operation so that connection failures are
+    reported to the bind (see ming.datastore.Engine.connection_failed)
+    '''
+    def wrapper(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        except pymongo.errors.ConnectionFailure, e:
+            self._connection_failed(e)
+            raise
+    return update_wrapper(wrapper, func)
+
 class Session(object):
     _registry = {}
     _datastores = {}
+    # Maximum total BSON size of the documents sent in one insert_many call
+    insert_batch_bytes = 16 * 1024 * 1024
 
-    def __init__(self, bind=None):
+    def __init__(self, bind=None, profilers=None):
+        '''profilers are notified of each operation (see ming.profiling)'''
+        if profilers is None: profilers = []
         self.bind = bind
+        self.profilers = profilers
 
     @classmethod
     def by_name(cls, name):
@@ -39,34 +59,66 @@ class Session(object):
         return result
 
     def _impl(self, cls):
-        try:
-            return self.db[cls.m.collection_name]
-        except TypeError:
+        name = cls.m.collection_name
+        if isinstance(self.bind, DataStore):
+            coll = self.bind.collection(name)
+        else:
+            try:
+                coll = self.db[name]
+            except TypeError:
+                coll = None
+        if coll is None:
             raise exc.MongoGone, 'MongoDB is not connected'
+        return coll
 
     @property
     def db(self):
         return self.bind.db
 
+    def _connection_failed(self, error):
+        report = getattr(self.bind, 'connection_failed', None)
+        if report is not None: report(error)
+
+    def _profile(self, operation, cls, spec=None):
+        '''A QueryRecord for the operation if there are profilers, otherwise
+        a stand-in that does nothing'''
+        if not self.profilers: return null_record
+        return QueryRecord(
+            operation, cls.m.collection_name, spec, self.profilers)
+
+    # Documents are decoded by the driver straight into Objects (nested
+    # documents included), so they never need Object.from_bson
+
+    @report_connection_failure
     def get(self, cls, **kwargs):
-        bson = self._impl(cls).find_one(kwargs)
-        if bson is None: return None
-        return cls.make(bson, allow_extra=True, strip_extra=True)
+        with self._profile('get', cls, kwargs) as record:
+            bson = self._impl(cls).find_one(kwargs, as_class=Object)
+            if bson is None: return None
+            record.documents = 1
+            return record.validate(
+                cls.make, bson, allow_extra=True, strip_extra=True,
+                skip_from_bson=True)
 
     def find(self, cls, *args, **kwargs):
         allow_extra=kwargs.pop('allow_extra', True)
         strip_extra=kwargs.pop('strip_extra', True)
         validate=kwargs.pop('validate', True)
         collection = self._impl(cls)
+        cursor = collection.find(as_class=Object, *args, **kwargs)
         if not validate:
-            return (
-                cls(o, skip_from_bson=True)
-                for o in collection.find(as_class=Object, *args, **kwargs))
-        cursor = collection.find(*args, **kwargs)
-        return Cursor(cls, cursor,
-                      allow_extra=allow_extra,
-                      strip_extra=strip_extra)
+            result = Cursor(cls, cursor, validate=False)
+        else:
+            result = Cursor(cls, cursor,
+                            allow_extra=allow_extra,
+                            strip_extra=strip_extra)
+        if self.profilers:
+            if args: spec = args[0]
+            else: spec = kwargs.get('spec')
+            result.profile(self._profile('find', cls, spec))
+        result.on_connection_failure(self._connection_failed)
+        return result
 
+    @report_connection_failure
     def remove(self, cls, *args, **kwargs):
         if 'safe' not in kwargs:
             kwargs['safe'] = True
@@ -74,14 +126,19 @@ class Session(object):
             if kwarg not in ('spec_or_id', 'safe'):
                 raise ValueError("Unexpected kwarg %s.  Did you mean to pass a dict?  If only sent kwargs, pymongo's remove()"
                                  " would've emptied the whole collection.  Which we're pretty sure you don't want." % kwarg)
-        self._impl(cls).remove(*args, **kwargs)
+        if args: spec = args[0]
+        else: spec = kwargs.get('spec_or_id')
+        with self._profile('remove', cls, spec):
+            self._impl(cls).remove(*args, **kwargs)
 
     def find_by(self, cls, **kwargs):
         return self.find(cls, kwargs)
 
+    @report_connection_failure
     def count(self, cls):
         return self._impl(cls).count()
 
+    @report_connection_failure
     def ensure_index(self, cls, fields, **kwargs):
         index_fields = fixup_index(fields)
         return self._impl(cls).ensure_index(index_fields, **kwargs), fields
@@ -91,66 +148,124 @@ class Session(object):
             self.ensure_index(cls, idx.index_spec, unique=idx.unique,
                     sparse=idx.sparse)
 
+    @report_connection_failure
     def group(self, cls, *args, **kwargs):
         return self._impl(cls).group(*args, **kwargs)
 
+    @report_connection_failure
     def update_partial(self, cls, spec, fields, upsert=False, **kw):
-        return self._impl(cls).update(spec, fields, upsert, safe=True, **kw)
+        with self._profile('update_partial', cls, spec):
+            return self._impl(cls).update(spec, fields, upsert, safe=True, **kw)
 
+    @report_connection_failure
     def find_and_modify(self, cls, query=None, sort=None, new=False, **kw):
         if query is None: query = {}
         if sort is None: sort = {}
         options = dict(kw, query=query, sort=sort, new=new)
-        bson = self._impl(cls).find_and_modify(**options)
-        if bson is None: return None
-        return cls.make(bson)
+        with self._profile('find_and_modify', cls, query) as record:
+            bson = self._impl(cls).find_and_modify(**options)
+            if bson is None: return None
+            record.documents = 1
+            return record.validate(cls.make, bson)
 
-    def _prep_save(self, doc, validate):
-        hook = doc.m.before_save
+    def _prep_save(self, doc, validate, record=null_record):
+        m = doc.m
+        hook = m.before_save
         if hook: hook(doc)
         if validate:
-            doc.make_safe()
-            if doc.m.schema is None:
+            schema = m.schema
+            if schema is None:
+                doc.make_safe()
                 data = dict(doc)
             else:
-                data = doc.m.schema.validate(doc)
+                # checks the document is safe for BSON as it validates
+                data = record.validate(schema.compiled(safe=True), doc)
             doc.update(data)
         else:
             data =dict(doc)
         return data
 
+    @report_connection_failure
     @annotate_doc_failure
     def save(self, doc, *args, **kwargs):
-        data = self._prep_save(doc, kwargs.pop('validate', True))
-        if args:
-            values = dict((arg, data[arg]) for arg in args)
-            result = self._impl(doc).update(
-                dict(_id=doc._id), {'$set':values}, safe=kwargs.get('safe', True))
-        else:
-            result = self._impl(doc).save(data, safe=kwargs.get('safe', True))
+        with self._profile('save', doc, dict(_id=doc.get('_id'))) as record:
+            data = self._prep_save(doc, kwargs.pop('validate', True), record)
+            if args:
+                values = dict((arg, data[arg]) for arg in args)
+                result = self._impl(doc).update(
+                    dict(_id=doc._id), {'$set':values}, safe=kwargs.get('safe', True))
+            else:
+                result = self._impl(doc).save(data, safe=kwargs.get('safe', True))
+            record.documents = 1
         if result and '_id' not in doc:
             doc._id = result
 
+    @report_connection_failure
     @annotate_doc_failure
     def insert(self, doc, **kwargs):
-        data = self._prep_save(doc, kwargs.pop('validate', True))
-        bson = self._impl(doc).insert(data, safe=kwargs.get('safe', True))
+        with self._profile('insert', doc) as record:
+            data = self._prep_save(doc, kwargs.pop('validate', True), record)
+            bson = self._impl(doc).insert(data, safe=kwargs.get('safe', True))
+            record.documents = 1
         if bson and '_id' not in doc:
             doc._id = bson
 
+    @report_connection_failure
+    def insert_many(self, docs, **kwargs):
+        '''Validate and insert a batch of documents (possibly of different
+        classes).  Each collection's documents are sent in as few insert
+        calls as insert_batch_bytes allows.  Returns the list of _ids.'''
+        validate = kwargs.pop('validate', True)
+        safe = kwargs.get('safe', True)
+        batch_bytes = kwargs.get('batch_bytes', self.insert_batch_bytes)
+        docs = list(docs)
+        batches = {} # collection name => [ (doc, data) ]
+        records = {} # collection name => QueryRecord
+        order = []
+        for doc in docs:
+            name = doc.m.collection_name
+            if name not in batches:
+                batches[name] = []
+                records[name] = self._profile('insert_many', doc)
+                order.append(name)
+            data = self._prep_save(doc, validate, records[name])
+            batches[name].append((doc, data))
+        ids = {}
+        for name in order:
+            batch = batches[name]
+            impl = self._impl(batch[0][0])
+            with records[name] as record:
+                for chunk in _chunk_by_size(batch, batch_bytes):
+                    result = impl.insert(
+                        [ data for doc, data in chunk ], safe=safe)
+                    for (doc, data), _id in zip(chunk, result):
+                        if '_id' not in doc:
+                            doc._id = _id
+                        ids[id(doc)] = _id
+                record.documents = len(batch)
+        return [ ids[id(doc)] for doc in docs ]
+
+    @report_connection_failure
     @annotate_doc_failure
     def upsert(self, doc, spec_fields, **kwargs):
-        self._prep_save(doc, kwargs.pop('validate', True))
         if type(spec_fields) != list:
             spec_fields = [spec_fields]
-        self._impl(doc).update(dict((k,doc[k]) for k in spec_fields),
-                               doc,
-                               upsert=True,
-                               safe=True)
+        with self._profile('upsert', doc) as record:
+            self._prep_save(doc, kwargs.pop('validate', True), record)
+            spec = dict((k,doc[k]) for k in spec_fields)
+            record.spec = spec
+            self._impl(doc).update(spec,
+                                   doc,
+                                   upsert=True,
+                                   safe=True)
+            record.documents = 1
 
+    @report_connection_failure
     @annotate_doc_failure
     def delete(self, doc):
-        self._impl(doc).remove({'_id':doc._id}, safe=True)
+        with self._profile('delete', doc, {'_id':doc._id}) as record:
+            self._impl(doc).remove({'_id':doc._id}, safe=True)
+            record.documents = 1
 
     def _set(self, doc, key_parts, value):
         if len(key_parts) == 0:
@@ -160,6 +275,7 @@ class Session(object):
         else:
             self._set(doc[key_parts[0]], key_parts[1:], value)
 
+    @report_connection_failure
     @annotate_doc_failure
     def set(self, doc, fields_values):
         """
@@ -173,6 +289,7 @@ class Session(object):
         impl = self._impl(doc)
         impl.update({'_id':doc._id}, {'$set':fields_values}, safe=True)
 
+    @report_connection_failure
     @annotate_doc_failure
     def increase_field(self, doc, **kwargs):
         """
@@ -200,11 +317,37 @@ class Session(object):
             safe = True,
         )
 
+    @report_connection_failure
     def index_information(self, cls):
         return self._impl(cls).index_information()
 
+    @report_connection_failure
     def drop_indexes(self, cls):
         try:
             return self._impl(cls).drop_indexes()
         except:
             pass
+
+# Only one document in this many is encoded to measure it for
+# _chunk_by_size, as pymongo encodes every document again to send it
+_SIZE_SAMPLE = 16
+
+def _encoded_size(data):
+    return len(bson.BSON.encode(data))
+
+def _chunk_by_size(batch, max_bytes):
+    '''Split a list of (doc, data) pairs into chunks whose encoded data
+    totals roughly max_bytes at most (a larger document gets a chunk to
+    itself).  Documents that are not measured are taken to be as large as
+    the largest one measured so far.'''
+    chunk, size, doc_size = [], 0, 0
+    for i, (doc, data) in enumerate(batch):
+        if i % _SIZE_SAMPLE == 0:
+            doc_size = max(doc_size, _encoded_size(data))
+        if chunk and size + doc_size > max_bytes:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append((doc, data))
+        size += doc_size
+    if chunk:
+        yield chunk
@@ -0,0 +1,55 @@
+from unittest import TestCase
+from threading import Event
+
+from ming import datastore as DS
+from ming import Session, collection, Field
+from ming.odm import ODMSession
+from ming.odm.asyncsession import AsyncODMSession
+
+class TestAsyncODMSession(TestCase):
+
+    def setUp(self):
+        self.datastore = DS.DataStore('mim:///', database='test_db')
+        odm_session = ODMSession(Session(bind=self.datastore))
+        self.session = AsyncODMSession(odm_session)
+        basic = collection(
+            'basic', odm_session.impl,
+            Field('_id', int),
+            Field('a', int))
+        class Basic(object): pass
+        odm_session.mapper(Basic, basic)
+        self.Basic = Basic
+        for i in range(5):
+            Basic(_id=i, a=i)
+        self.session.flush().get()
+        odm_session.clear()
+
+    def tearDown(self):
+        self.session.close()
+        self.datastore.conn.drop_all()
+
+    def test_find_and_flush(self):
+        cursor = self.session.find(self.Basic, batch_size=2).get()
+        objs = list(cursor)
+        self.assertEqual([ o._id for o in objs ], range(5))
+        self.assert_(self.session.get(self.Basic, 3).get() is objs[3])
+        objs[3].a = 30
+        self.session.flush().get()
+        self.assertEqual(self.datastore.db.basic.find_one({'_id':3})['a'], 30)
+
+    def test_find_and_modify(self):
+        obj = self.session.find_and_modify(
+            self.Basic, query={'_id':1}, update={'$set':{'a':10}},
+            new=True).get()
+        self.assertEqual(obj.a, 10)
+
+    def test_callback_waits(self):
+        results = []
+        done = Event()
+        def callback(cursor):
+            # waits for another operation from inside a callback
+            results.append(self.session.get(self.Basic, 1).get(5))
+            done.set()
+        self.session.find(self.Basic, callback=callback)
+        self.assert_(done.wait(10))
+        self.assertEqual(results[0]._id, 1)
@@ -1,3 +1,5 @@
+import gc
+import weakref
 from unittest import TestCase
 
 from mock import Mock
@@ -6,7 +8,7 @@ from ming import datastore as DS
 from ming import schema as S
 from ming import collection, Field, Session
 from ming.base import Object
-from ming.odm import ODMSession, mapper, state, Mapper
+from ming.odm import ODMSession, mapper, state, Mapper, SessionExtension
 from ming.odm import ForeignIdProperty, RelationProperty
 from ming.odm.icollection import InstrumentedList, InstrumentedObj
 
@@ -164,8 +166,424 @@ class TestBasicMapping(TestCase):
         self.session.expunge(doc)
         self.session.expunge(doc)
         self.session.expunge(doc)
-        
-        
+
+    def test_incremental_flush(self):
+        for i in range(5):
+            self.Basic(a=i, b=[], c=dict(d=1, e=2))
+        self.session.flush()
+        self.session.clear()
+        objs = self.Basic.query.find().sort('a').all()
+        uow = self.session.uow
+        self.assertEqual(len(uow._pending), 0)
+        self.assertEqual(len(list(uow.clean)), 5)
+        objs[1].a = 10
+        objs[2].delete()
+        self.assertEqual(list(uow.dirty), [ objs[1] ])
+        self.assertEqual(list(uow.deleted), [ objs[2] ])
+        self.session.update_now = Mock(side_effect=self.session.update_now)
+        self.session.flush()
+        self.assertEqual(self.session.update_now.call_count, 1)
+        self.assertEqual(len(uow._pending), 0)
+        self.assertEqual(len(list(uow.clean)), 4)
+        self.assertEqual(self.session.imap.get(self.Basic, objs[2]._id), None)
+        for i in (0, 1, 3, 4):
+            self.assert_(
+                self.session.imap.get(self.Basic, objs[i]._id) is objs[i])
+        self.assertEqual(self.Basic.query.find(dict(a=10)).count(), 1)
+
+    def test_stream(self):
+        for i in range(5):
+            self.Basic(a=i, b=[i], c=dict(d=1, e=2))
+        self.session.flush()
+        self.session.clear()
+        gc.disable()
+        try:
+            refs = []
+            for obj in self.Basic.query.find().sort('a').stream(batch_size=2):
+                refs.append(weakref.ref(obj))
+                self.assertEqual(type(obj.b), list)
+                obj.a = 10
+            del obj
+            self.assertEqual([ r() for r in refs ], [ None ] * 5)
+        finally:
+            gc.enable()
+        self.assertEqual(len(self.session.imap._objects), 0)
+        self.assertEqual(len(self.session.uow._objects), 0)
+        self.session.flush()
+        self.assertEqual(self.Basic.query.find(dict(a=10)).count(), 0)
+        objs = list(self.Basic.query.find().sort('a').stream(instrument=True))
+        self.assertEqual([ o.a for o in objs ], range(5))
+        self.assertEqual(type(objs[0].b), InstrumentedList)
+
+    def test_prefetch(self):
+        for i in range(5):
+            self.Basic(a=i, b=[i], c=dict(d=1, e=2))
+        self.session.flush()
+        self.session.clear()
+        cursor = self.Basic.query.find().sort('a').prefetch(batch_size=2)
+        objs = list(cursor)
+        self.assertEqual([ o.a for o in objs ], range(5))
+        self.assertEqual(type(objs[0].b), InstrumentedList)
+        self.assert_(self.Basic.query.get(_id=objs[0]._id) is objs[0])
+        objs[0].a = 10
+        self.session.flush()
+        self.assertEqual(self.basic.m.find(dict(a=10)).count(), 1)
+        cursor = self.Basic.query.find().prefetch(batch_size=2)
+        cursor.first()
+        thread = cursor.ming_cursor._prefetcher.thread
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_original_document(self):
+        self.Basic(a=1, b=[], c=dict(d=1, e=2))
+        self.session.flush()
+        self.session.clear()
+        obj = self.Basic.query.get(a=1)
+        st = state(obj)
+        self.assertEqual(st.original_document['a'], 1)
+        self.assertRaises(AttributeError, setattr, st, 'other', 1)
+        self.assertEqual(st._extra_state, None)
+        session = Session(bind=self.datastore)
+        basic1 = collection(
+            'basic', session,
+            Field('_id', S.ObjectId),
+            Field('a', int))
+        class Basic1(object): pass
+        self.session.mapper(
+            Basic1, basic1, options=dict(original_document=False))
+        obj = Basic1.query.get(a=1)
+        self.assertEqual(state(obj).original_document, None)
+        self.assertRaises(
+            ValueError, obj.query.update_if_not_modified, {'a':2})
+
+    def test_batched_insert(self):
+        calls = []
+        class Extension(SessionExtension):
+            def before_insert(self, obj, st):
+                calls.append(('before', obj.a))
+            def after_insert(self, obj, st):
+                calls.append(('after', obj.a))
+        self.session.extensions.append(Extension(self.session))
+        impl = self.datastore.db.basic
+        impl.insert = Mock(side_effect=impl.insert)
+        docs = [ self.Basic(a=i, b=[], c=dict(d=1, e=2)) for i in range(3) ]
+        self.session.flush()
+        self.assertEqual(impl.insert.call_count, 1)
+        self.assertEqual(len(impl.insert.call_args[0][0]), 3)
+        self.assertEqual(sorted(calls), sorted(
+                [ ('before', i) for i in range(3) ] +
+                [ ('after', i) for i in range(3) ]))
+        for doc in docs:
+            self.assertEqual(state(doc).status, state(doc).clean)
+        self.session.clear()
+        self.assertEqual(self.Basic.query.find().count(), 3)
+
+    def test_flush_order(self):
+        calls = []
+        class Extension(SessionExtension):
+            def before_insert(self, obj, st):
+                calls.append(('insert', obj.a))
+            def before_update(self, obj, st):
+                calls.append(('update', obj.a))
+            def before_delete(self, obj, st):
+                calls.append(('delete', obj.a))
+        self.session.extensions.append(Extension(self.session))
+        docs = [ self.Basic(a=i, b=[], c=dict(d=1, e=2)) for i in range(4) ]
+        self.session.flush()
+        del calls[:]
+        docs[0].a = 10
+        docs[1].delete()
+        docs[2].a = 12
+        docs += [ self.Basic(a=i, b=[], c=dict(d=1, e=2)) for i in (4, 5) ]
+        self.session.flush()
+        self.assertEqual(sorted(calls[:2]), [ ('insert', 4), ('insert', 5) ])
+        self.assertEqual(sorted(calls[2:]), [
+                ('delete', 1), ('update', 10), ('update', 12) ])
+
+    def test_insert_override(self):
+        m = mapper(self.Basic)
+        m.insert = Mock(side_effect=m.insert)
+        docs = [ self.Basic(a=i, b=[], c=dict(d=1, e=2)) for i in range(3) ]
+        self.session.flush()
+        self.assertEqual(m.insert.call_count, 3)
+        for doc in docs:
+            self.assertEqual(state(doc).status, state(doc).clean)
+        self.session.clear()
+        self.assertEqual(self.Basic.query.find().count(), 3)
+
+class TestDirtyFields(TestCase):
+
+    def setUp(self):
+        self.datastore = DS.DataStore(
+            'mim:///', database='test_db')
+        session = Session(bind=self.datastore)
+        self.session = ODMSession(session)
+        basic = collection(
+            'basic', session,
+            Field('_id', S.ObjectId),
+            Field('a', int),
+            Field('b', [int]),
+            Field('c', dict(d=int, e=int)),
+            Field('f', int, if_missing=S.Missing))
+        class Basic(object):
+            pass
+        self.session.mapper(Basic, basic)
+        self.basic = basic
+        self.Basic = Basic
+        self.obj = self.Basic(a=1, b=[2, 3], c=dict(d=4, e=5), f=6)
+        self.session.flush()
+        self.impl = self.datastore.db.basic
+        self.impl.update = Mock(side_effect=self.impl.update)
+        self.impl.save = Mock(side_effect=self.impl.save)
+
+    def tearDown(self):
+        self.session.clear()
+        self.datastore.conn.drop_all()
+
+    def test_set_field(self):
+        st = state(self.obj)
+        self.obj.a = 2
+        self.obj.c.d = 7
+        self.assertEqual(st.dirty_fields, set(['a', 'c']))
+        self.session.flush()
+        self.assertEqual(st.dirty_fields, None)
+        self.impl.update.assert_called_with(
+            dict(_id=self.obj._id),
+            {'$set':dict(a=2, c=dict(d=7, e=5))}, False, safe=True)
+        self.assertEqual(self.impl.save.call_count, 0)
+        self.assertEqual(self.impl.find_one()['c'], dict(d=7, e=5))
+
+    def test_unset_field(self):
+        del self.obj.f
+        self.obj.b.append(4)
+        self.session.flush()
+        self.impl.update.assert_called_with(
+            dict(_id=self.obj._id),
+            {'$set':dict(b=[2, 3, 4]), '$unset':dict(f=1)}, False, safe=True)
+        self.assertEqual(
+            self.impl.find_one(),
+            dict(_id=self.obj._id, a=1, b=[2, 3, 4], c=dict(d=4, e=5)))
+
+    def test_concurrent_write(self):
+        self.impl.update(dict(_id=self.obj._id), {'$set':dict(a=10)})
+        self.obj.b = [1]
+        self.session.flush()
+        self.assertEqual(self.impl.find_one()['a'], 10)
+
+    def test_unknown_changes(self):
+        st = state(self.obj)
+        st.soil()
+        self.session.flush()
+        self.assertEqual(self.impl.save.call_count, 1)
+
+    def test_before_save(self):
+        self.basic.m.before_save = lambda doc: None
+        try:
+            self.obj.a = 5
+            self.session.flush()
+        finally:
+            self.basic.m.before_save = None
+        self.assertEqual(self.impl.save.call_count, 1)
+
+class TestWeakIdentityMap(TestCase):
+
+    def setUp(self):
+        self.datastore = DS.DataStore(
+            'mim:///', database='test_db')
+        session = Session(bind=self.datastore)
+        self.session = ODMSession(session, weak_identity_map=True)
+        basic = collection(
+            'basic', session,
+            Field('_id', int),
+            Field('a', int),
+            Field('b', [int]))
+        class Basic(object):
+            pass
+        self.session.mapper(Basic, basic)
+        self.Basic = Basic
+        for i in range(10):
+            self.Basic(_id=i, a=i, b=[i])
+        self.session.flush()
+
+    def tearDown(self):
+        self.session.clear()
+        self.datastore.conn.drop_all()
+
+    def test_clean_released(self):
+        gc.disable() # objects must be freed without the cycle collector
+        try:
+            self.assertEqual(len(self.session.imap._objects), 0)
+            for obj in self.Basic.query.find():
+                obj.b # instrument a field
+                self.assertEqual(len(self.session.uow._objects), 1)
+            del obj
+            self.assertEqual(len(self.session.imap._objects), 0)
+            self.assertEqual(len(self.session.uow._objects), 0)
+        finally:
+            gc.enable()
+
+    def test_dirty_kept(self):
+        obj = self.Basic.query.get(_id=1)
+        obj.b.append(5)
+        del obj
+        self.assertEqual(len(self.session.uow._pending), 1)
+        self.session.flush()
+        self.assertEqual(len(self.session.uow._pending), 0)
+        self.assertEqual(self.datastore.db.basic.find_one({'_id':1})['b'], [1, 5])
+
+    def test_identity(self):
+        obj = self.Basic.query.get(_id=1)
+        self.assert_(self.Basic.query.get(_id=1) is obj)
+        self.assert_(obj.__ming__.instance is obj)
+
+class TestLazyValidation(TestCase):
+
+    def setUp(self):
+        self.datastore = DS.DataStore(
+            'mim:///', database='test_db')
+        session = Session(bind=self.datastore)
+        self.session = ODMSession(session)
+        basic = collection(
+            'basic', session,
+            Field('_id', S.ObjectId),
+            Field('a', int),
+            Field('b', [int]),
+            Field('c', dict(
+                    d=int, e=int)),
+            Field('d', str, if_missing='default'))
+        class Basic(object):
+            pass
+        self.session.mapper(Basic, basic,
+                            options=dict(lazy_validate=True))
+        self.Basic = Basic
+        self.datastore.db.basic.insert(dict(
+                a=1.0, b=['bad'], c=dict(d=4, e=5, f=6), z='extra'))
+
+    def tearDown(self):
+        self.session.clear()
+        self.datastore.conn.drop_all()
+
+    def test_validates_on_access(self):
+        obj = self.Basic.query.find().first()
+        st = state(obj)
+        self.assert_('a' not in st.validated_fields)
+        self.assertEqual(st.document['a'], 1.0)
+        self.assertEqual(obj.a, 1)
+        self.assertEqual(type(st.document['a']), int)
+        self.assertEqual(obj.c, dict(d=4, e=5))
+        self.assertEqual(obj.d, 'default')
+        self.assert_(set(['a', 'c', 'd']) <= st.validated_fields)
+        self.assert_('b' not in st.validated_fields)
+        self.assertRaises(S.Invalid, getattr, obj, 'b')
+        self.assertEqual(st.status, 'clean')
+
+    def test_full_validation_on_flush(self):
+        obj = self.Basic.query.find().first()
+        obj.a = 2
+        obj.b = [1, 2]
+        self.session.flush()
+        self.assertEqual(state(obj).validated_fields, None)
+        self.assertEqual(
+            state(obj).document,
+            dict(_id=obj._id, a=2, b=[1,2], c=dict(d=4, e=5), d='default'))
+        # only the changed fields are written
+        self.assertEqual(
+            self.datastore.db.basic.find_one(),
+            dict(_id=obj._id, a=2, b=[1,2], c=dict(d=4, e=5, f=6), z='extra'))
+
+    def test_eager_override(self):
+        q = self.Basic.query.find(lazy_validate=False)
+        self.assertRaises(S.Invalid, q.first)
+
+class TestPartialObjects(TestCase):
+
+    def setUp(self):
+        self.datastore = DS.DataStore(
+            'mim:///', database='test_db')
+        session = Session(bind=self.datastore)
+        self.session = ODMSession(session)
+        basic = collection(
+            'basic', session,
+            Field('_id', S.ObjectId),
+            Field('a', int),
+            Field('b', [int]),
+            Field('c', dict(d=int, e=int)))
+        class Basic(object):
+            pass
+        self.session.mapper(Basic, basic)
+        self.Basic = Basic
+        self.impl = self.datastore.db.basic
+        self.impl.insert(dict(a=1, b=[2, 3], c=dict(d=4, e=5)))
+
+    def tearDown(self):
+        self.session.clear()
+        self.datastore.conn.drop_all()
+
+    def test_unloaded_fields(self):
+        obj = self.Basic.query.find({}, ['a']).first()
+        self.assertEqual(obj.a, 1)
+        self.assertEqual(state(obj).loaded_fields, set(['_id', 'a']))
+        self.assertRaises(AttributeError, getattr, obj, 'b')
+        self.assert_('<unloaded>' in repr(obj))
+        obj.b = [7]
+        self.assertEqual(obj.b, [7])
+
+    def test_flush_partial(self):
+        obj = self.Basic.query.find({}, fields=dict(a=1, b=1)).first()
+        obj.a = 2
+        obj.b.append(4)
+        self.session.flush()
+        self.assertEqual(
+            self.impl.find_one(),
+            dict(_id=obj._id, a=2, b=[2, 3, 4], c=dict(d=4, e=5)))
+
+    def test_partial_validates_loaded_fields(self):
+        self.impl.update({}, {'$set':dict(c='bad')})
+        obj = self.Basic.query.find({}, ['a']).first()
+        state(obj).soil()
+        self.session.flush()
+        self.assertEqual(self.impl.find_one()['c'], 'bad')
+
+    def test_merge_later_load(self):
+        obj = self.Basic.query.find({}, ['a']).first()
+        obj.a = 5
+        obj2 = self.Basic.query.find({}, ['b']).first()
+        self.assert_(obj2 is obj)
+        self.assertEqual(obj.a, 5)
+        self.assertEqual(obj.b, [2, 3])
+        self.assertRaises(AttributeError, getattr, obj, 'c')
+        self.Basic.query.find().first()
+        self.assertEqual(state(obj).loaded_fields, None)
+        self.assertEqual(obj.a, 5)
+        self.assertEqual(obj.c, dict(d=4, e=5))
+
+    def test_exclusion(self):
+        obj = self.Basic.query.find({}, fields=dict(b=0)).first()
+        self.assertEqual(state(obj).loaded_fields, set(['_id', 'a', 'c']))
+        self.assertRaises(AttributeError, getattr, obj, 'b')
+        obj.a = 2
+        obj.c.d = 6
+        self.session.flush()
+        self.assertEqual(
+            self.impl.find_one(),
+            dict(_id=obj._id, a=2, b=[2, 3], c=dict(d=6, e=5)))
+
+    def test_dotted(self):
+        obj = self.Basic.query.find({}, ['a', 'c.d']).first()
+        self.assertEqual(state(obj).loaded_fields, set(['_id', 'a']))
+        self.assertRaises(AttributeError, getattr, obj, 'c')
+        obj.a = 2
+        self.session.flush()
+        self.session.clear()
+        obj = self.Basic.query.find({}, {'c.e':0}).first()
+        self.assertEqual(state(obj).loaded_fields, set(['_id', 'a', 'b']))
+        self.assertRaises(AttributeError, getattr, obj, 'c')
+        obj.b.append(4)
+        self.session.flush()
+        self.assertEqual(
+            self.impl.find_one(),
+            dict(_id=obj._id, a=2, b=[2, 3, 4], c=dict(d=4, e=5)))
+
 class TestRelation(TestCase):
     def setUp(self):
         self.datastore = DS.DataStore(
@@ -201,6 +619,22 @@ class TestRelation(TestCase):
         parent = self.Parent.query.get(_id=1)
         self.assertEqual(len(parent.children), 5)
 
+    def test_repr_partial(self):
+        self.Parent(_id=1)
+        self.Child(_id=2, parent_id=1)
+        self.session.flush()
+        self.session.clear()
+        child = self.Child.query.find(fields=['parent_id']).one()
+        self.assertEqual(
+            self.Child.parent.repr(child), repr(self.Parent.query.get(_id=1)))
+        self.session.clear()
+        child = self.Child.query.find(fields=['_id']).one()
+        self.assertEqual(self.Child.parent.repr(child), '<unloaded>')
+        parent = self.Parent.query.find(fields=['_id']).one()
+        self.assertEqual(
+            self.Parent.children.repr(parent), repr(parent.children))
+        self.assertEqual([ c._id for c in parent.children ], [ 2 ])
+
     def test_readonly(self):
         parent = self.Parent(_id=1)
         children = [ self.Child(_id=i, parent_id=1) for i in range(5) ]
@@ -215,6 +649,115 @@ class TestRelation(TestCase):
         self.assertRaises(TypeError, parent.children.append, children[0])
         self.assertRaises(TypeError, setchild)
 
+    def test_eager(self):
+        for i in range(3):
+            self.Parent(_id=i)
+        self.Parent(_id=3)
+        for i in range(10):
+            self.Child(_id=i, parent_id=i % 3)
+        self.session.flush()
+        self.session.clear()
+        child_find = self.datastore.db.child.find
+        parent_find = self.datastore.db.parent.find
+        self.datastore.db.child.find = Mock(side_effect=child_find)
+        self.datastore.db.parent.find = Mock(side_effect=parent_find)
+        parents = self.Parent.query.find().sort('_id').options(
+            eager=['children']).all()
+        self.assertEqual(self.datastore.db.child.find.call_count, 1)
+        self.assertEqual(
+            [ sorted(c._id for c in p.children) for p in parents ],
+            [ [0, 3, 6, 9], [1, 4, 7], [2, 5, 8], [] ])
+        self.assertRaises(TypeError, parents[0].children.append, None)
+        self.assertEqual(self.datastore.db.child.find.call_count, 1)
+        self.assertEqual(self.datastore.db.parent.find.call_count, 1)
+        self.session.clear()
+        self.datastore.db.parent.find.reset_mock()
+        children = self.Child.query.find(eager=['parent']).all()
+        self.assertEqual(self.datastore.db.parent.find.call_count, 1)
+        self.assertEqual(
+            [ c.parent._id for c in children ], [ c.parent_id for c in children ])
+        self.assertEqual(self.datastore.db.parent.find.call_count, 1)
+        self.assert_(children[0].parent is children[3].parent)
+
+    def test_eager_list_keys(self):
+        class Tag(object): pass
+        class Tagged(object): pass
+        tag = collection(
+            'tag', self.session.impl,
+            Field('_id', int))
+        tagged = collection(
+            'tagged', self.session.impl,
+            Field('_id', int),
+            Field('tag_ids', [int]))
+        mapper(Tag, tag, self.session, properties=dict(
+                tagged=RelationProperty(Tagged)))
+        mapper(Tagged, tagged, self.session, properties=dict(
+                tag_ids=ForeignIdProperty(Tag)))
+        self.datastore.db.tag.insert([ dict(_id=i) for i in range(3) ])
+        self.datastore.db.tagged.insert([
+                dict(_id=0, tag_ids=[0, 1]),
+                dict(_id=1, tag_ids=[1, 1]),
+                dict(_id=2, tag_ids=[]) ])
+        tags = Tag.query.find().sort('_id').options(eager=['tagged']).all()
+        self.assertEqual(
+            [ sorted(t._id for t in tag.tagged) for tag in tags ],
+            [ [0], [0, 1], [] ])
+
+    def test_eager_partial(self):
+        self.Parent(_id=1)
+        self.Child(_id=2, parent_id=1)
+        self.session.flush()
+        self.session.clear()
+        self.datastore.db.parent.find = Mock(
+            side_effect=self.datastore.db.parent.find)
+        child, = self.Child.query.find(
+            fields=['_id'], eager=['parent']).all()
+        self.assertEqual(self.datastore.db.parent.find.call_count, 0)
+        self.assertEqual(state(child).extra_state, {})
+        self.assertRaises(AttributeError, getattr, child, 'parent')
+        self.session.clear()
+        child, = self.Child.query.find(eager=['parent']).all()
+        self.assertEqual(child.parent._id, 1)
+
+    def test_eager_no_fetch(self):
+        class Parent(object): pass
+        class Child(object): pass
+        parent = collection(
+            'parent', self.session.impl,
+            Field('_id', int))
+        child = collection(
+            'child', self.session.impl,
+            Field('_id', int),
+            Field('parent_id', int))
+        mapper(Parent, parent, self.session, properties=dict(
+                children=RelationProperty(Child, fetch=False)))
+        mapper(Child, child, self.session, properties=dict(
+                parent_id=ForeignIdProperty(Parent)))
+        Parent(_id=1)
+        Child(_id=1, parent_id=1)
+        self.session.flush()
+        self.session.clear()
+        parent, = Parent.query.find(eager=['children']).all()
+        self.assertEqual(state(parent).extra_state, {})
+        self.assertEqual([ c._id for c in parent.children ], [ 1 ])
+
+    def test_eager_batches(self):
+        for i in range(5):
+            self.Parent(_id=i)
+        self.session.flush()
+        self.session.clear()
+        self.datastore.db.child.find = Mock(
+            side_effect=self.datastore.db.child.find)
+        cursor = self.Parent.query.find().options(eager=['children'])
+        cursor.eager_batch_size = 2
+        self.assertEqual(len(cursor.all()), 5)
+        self.assertEqual(self.datastore.db.child.find.call_count, 3)
+
+    def test_options_kept(self):
+        cursor = self.Parent.query.find().options(eager=['children'])
+        for c in (cursor.limit(1), cursor.skip(1), cursor.sort('_id')):
+            self.assertEqual(c._options.eager, ['children'])
+
 class TestPolymorphic(TestCase):
 
     def setUp(self):
@@ -251,3 +794,11 @@ class TestPolymorphic(TestCase):
         assert r[0].__class__ is self.Base
         assert r[1].__class__ is self.Derived
 
+    def test_polymorphic_partial(self):
+        self.Derived(a=2,b=2)
+        self.session.flush()
+        self.session.clear()
+        obj = self.Base.query.find(dict(a=2), ['a']).first()
+        assert obj.__class__ is self.Derived
+        self.assertEqual(obj.a, 2)
+        self.assertRaises(AttributeError, getattr, obj, 'b')
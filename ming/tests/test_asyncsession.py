@@ -0,0 +1,146 @@
+import sys
+import traceback
+from unittest import TestCase, main
+from threading import Event
+from multiprocessing.pool import ThreadPool
+
+from mock import Mock
+
+from ming import datastore as DS
+from ming import Session, collection, Field
+from ming import schema as S
+from ming.asyncsession import AsyncSession, AsyncCursor
+
+class TestAsyncSession(TestCase):
+
+    def setUp(self):
+        self.datastore = DS.DataStore('mim:///', database='test_db')
+        self.session = AsyncSession(Session(bind=self.datastore))
+        self.Doc = collection(
+            'doc', self.session.session,
+            Field('_id', int),
+            Field('a', int, if_missing=0))
+        self.session.insert_many(
+            [ self.Doc(dict(_id=i, a=i)) for i in range(10) ]).get()
+
+    def tearDown(self):
+        self.session.close()
+        self.datastore.conn.drop_all()
+
+    def test_get(self):
+        self.assertEqual(self.session.get(self.Doc, _id=3).get(), dict(_id=3, a=3))
+        results = []
+        done = Event()
+        def callback(doc):
+            results.append(doc)
+            done.set()
+        self.session.get(self.Doc, _id=4, callback=callback)
+        done.wait(5)
+        self.assertEqual(results, [ dict(_id=4, a=4) ])
+
+    def test_find_batches(self):
+        cursor = self.session.find(
+            self.Doc, {'a':{'$gte':3}}, batch_size=3).get()
+        batches = []
+        while True:
+            batch = cursor.next_batch().get()
+            if not batch: break
+            batches.append([ doc._id for doc in batch ])
+        self.assertEqual(batches, [ [3, 4, 5], [6, 7, 8], [9] ])
+        cursor = self.session.find(self.Doc, batch_size=4).get()
+        self.assertEqual(len(cursor.next_batch().get()), 4)
+        self.assertEqual(len(cursor.all().get()), 6)
+        self.assertEqual(cursor.next_batch().get(), [])
+
+    def test_writes(self):
+        doc = self.session.get(self.Doc, _id=1).get()
+        doc.a = 10
+        self.session.save(doc).get()
+        self.session.insert(self.Doc(dict(_id=20))).get()
+        self.session.remove(self.Doc, {'_id':2}).get()
+        self.session.update_partial(
+            self.Doc, {'_id':3}, {'$set':{'a':30}}).get()
+        self.assertEqual(
+            sorted((d._id, d.a) for d in self.session.find(self.Doc).get()
+                   if d._id in (1, 2, 3, 20)),
+            [ (1, 10), (3, 30), (20, 0) ])
+        doc = self.session.find_and_modify(
+            self.Doc, query={'_id':5}, update={'$set':{'a':50}},
+            new=True).get()
+        self.assertEqual(doc.a, 50)
+
+    def test_errors(self):
+        self.assertRaises(
+            S.Invalid, self.session.insert(self.Doc(dict(a='x'))).get)
+
+class TestAsyncCursor(TestCase):
+
+    def setUp(self):
+        self.pool = ThreadPool(2)
+
+    def tearDown(self):
+        self.pool.close()
+        self.pool.join()
+
+    def test_request_during_read(self):
+        reading, release = Event(), Event()
+        def slow_cursor():
+            reading.set()
+            release.wait(5)
+            for i in range(5):
+                yield i
+        cursor = AsyncCursor(slow_cursor(), self.pool, batch_size=2)
+        first = cursor.next_batch()
+        self.assert_(reading.wait(5))
+        # the cursor is being read, but requesting a batch does not block
+        second = cursor.next_batch()
+        self.assertFalse(first.ready())
+        release.set()
+        self.assertEqual(first.get(5), [0, 1])
+        self.assertEqual(second.get(5), [2, 3])
+        self.assertEqual(cursor.all().get(5), [4])
+
+    def test_one_job_per_cursor(self):
+        reading, release = Event(), Event()
+        def slow_cursor():
+            reading.set()
+            release.wait(5)
+            for i in range(7):
+                yield i
+        pool = Mock(wraps=self.pool)
+        cursor = AsyncCursor(slow_cursor(), pool, batch_size=2)
+        batches = [ cursor.next_batch() ]
+        self.assert_(reading.wait(5))
+        batches += [ cursor.next_batch() for i in range(3) ]
+        self.assertEqual(pool.apply_async.call_count, 1)
+        release.set()
+        self.assertEqual(
+            [ b.get(5) for b in batches ], [ [0, 1], [2, 3], [4, 5], [6] ])
+
+    def test_callback_waits(self):
+        results = []
+        done = Event()
+        cursor = AsyncCursor(iter(range(5)), self.pool, batch_size=2)
+        def callback(batch):
+            # waits for another batch from inside a callback
+            results.append((batch, cursor.next_batch().get(5)))
+            done.set()
+        cursor.next_batch(callback=callback)
+        self.assert_(done.wait(10))
+        self.assertEqual(results, [ ([0, 1], [2, 3]) ])
+
+    def test_traceback(self):
+        def failing_cursor():
+            yield 1
+            raise ValueError('broken')
+        cursor = AsyncCursor(failing_cursor(), self.pool, batch_size=5)
+        try:
+            cursor.next_batch().get(5)
+        except ValueError:
+            tb = traceback.extract_tb(sys.exc_info()[2])
+            self.assertEqual(tb[-1][2], 'failing_cursor')
+        else:
+            self.fail('ValueError not raised')
+
+if __name__ == '__main__':
+    main()
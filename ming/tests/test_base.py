@@ -2,9 +2,13 @@ from datetime import datetime
 from decimal import Decimal
 from unittest import TestCase, main
 import copy
+import gc
 
 from bson import ObjectId
 
+from ming import datastore as DS
+from ming import Session, collection, Field
+from ming import schema as S
 from ming.base import Object
 
 class TestObject(TestCase):
@@ -56,5 +60,55 @@ class TestObject(TestCase):
         self.assertRaises(AssertionError, unsafe_obj.make_safe)
 
 
+class TestPrefetch(TestCase):
+
+    def setUp(self):
+        self.datastore = DS.DataStore('mim:///', database='test_db')
+        self.session = Session(bind=self.datastore)
+        self.Doc = collection(
+            'doc', self.session,
+            Field('_id', int),
+            Field('a', int))
+        self.datastore.db.doc.insert([ dict(_id=i, a=i) for i in range(10) ])
+
+    def tearDown(self):
+        self.datastore.conn.drop_all()
+
+    def test_prefetch(self):
+        cursor = self.session.find(self.Doc).sort('_id').prefetch(3, depth=1)
+        self.assertEqual([ d.a for d in cursor ], range(10))
+        self.assertEqual(list(cursor), [])
+        cursor = self.session.find(self.Doc).prefetch(3)
+        self.assertEqual(cursor.first()._id, 0)
+        cursor.close()
+        cursor._prefetcher.thread.join(5)
+
+    def test_abandoned(self):
+        cursor = self.session.find(self.Doc).prefetch(2, depth=1)
+        cursor.next()
+        thread = cursor._prefetcher.thread
+        self.assert_(thread.is_alive())
+        del cursor
+        gc.collect()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_first_stops(self):
+        cursor = self.session.find(self.Doc).prefetch(2, depth=1)
+        self.assertEqual(cursor.first()._id, 0)
+        thread = cursor._prefetcher.thread
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        cursor = self.session.find(self.Doc, {'_id':3}).prefetch(2)
+        self.assertEqual(cursor.one()._id, 3)
+        cursor._prefetcher.thread.join(5)
+        self.assertFalse(cursor._prefetcher.thread.is_alive())
+
+    def test_invalid(self):
+        self.datastore.db.doc.update({'_id':5}, {'$set':{'a':'x'}})
+        cursor = self.session.find(self.Doc).sort('_id').prefetch(2)
+        self.assertEqual([ cursor.next().a for i in range(5) ], range(5))
+        self.assertRaises(S.Invalid, cursor.next)
+
 if __name__ == '__main__':
     main()
@@ -1,11 +1,15 @@
+import time
+from threading import Thread, Event
 from unittest import TestCase, main
 
-from mock import patch
+from mock import patch, Mock, MagicMock
 
 import ming
 from ming import Session, Field, Document
 from ming import datastore as DS
 from ming import schema as S
+from ming.exc import MongoGone
+from pymongo.errors import AutoReconnect
 
 CONNECT_ARGS = dict(
     network_timeout=0.1)
@@ -45,6 +49,97 @@ class TestEngine(TestCase):
             **CONNECT_ARGS)
         assert ms.conn is not None
 
+class TestCircuitBreaker(TestCase):
+
+    def test_circuit_breaker(self):
+        engine = DS.Engine(
+            'mongodb://localhost:23/', circuit_breaker=True, backoff=0.2)
+        engine._log = Mock()
+        conn = Mock()
+        engine.ConnectionClass = Mock(side_effect=[ValueError, ValueError, conn])
+        self.assertRaises(MongoGone, getattr, engine, 'conn')
+        self.assertEqual(engine.circuit, engine.open)
+        self.assertRaises(MongoGone, getattr, engine, 'conn')
+        self.assertEqual(engine.ConnectionClass.call_count, 1)
+        time.sleep(0.25)
+        # the probe fails, so the circuit stays open for twice as long
+        self.assertRaises(MongoGone, getattr, engine, 'conn')
+        time.sleep(0.25)
+        self.assertRaises(MongoGone, getattr, engine, 'conn')
+        self.assertEqual(engine.ConnectionClass.call_count, 2)
+        time.sleep(0.3)
+        self.assert_(engine.conn is conn)
+        self.assertEqual(engine.circuit, engine.closed)
+        counters = engine.metrics.snapshot()['counters']
+        self.assertEqual(counters['circuit_opens'], 1)
+        self.assertEqual(counters['connect_attempts'], 3)
+        self.assertEqual(counters['connect_failures'], 2)
+        self.assertEqual(counters['circuit_rejections'], 2)
+
+    def test_half_open_probe(self):
+        engine = DS.Engine(
+            'mongodb://localhost:23/', circuit_breaker=True, backoff=0.1)
+        engine._log = Mock()
+        conn = Mock()
+        attempts = []
+        started, release = Event(), Event()
+        def connect(*args, **kwargs):
+            attempts.append(args)
+            if len(attempts) == 1: raise ValueError
+            started.set()
+            release.wait(5)
+            return conn
+        engine.ConnectionClass = connect
+        self.assertRaises(MongoGone, getattr, engine, 'conn')
+        time.sleep(0.15)
+        result = []
+        probe = Thread(target=lambda: result.append(engine.conn))
+        probe.start()
+        started.wait(5)
+        # only the probe connects; the others are refused without waiting
+        self.assertEqual(engine.circuit, engine.half_open)
+        self.assertRaises(MongoGone, getattr, engine, 'conn')
+        engine.connection_failed(AutoReconnect('down'))
+        release.set()
+        probe.join(5)
+        self.assertEqual(result, [conn])
+        self.assert_(engine.conn is conn)
+        self.assertEqual(engine.circuit, engine.closed)
+        self.assertEqual(len(attempts), 2)
+
+    def test_operation_failure(self):
+        engine = DS.Engine(
+            'mongodb://localhost:23/', circuit_breaker=True, backoff=0.2,
+            failure_threshold=2)
+        engine._log = Mock()
+        conn, new_conn = Mock(), Mock()
+        conn.test_db = dict(doc=Mock())
+        conn.test_db['doc'].find_one.side_effect = AutoReconnect('down')
+        new_conn.test_db = dict(doc=Mock())
+        new_conn.test_db['doc'].find_one.return_value = dict(_id=1)
+        engine.ConnectionClass = Mock(side_effect=[conn, new_conn])
+        session = Session(DS.DataStore(bind=engine, database='test_db'))
+        class Doc(Document):
+            class __mongometa__:
+                name = 'doc'
+            _id = Field(int)
+        Doc.m.session = session
+        self.assertRaises(AutoReconnect, session.get, Doc, _id=1)
+        self.assertEqual(engine.circuit, engine.closed)
+        self.assertRaises(AutoReconnect, session.get, Doc, _id=1)
+        self.assertEqual(engine.circuit, engine.open)
+        conn.disconnect.assert_called_once_with()
+        self.assertRaises(MongoGone, session.get, Doc, _id=1)
+        time.sleep(0.25)
+        self.assertEqual(session.get(Doc, _id=1), dict(_id=1))
+        self.assert_(engine.conn is new_conn)
+        self.assertEqual(engine.circuit, engine.closed)
+        counters = engine.metrics.snapshot()['counters']
+        self.assertEqual(counters['connection_errors'], 2)
+        self.assertEqual(counters['circuit_opens'], 1)
+        self.assertEqual(counters['circuit_rejections'], 1)
+        self.assertEqual(counters['connect_attempts'], 2)
+
 class TestDatastore(TestCase):
 
     def test_basic(self):
@@ -55,6 +150,35 @@ class TestDatastore(TestCase):
         assert ds.conn is not None
         assert ds.db is not None
 
+    def test_authenticate_once(self):
+        engine = DS.Engine('mongodb://localhost:23/')
+        engine._conn = Mock()
+        ds = DS.DataStore(
+            bind=engine, database='test_db',
+            authenticate=dict(name='user', password='secret'))
+        db = ds.db
+        self.assert_(ds.db is db)
+        db.authenticate.assert_called_once_with(name='user', password='secret')
+        engine._conn = Mock()
+        self.assert_(ds.db is not db)
+        self.assertEqual(ds.metrics.snapshot()['counters']['authentications'], 2)
+
+    def test_collection_handles(self):
+        def connection():
+            conn = MagicMock()
+            conn.test_db.__getitem__.side_effect = lambda name: Mock()
+            return conn
+        engine = DS.Engine('mongodb://localhost:23/')
+        engine._conn = connection()
+        ds = DS.DataStore(bind=engine, database='test_db')
+        coll = ds.collection('docs')
+        self.assert_(ds.collection('docs') is coll)
+        self.assert_(ds.db is engine._conn.test_db)
+        engine._conn = connection()
+        self.assert_(ds.collection('docs') is not coll)
+        self.assert_(ds.collection('docs') is ds.collection('docs'))
+        self.assertEqual(engine._conn.test_db.__getitem__.call_count, 1)
+
     def test_configure(self):
         ming.configure(**{
                 'ming.main.master':'mongodb://localhost:27017/',
@@ -185,6 +185,20 @@ class TestIndexes(TestCase):
         self.MyDoc.m
         assert ensure_index.called
 
+    def test_index_added_later(self):
+        class NoIndexDoc(Document):
+            class __mongometa__:
+                session = self.MockSession
+                name = 'test_added_index'
+                schema = dict(_id=S.ObjectId, test1=str)
+        collection = self.MockSession.db['test_added_index']
+        NoIndexDoc.m
+        self.assertFalse(collection.ensure_index.called)
+        NoIndexDoc.m.add_index(Index('test1'))
+        NoIndexDoc.m
+        collection.ensure_index.assert_called_once_with(
+            [ ('test1', pymongo.ASCENDING) ], unique=False, sparse=False)
+
     def test_index_inheritance_child_none(self):
         class MyChild(self.MyDoc):
             class __mongometa__:
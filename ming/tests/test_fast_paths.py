@@ -0,0 +1,232 @@
+'''Checks that the optimized code paths agree with the paths they replace.
+The timings of these paths are in benchmarks/ming_benchmarks.py.'''
+import gc
+from copy import copy, deepcopy
+from datetime import datetime
+from unittest import TestCase
+
+import mock
+
+from ming import schema as S
+from ming import datastore as DS
+from ming import mim
+from ming import collection, Field, Session
+from ming.base import Object
+from ming.odm import ODMSession
+
+class TestSchemaFastPaths(TestCase):
+
+    def setUp(self):
+        self.schema = S.SchemaItem.make(dict(
+                _id=S.ObjectId(),
+                name=str,
+                created=datetime,
+                tags=[str],
+                author=dict(name=str, email=str, score=float),
+                comments=[dict(
+                        author=str,
+                        text=str,
+                        posted=datetime,
+                        votes=dict(up=int, down=int))],
+                meta={str:None}))
+        now = datetime.utcnow()
+        self.doc = dict(
+            name='A benchmark', created=now,
+            tags=[ 'tag%d' % i for i in range(10) ],
+            author=dict(name='Rick', email='rick@example.com', score=4.5),
+            comments=[
+                dict(author='user%d' % i, text='comment text %d' % i,
+                     posted=now, votes=dict(up=i, down=0))
+                for i in range(20) ],
+            meta=dict(a=1, b=2, c=3))
+
+    def test_compiled_validation(self):
+        interpreted = self.schema.validate(self.doc)
+        result = self.schema.compiled()(self.doc)
+        result.pop('_id')
+        interpreted.pop('_id')
+        self.assertEqual(result, interpreted)
+
+    def test_missing_defaults(self):
+        default = dict(
+            flags=dict(a=True, b=False), history=[],
+            limits=dict(daily=[1, 2, 3], monthly=dict(max=10, used=0)))
+        schema = S.SchemaItem.make(dict(
+                _id=int,
+                settings=S.Anything(if_missing=default),
+                profile=dict(
+                    name=str,
+                    address=dict(street=str, city=str, zip=str),
+                    prefs=dict(color=S.String(if_missing='blue'),
+                               tags=[str]))))
+        copy = S._copier(default)()
+        self.assertEqual(copy, deepcopy(default))
+        self.assert_(copy['limits']['daily'] is not default['limits']['daily'])
+        result = schema.compiled()(dict(_id=1))
+        self.assertEqual(result['settings'], default)
+        self.assertEqual(result['profile']['prefs']['color'], 'blue')
+
+class TestMimFastPaths(TestCase):
+
+    def setUp(self):
+        self.bind = DS.DataStore(master='mim:///', database='fast_paths')
+        self.bind.conn.drop_all()
+        self.count = 500
+        for name in ('plain', 'indexed'):
+            coll = getattr(self.bind.db, name)
+            for i in xrange(self.count):
+                coll.insert(dict(_id=i, a=i % 100, b=i))
+        self.bind.db.indexed.ensure_index('a')
+        self.bind.db.indexed.ensure_index('b')
+
+    def tearDown(self):
+        self.bind.conn.drop_all()
+
+    def test_indexed_find(self):
+        def query(coll):
+            return [
+                len(list(coll.find(dict(a=i)))) +
+                len(list(coll.find(dict(b={'$gte':self.count - i * 10}))))
+                + len(list(coll.find(dict(b={'$gt':self.count - 5}))))
+                for i in range(20) ]
+        self.assertEqual(
+            query(self.bind.db.indexed), query(self.bind.db.plain))
+
+    def test_compiled_match(self):
+        docs = [ dict(_id=i, a=i % 100, b=dict(c=i % 7, d=[i, i + 1]),
+                      tags=[ 'tag%d' % (i % 10), 'other' ])
+                 for i in xrange(1000) ]
+        specs = [
+            {'$or':[{'a':{'$in':[1, 2, 3]}}, {'b.c':{'$gt':5}}]},
+            {'b.d':{'$in':[10, 20, 30]}, 'tags':'tag0'},
+            {'a':{'$gte':50}, '$or':[{'tags':'tag1'}, {'b.c':3}]} ]
+        for spec in specs:
+            predicate = mim.compile_spec(spec)
+            self.assertEqual(
+                [ d['_id'] for d in docs if predicate(d) ],
+                [ d['_id'] for d in docs if mim.match(spec, d) ])
+
+    def test_copy_on_write_reads(self):
+        doc = dict(
+            a=1, tags=[ 'tag%d' % i for i in range(10) ],
+            comments=[ dict(author='user%d' % i, votes=dict(up=i, down=0))
+                       for i in range(20) ])
+        results = []
+        for copy_on_write in (False, True):
+            coll = mim.Connection(copy_on_write=copy_on_write).db.coll
+            for i in xrange(100):
+                doc['_id'] = i
+                coll.insert(doc)
+            results.append(list(coll.find().sort('_id')))
+        self.assertEqual(results[0], results[1])
+
+class TestSessionFastPaths(TestCase):
+
+    def setUp(self):
+        self.datastore = DS.DataStore('mim:///', database='fast_paths')
+        self.datastore.conn.drop_all()
+        self.session = Session(bind=self.datastore)
+        self.Record = collection(
+            'record', self.session,
+            Field('_id', int),
+            Field('name', str),
+            Field('tags', [str]),
+            Field('meta', dict(a=int, b=int)),
+            Field('extra', None))
+        self.count = 200
+        self.datastore.db.record.insert([
+                dict(_id=i, name='record %d' % i, tags=['a', 'b'],
+                     meta=dict(a=i, b=1), extra=dict(x=dict(y=i)))
+                for i in xrange(self.count) ])
+
+    def tearDown(self):
+        self.datastore.conn.drop_all()
+
+    def test_find(self):
+        coll = self.datastore.db.record
+        expected = sum(
+            Object.from_bson(d)['meta']['a'] for d in coll.find())
+        for validate in (True, False):
+            self.assertEqual(expected, sum(
+                    d.meta.a for d in self.session.find(
+                        self.Record, validate=validate)))
+        self.assertEqual(expected, sum(
+                d.meta.a for d in self.session.find(self.Record).prefetch()))
+        doc = self.session.find(self.Record).first()
+        self.assert_(isinstance(doc.extra.x, Object))
+
+    def test_find_decodes_once(self):
+        # Documents come from the driver as Objects, so finding them never
+        # makes a second conversion pass over them
+        with mock.patch.object(
+            Object, 'from_bson', side_effect=Object.from_bson) as from_bson:
+            for validate in (True, False):
+                docs = self.session.find(
+                    self.Record, validate=validate).all()
+                self.assertEqual(len(docs), self.count)
+                self.assert_(isinstance(docs[0].extra.x, Object))
+            doc = self.session.get(self.Record, _id=0)
+            self.assert_(isinstance(doc.extra.x, Object))
+        self.assertEqual(from_bson.call_count, 0)
+
+    def test_manager(self):
+        doc = self.session.get(self.Record, _id=0)
+        m = doc.m
+        self.assert_(m.inst is doc)
+        self.assertEqual(m.collection_name, 'record')
+        self.assert_(doc.m is m)
+        other = copy(doc)
+        self.assert_(other.m.inst is other)
+        self.assert_(doc.m.inst is doc)
+
+class TestODMFastPaths(TestCase):
+
+    def setUp(self):
+        self.datastore = DS.DataStore('mim:///', database='fast_paths')
+        self.datastore.conn.drop_all()
+        self.session = ODMSession(Session(bind=self.datastore))
+        record = collection(
+            'record', self.session.impl,
+            Field('_id', int),
+            Field('name', str),
+            Field('tags', [str]),
+            Field('meta', dict(a=int, b=int)))
+        class Record(object): pass
+        self.session.mapper(Record, record)
+        self.Record = Record
+        self.count = 200
+        self.datastore.db.record.insert([
+                dict(_id=i, name='record %d' % i, tags=['a', 'b'],
+                     meta=dict(a=i, b=1))
+                for i in xrange(self.count) ])
+
+    def tearDown(self):
+        self.session.clear()
+        self.datastore.conn.drop_all()
+
+    def test_stream(self):
+        expected = sum(r.meta['a'] for r in self.Record.query.find())
+        self.session.clear()
+        self.assertEqual(expected, sum(
+                r.meta['a'] for r in self.Record.query.find().stream()))
+
+    def test_memory(self):
+        def load(**options):
+            self.session.clear()
+            return self.Record.query.find().options(**options).all()
+        def allocated(**options):
+            'gc-tracked objects kept alive per loaded object'
+            load(**options)
+            self.session.clear()
+            gc.collect()
+            before = len(gc.get_objects())
+            objs = load(**options)
+            gc.collect()
+            return float(len(gc.get_objects()) - before) / len(objs)
+        self.assert_(allocated(original_document=False) < allocated())
+
+    def test_query(self):
+        obj = self.Record.query.get(_id=0)
+        query = obj.query
+        self.assert_(query.instance is obj)
+        self.assert_(query.get(_id=1) is self.Record.query.get(_id=1))
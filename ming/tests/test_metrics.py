@@ -0,0 +1,68 @@
+from __future__ import with_statement
+from unittest import TestCase, main
+
+import mock
+
+from ming import datastore as DS
+from ming.metrics import Metrics, Histogram
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.events = []
+        self.metrics.add_listener(
+            lambda name, value: self.events.append((name, value)))
+
+    def test_counters(self):
+        self.metrics.incr('a')
+        self.metrics.incr('a', 2)
+        self.metrics.gauge('b', 5)
+        self.assertEqual(self.metrics.snapshot()['counters'], dict(a=3))
+        self.assertEqual(self.metrics.snapshot()['gauges'], dict(b=5))
+        self.assertEqual(self.events, [ ('a', 1), ('a', 2), ('b', 5) ])
+        self.metrics.reset()
+        self.assertEqual(self.metrics.snapshot()['counters'], {})
+
+    def test_histogram(self):
+        h = Histogram([1, 10])
+        for value in (0.5, 1, 5, 20):
+            h.observe(value)
+        snapshot = h.snapshot()
+        self.assertEqual(snapshot['count'], 4)
+        self.assertEqual(snapshot['min'], 0.5)
+        self.assertEqual(snapshot['max'], 20)
+        self.assertEqual(snapshot['mean'], 26.5 / 4)
+        self.assertEqual(snapshot['buckets'], [ (1, 2), (10, 1), (None, 1) ])
+
+    def test_timer(self):
+        try:
+            with self.metrics.timer('t'):
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(
+            self.metrics.snapshot()['histograms']['t']['count'], 1)
+        self.assertEqual(self.events[0][0], 't')
+
+class TestEngineMetrics(TestCase):
+
+    @mock.patch('time.sleep')
+    def test_connect(self, sleep):
+        engine = DS.Engine('mongodb://localhost:23/', connect_retry=2)
+        conn = mock.Mock()
+        engine.ConnectionClass = mock.Mock(side_effect=[ValueError, conn])
+        engine._log = mock.Mock()
+        self.assert_(engine.conn is conn)
+        snapshot = DS.DataStore(bind=engine, database='test').metrics.snapshot()
+        self.assertEqual(snapshot['counters'], dict(
+                connect_attempts=2, connect_failures=1, connect_retries=1))
+        self.assertEqual(snapshot['histograms']['connect_time']['count'], 2)
+        self.assertEqual(snapshot['histograms']['connect_wait']['count'], 2)
+        engine._conn = None
+        engine.ConnectionClass = mock.Mock(return_value=conn)
+        engine.conn
+        self.assertEqual(engine.metrics.snapshot()['counters']['reconnects'], 1)
+
+if __name__ == '__main__':
+    main()
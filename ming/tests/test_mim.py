@@ -1,6 +1,12 @@
 from unittest import TestCase
 
+import re
+import copy
+import pickle
+
 from ming import datastore as DS
+from ming import mim
+from ming.base import Object
 
 class TestDatastore(TestCase):
 
@@ -29,6 +35,202 @@ class TestDatastore(TestCase):
         assert 0 == f(dict({'$or': [{'c':{'$all':[4,2,3]}}]})).count()
         assert 1 == f(dict({'$or': [{'a': 2}, {'c':{'$all':[1,2,3]}}]})).count()
 
+class TestMatch(TestCase):
+
+    doc = dict(a=2, b=dict(c=[1, 2], d='foo'), e=[dict(f=1), dict(f=3)], g=[1, 2])
+
+    def test_match(self):
+        cases = [
+            (dict(a=2), True),
+            (dict(a={'$gt':1}), True),
+            (dict(a={'$lte':1}), False),
+            (dict(a={'$ne':2}), False),
+            (dict(a={'$in':[1, 2]}), True),
+            (dict(a={'$nin':[1, 2]}), False),
+            (dict(a={'$exists':True}), True),
+            (dict(x={'$exists':False}), True),
+            ({'b.c':1}, True),
+            ({'b.c':{'$in':[5, 2]}}, True),
+            ({'b.c':{'$all':[1, 2]}}, True),
+            ({'b.d':re.compile('f.o')}, True),
+            ({'b.d':re.compile('bar')}, False),
+            ({'e.f':3}, True),
+            ({'e.f':2}, False),
+            ({'g':[1, 2]}, True),
+            ({'a.x':1}, False),
+            ({'a':2, 'b.d':'bar'}, False),
+            ({'$or':[{'a':3}, {'b.d':'foo'}]}, True),
+            ({'$or':[{'a':3}, {'a.x':1}]}, False),
+            ({'a':2, '$or':[{'a.x':1}, {'e.f':1}]}, True),
+            ]
+        for spec, expected in cases:
+            self.assertEqual(mim.match(spec, self.doc), expected, spec)
+
+    def test_shape_cache(self):
+        mim.compile_spec({'a':1, 'b':{'$in':[1]}})
+        count = len(mim._compiled_specs)
+        predicate = mim.compile_spec({'a':2, 'b':{'$in':[3]}})
+        self.assertEqual(count, len(mim._compiled_specs))
+        self.assert_(predicate(dict(a=2, b=3)))
+        self.assert_(not predicate(dict(a=1, b=1)))
+
+    def test_invalid_or(self):
+        self.assertRaises(
+            mim.InvalidOperation, mim.match, {'$or':{'a':1}}, self.doc)
+
+class TestIndexes(TestCase):
+
+    queries = [
+        dict(a=3),
+        dict(a={'$in':[1, 5, 'x']}),
+        dict(a={'$gt':5}),
+        dict(a={'$gte':5}),
+        dict(a={'$lt':5}),
+        dict(a={'$lte':5}),
+        dict(a={'$gt':'m'}),
+        dict(a={'$ne':3}),
+        dict(c=4),
+        dict(c={'$in':[0, 7]}),
+        dict(c={'$gt':8}),
+        {'b.x':2},
+        {'b.x':{'$lt':3}},
+        {'b.x':{'$in':[1, 2]}, 'a':{'$gte':4}},
+        {'_id':3},
+        {'_id':{'$in':[1, 2, 'missing']}},
+        {'a':2, '_id':2},
+        ]
+
+    def setUp(self):
+        self.bind = DS.DataStore(master='mim:///', database='testdb')
+        self.bind.conn.drop_all()
+        self.plain = self.bind.db.plain
+        self.indexed = self.bind.db.indexed
+        self.indexed.ensure_index('a')
+        self.indexed.ensure_index([('c', 1), ('a', 1)])
+        self.indexed.ensure_index('b.x')
+        docs = [ dict(_id=i, a=i % 7, b=dict(x=i % 3), c=[i, i+1])
+                 for i in range(20) ]
+        docs += [
+            dict(_id=20),
+            dict(_id=21, a='string', b=[dict(x=1), dict(x=2)]),
+            dict(_id=22, a=None, b=5),
+            dict(_id=23, a=[3, 5]) ]
+        for doc in docs:
+            self.plain.insert(doc)
+            self.indexed.insert(doc)
+
+    def assertSameResults(self):
+        for q in self.queries:
+            expected = sorted(d['_id'] for d in self.plain.find(q))
+            result = sorted(d['_id'] for d in self.indexed.find(q))
+            self.assertEqual(result, expected, q)
+
+    def test_find(self):
+        self.assertSameResults()
+
+    def test_modify(self):
+        for coll in self.plain, self.indexed:
+            coll.update({'a':3}, {'$set':{'a':8}}, multi=True)
+            coll.update({'_id':4}, {'a':'x', 'c':[7]})
+            coll.update({'_id':30}, {'$set':{'a':5}}, upsert=True)
+            coll.remove({'c':{'$gt':15}})
+        self.assertSameResults()
+        self.assertEqual(
+            self.indexed.find(dict(a=8)).count(),
+            self.plain.find(dict(a=8)).count())
+
+    def test_drop_index(self):
+        self.indexed.drop_index('c_a')
+        self.assert_('c' not in self.indexed._field_indexes)
+        self.assert_('a' in self.indexed._field_indexes)
+        self.indexed.drop_index('a')
+        self.assert_('a' not in self.indexed._field_indexes)
+        self.assertSameResults()
+
+    def test_sort(self):
+        for coll in self.plain, self.indexed:
+            coll.remove({'_id':{'$gte':20}})
+        index = self.indexed._field_indexes['a']
+        self.assertNotEqual(index.ordered_ids(1), None)
+        for direction in (1, -1):
+            result = [ d['a'] for d in self.indexed.find(
+                    {'c':{'$gt':3}}).sort('a', direction) ]
+            expected = sorted(
+                [ d['a'] for d in self.plain.find({'c':{'$gt':3}}) ],
+                reverse=direction < 0)
+            self.assertEqual(result, expected)
+        self.indexed.insert(dict(_id=50))
+        self.assertEqual(index.ordered_ids(1), None)
+        self.assertEqual(
+            self.indexed.find().sort('a', 1).next()['_id'], 50)
+
+class TestIsolation(TestCase):
+
+    copy_on_write = False
+
+    def setUp(self):
+        self.conn = mim.Connection(copy_on_write=self.copy_on_write)
+        self.coll = self.conn.db.coll
+        self.coll.insert(dict(_id=1, a=1, b=dict(c=[1, 2], d=[dict(e=1)])))
+
+    def test_mutate_result(self):
+        doc = self.coll.find_one()
+        doc['a'] = 2
+        doc['b']['c'].append(3)
+        doc['b']['d'][0]['e'] = 2
+        doc.get('b').setdefault('x', []).append(1)
+        self.assertEqual(
+            self.coll.find_one(), dict(_id=1, a=1, b=dict(c=[1, 2], d=[dict(e=1)])))
+
+    def test_update(self):
+        sub = dict(x=[1])
+        self.coll.insert(dict(_id=2, a=1))
+        self.coll.update({'a':1}, {'$set':{'s':sub, 't':[1]}}, multi=True)
+        self.coll.update({'_id':1}, {'$push':{'t':2}})
+        sub['x'].append(2)
+        self.assertEqual(self.coll.find_one({'_id':1})['s'], dict(x=[1]))
+        self.assertEqual(self.coll.find_one({'_id':1})['t'], [1, 2])
+        self.assertEqual(self.coll.find_one({'_id':2})['t'], [1])
+        self.coll.update({'_id':2}, {'a':5})
+        self.assertEqual(self.coll.find_one({'a':5}), dict(_id=2, a=5))
+
+    def test_as_class(self):
+        doc = self.coll.find_one(as_class=Object)
+        self.assert_(isinstance(doc, Object))
+        self.assert_(isinstance(doc.b, Object))
+        self.assert_(isinstance(doc.b.d[0], Object))
+        doc.b.c.append(3)
+        self.assertEqual(self.coll.find_one()['b']['c'], [1, 2])
+
+    def test_copies(self):
+        doc = self.coll.find_one()
+        doc2 = copy.deepcopy(doc)
+        doc2['b']['c'].append(3)
+        self.assertEqual(doc['b']['c'], [1, 2])
+        doc3 = pickle.loads(pickle.dumps(doc))
+        self.assertEqual(doc3, doc)
+        self.assertEqual(type(doc3), dict)
+
+class TestCopyOnWrite(TestIsolation):
+
+    copy_on_write = True
+
+    def test_stored_frozen(self):
+        stored = self.coll._data[1]
+        self.assert_(isinstance(stored, mim.FrozenDict))
+        self.assertRaises(TypeError, stored.__setitem__, 'a', 2)
+        self.assertRaises(TypeError, stored['b']['c'].append, 3)
+        doc = self.coll.find_one()
+        self.assert_(dict.__getitem__(doc, 'b') is stored['b'])
+        self.assert_(doc['b'] is not stored['b'])
+        self.assert_(dict.__getitem__(doc, 'b') is doc['b'])
+
+    def test_thaw_plain_copy(self):
+        doc = copy.deepcopy(self.coll._data[1])
+        self.assertEqual(type(doc), dict)
+        self.assertEqual(type(doc['b']['c']), list)
+        doc['b']['c'].append(3)
+
 class TestCommands(TestCase):
         
     sum_js = '''function(key,values) {
@@ -0,0 +1,103 @@
+from unittest import TestCase, main
+
+import mock
+
+from ming import datastore as DS
+from ming import Session, collection, Field
+from ming.profiling import query_shape, Profiler, SlowQueryLogger
+from ming.profiling import ShapeAggregator
+
+class Recorder(Profiler):
+
+    def __init__(self):
+        self.records = []
+
+    def record(self, record):
+        self.records.append(record)
+
+class TestQueryShape(TestCase):
+
+    def test_shape(self):
+        self.assertEqual(query_shape(None), '{}')
+        self.assertEqual(query_shape(5), '?')
+        self.assertEqual(
+            query_shape({'b':{'$gt':1, '$lt':5}, 'a':'secret'}),
+            '{a: ?, b: {$gt: ?, $lt: ?}}')
+        self.assertEqual(
+            query_shape({'$or':[{'a':1}, {'c.d':{'$in':[1,2]}}]}),
+            '{$or: [{a: ?}, {c.d: {$in: ?}}]}')
+        self.assertEqual(query_shape({'a':{'x':1}}), '{a: ?}')
+        self.assertEqual(
+            query_shape({'a':1}), query_shape({'a':'other'}))
+
+class TestSessionProfiling(TestCase):
+
+    def setUp(self):
+        self.datastore = DS.DataStore('mim:///', database='test_db')
+        self.recorder = Recorder()
+        self.aggregator = ShapeAggregator()
+        self.session = Session(
+            bind=self.datastore,
+            profilers=[ self.recorder, self.aggregator ])
+        self.Doc = collection(
+            'doc', self.session,
+            Field('_id', int),
+            Field('a', int))
+        for i in range(5):
+            self.session.insert(self.Doc(dict(_id=i, a=i)))
+        self.recorder.records = []
+        self.aggregator.reset()
+
+    def tearDown(self):
+        self.datastore.conn.drop_all()
+
+    def test_find(self):
+        self.assertEqual(
+            len(self.session.find(self.Doc, {'a':{'$gt':1}}).all()), 3)
+        record, = self.recorder.records
+        self.assertEqual(record.operation, 'find')
+        self.assertEqual(record.collection, 'doc')
+        self.assertEqual(record.shape, '{a: {$gt: ?}}')
+        self.assertEqual(record.documents, 3)
+        self.assert_(0 < record.validation_time <= record.duration)
+
+    def test_first(self):
+        self.session.find(self.Doc, {'a':1}).first()
+        self.assertEqual(self.recorder.records[0].documents, 1)
+
+    def test_writes(self):
+        doc = self.session.get(self.Doc, _id=1)
+        doc.a = 10
+        self.session.save(doc)
+        self.session.update_partial(self.Doc, {'_id':2}, {'$set':{'a':3}})
+        self.session.remove(self.Doc, {'_id':3})
+        self.assertEqual(
+            [ (r.operation, r.shape, r.documents)
+              for r in self.recorder.records ],
+            [ ('get', '{_id: ?}', 1),
+              ('save', '{_id: ?}', 1),
+              ('update_partial', '{_id: ?}', 0),
+              ('remove', '{_id: ?}', 0) ])
+
+    def test_aggregate(self):
+        for i in range(3):
+            self.session.find(self.Doc, {'a':i}).all()
+        self.session.find(self.Doc).all()
+        stats = self.aggregator.stats()
+        self.assertEqual(
+            sorted((s['shape'], s['count'], s['documents']) for s in stats),
+            [ ('{a: ?}', 3, 3), ('{}', 1, 5) ])
+
+    def test_slow_query_logger(self):
+        log = mock.Mock()
+        self.session.profilers = [ SlowQueryLogger(0, log=log) ]
+        self.session.find(self.Doc, {'a':1}).all()
+        self.assertEqual(log.log.call_count, 1)
+        self.assert_('{a: ?}' in log.log.call_args[0])
+        log.reset_mock()
+        self.session.profilers = [ SlowQueryLogger(60, log=log) ]
+        self.session.find(self.Doc, {'a':1}).all()
+        self.assertEqual(log.log.call_count, 0)
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,9 @@
 from unittest import TestCase, main
 from datetime import datetime
+from decimal import Decimal
 
 import ming.datastore
+from ming.base import Object
 from ming import Document, Field
 from ming import schema as S
 
@@ -128,7 +130,206 @@ class TestSchemaItem(TestCase):
 
     def test_nodefault(self):
         self.assertEqual(repr(S.NoDefault), '<NoDefault>')
-    
+
+class TestCompiledSchema(TestCase):
+
+    def setUp(self):
+        self.si = S.SchemaItem.make(dict(
+                a=S.Int(required=True),
+                b=S.String(if_missing='x'),
+                c=[ dict(d=float, e=S.OneOf('x', 'y')) ],
+                f={str:int},
+                g=S.Deprecated(),
+                h=S.Migrate(int, str, str),
+                i=dict(j=datetime, k=S.Value(4)),
+                l=None))
+
+    def assertSame(self, si, value, **kw):
+        expected = si.validate(value, **kw)
+        actual = si.compiled(**kw)(value)
+        self.assertEqual(expected, actual)
+        self.assertEqual(type(expected), type(actual))
+
+    def assertSameInvalid(self, si, value, **kw):
+        try:
+            si.validate(value, **kw)
+        except S.Invalid, inv:
+            expected = inv
+        else:
+            assert False, 'No Invalid raised'
+        try:
+            si.compiled(**kw)(value)
+        except S.Invalid, inv:
+            actual = inv
+        else:
+            assert False, 'No Invalid raised'
+        self.assertEqual(expected.msg, actual.msg)
+        self.assertEqual(type(expected.error_dict), type(actual.error_dict))
+        self.assertEqual(type(expected.error_list), type(actual.error_list))
+
+    def test_valid(self):
+        self.assertSame(self.si, dict(a=1))
+        self.assertSame(self.si, dict(
+                a=1.0, b='foo',
+                c=[dict(d=1.5, e='y'), dict(d=2)],
+                f=dict(x=1, y=2), g='old', h=5,
+                i=dict(j=datetime(2012,2,8,12,42,14,123456), k=4),
+                l=dict(m=[1,2])))
+
+    def test_invalid(self):
+        self.assertSameInvalid(self.si, dict())
+        self.assertSameInvalid(self.si, dict(a='foo', b=5))
+        self.assertSameInvalid(self.si, dict(a=1, c=[dict(e='z'), 5]))
+        self.assertSameInvalid(self.si, dict(a=1, f=dict(x='y')))
+        self.assertSameInvalid(self.si, dict(a=1, i=dict(k=3)))
+        self.assertSameInvalid(self.si, dict(a=1, h=[]))
+        self.assertSameInvalid(self.si, [])
+
+    def test_extra(self):
+        value = dict(a=1, z=5)
+        self.assertSameInvalid(self.si, value)
+        self.assertSame(self.si, value, allow_extra=True)
+        self.assertSame(self.si, value, allow_extra=True, strip_extra=True)
+        self.assertEqual(
+            self.si.compiled(allow_extra=True)(value)['z'], 5)
+        self.assert_('z' not in self.si.compiled(
+                allow_extra=True, strip_extra=True)(value))
+
+    def test_cached(self):
+        self.assert_(self.si.compiled() is self.si.compiled())
+        self.assert_(self.si.compiled() is not self.si.compiled(allow_extra=True))
+        self.si.extend(S.Object(dict(z=int)))
+        self.assertEqual(self.si.compiled()(dict(a=1, z=2))['z'], 2)
+
+    def test_safe(self):
+        value = dict(a=Decimal('1'), c=[dict(d=Decimal('1.5'))],
+                     l=dict(m=[Decimal('2.5'), 'x']), z=dict(y=Decimal(3)))
+        expected = Object(value)
+        expected.make_safe()
+        expected = self.si.validate(expected, allow_extra=True)
+        actual = self.si.compiled(allow_extra=True, safe=True)(value)
+        self.assertEqual(actual, expected)
+        self.assertEqual(type(actual['l']), Object)
+        self.assertEqual(value['l']['m'][0], Decimal('2.5'))
+        safe = self.si.compiled(allow_extra=True, safe=True)
+        self.assertRaises(AssertionError, safe, dict(a=1, l=(1, 2)))
+        self.assertRaises(AssertionError, safe, dict(a=1, z=set()))
+        # safe values are not copied
+        value = dict(a=1, z=[1, 2])
+        self.assert_(safe(value)['z'] is value['z'])
+
+    def test_safe_defaults(self):
+        si = S.SchemaItem.make(dict(
+                a=S.Float(if_missing=Decimal('1.5')),
+                b=S.Anything(if_missing=lambda: Decimal('2.5'))))
+        safe = si.compiled(safe=True)
+        self.assertEqual(safe({}), dict(a=1.5, b=2.5))
+        self.assertEqual(type(safe({})['a']), float)
+        self.assertEqual(type(safe(dict(a=Decimal('1.5')))['a']), float)
+        si = S.SchemaItem.make(dict(
+                a=S.Object(dict(b=int), if_missing=lambda: dict(b=(1, 2)))))
+        self.assertRaises(AssertionError, si.compiled(safe=True), {})
+
+    def test_defaults(self):
+        default = dict(x=[1, dict(y=datetime(2012, 1, 1))], z='z')
+        si = S.SchemaItem.make(dict(
+                a=S.Anything(if_missing=default),
+                b=dict(c=int, d=dict(e=[int], f=S.String(if_missing='f')))))
+        for validate in (si.validate, si.compiled()):
+            value = validate({})
+            self.assertEqual(value, dict(
+                    a=default, b=dict(c=None, d=dict(e=[], f='f'))))
+            self.assertEqual(type(value['b']['d']), Object)
+            value['a']['x'][1]['y'] = None
+            value['b']['d']['e'].append(1)
+            self.assertEqual(default['x'][1]['y'], datetime(2012, 1, 1))
+            self.assertEqual(validate({})['b']['d']['e'], [])
+
+    def test_extend_nested(self):
+        child = S.Object(dict(a=int))
+        si = S.SchemaItem.make(dict(child=child))
+        validate = si.compiled()
+        self.assertEqual(validate({}), dict(child=dict(a=None)))
+        child.extend(S.Object(dict(b=S.Int(if_missing=2))))
+        validate = si.compiled()
+        self.assertEqual(validate({}), dict(child=dict(a=None, b=2)))
+        self.assertEqual(validate(dict(child=dict(a=1, b=3))),
+                         dict(child=dict(a=1, b=3)))
+
+    def test_if_missing_extend_nested(self):
+        child = S.Object(dict(a=int))
+        si = S.Object(dict(child=child, c=S.Object(dict(child=child))))
+        self.assertEqual(si.if_missing(),
+                         dict(child=dict(a=None), c=dict(child=dict(a=None))))
+        child.extend(S.Object(dict(b=S.Int(if_missing=2))))
+        self.assertEqual(si.if_missing(), dict(
+                child=dict(a=None, b=2), c=dict(child=dict(a=None, b=2))))
+
+    def test_custom_subclass(self):
+        class Upper(S.String):
+            def _validate(self, value, **kw):
+                return value.upper()
+        si = S.SchemaItem.make(dict(a=Upper()))
+        self.assertEqual(si.compiled()(dict(a='foo')), dict(a='FOO'))
+
+    def test_document(self):
+        class Doc(Document):
+            class __mongometa__:
+                name='doc'
+                polymorphic_registry={}
+                polymorphic_on='type'
+                polymorphic_identity='base'
+            _id=Field(int)
+            type=Field(str, if_missing='base')
+        class Derived(Doc):
+            class __mongometa__:
+                polymorphic_identity='derived'
+            type=Field(str, if_missing='derived')
+            b=Field(int, if_missing=5)
+        doc = Doc.make(dict(_id=1, type='derived'))
+        self.assertEqual(type(doc), Derived)
+        self.assertEqual(doc, dict(_id=1, type='derived', b=5))
+        doc = Doc.make(dict(_id=1))
+        self.assertEqual(type(doc), Doc)
+        self.assertEqual(doc, dict(_id=1, type='base'))
+
+class TestValidationProfiler(TestCase):
+
+    def setUp(self):
+        self.profiler = S.enable_profiling()
+        class Doc(Document):
+            class __mongometa__:
+                name='doc'
+            _id=Field(int)
+            a=Field([dict(b=S.OneOf('x', 'y'))])
+            c=Field(S.Migrate(int, str, str))
+        self.Doc = Doc
+
+    def tearDown(self):
+        S.disable_profiling()
+
+    def test_report(self):
+        for i in range(3):
+            self.Doc.make(dict(_id=i, a=[dict(b='x'), dict(b='y')], c=5))
+        self.assertRaises(S.Invalid, self.Doc.make, dict(a=[dict(b='z')]))
+        stats = dict(
+            ((r['collection'], r['path'], r['type']), r)
+            for r in self.profiler.report())
+        self.assertEqual(stats['doc', '', 'Document']['calls'], 4)
+        self.assertEqual(stats['doc', '', 'Document']['invalid'], 1)
+        # invalid documents are validated again to find the errors
+        self.assertEqual(stats['doc', 'a', 'Array']['calls'], 5)
+        self.assertEqual(stats['doc', 'a.b', 'OneOf']['calls'], 14)
+        self.assertEqual(stats['doc', 'a.b', 'OneOf']['invalid'], 8)
+        self.assertEqual(stats['doc', 'c', 'Migrate']['calls'], 4)
+        self.assertEqual(stats['doc', 'c', 'Int']['calls'], 3)
+        self.assertEqual(stats['doc', 'c', 'String']['invalid'], 3)
+        self.profiler.reset()
+        self.assertEqual(self.profiler.report(), [])
+        S.disable_profiling()
+        self.Doc.make(dict(_id=1))
+        self.assertEqual(self.profiler.report(), [])
+
 if __name__ == '__main__':
     main()
 
@@ -5,7 +5,9 @@ import mock
 import bson
 import pymongo
 
+import ming.session
 from ming import Document, Field
+from ming.base import Object
 from ming import schema as S
 from ming.session import Session
 from ming.utils import ThreadLocalProxy
@@ -61,8 +63,8 @@ class TestSession(TestCase):
         sess.group(TestDoc, 'a')
         sess.update_partial(TestDoc, dict(a=5), dict(b=6), False)
 
-        impl.find_one.assert_called_with(dict(a=5))
-        impl.find.assert_called_with(dict(a=5))
+        impl.find_one.assert_called_with(dict(a=5), as_class=Object)
+        impl.find.assert_called_with(dict(a=5), as_class=Object)
         impl.remove.assert_called_with(dict(a=5), safe=True)
         impl.group.assert_called_with('a')
         impl.update.assert_called_with(dict(a=5), dict(b=6), False, safe=True)
@@ -97,7 +99,7 @@ class TestSession(TestCase):
         sess.find_by(self.TestDoc, a=5)
         sess.count(self.TestDoc)
         sess.ensure_index(self.TestDoc, 'a')
-        impl.find.assert_called_with(dict(a=5))
+        impl.find.assert_called_with(dict(a=5), as_class=Object)
         impl.count.assert_called_with()
         impl.ensure_index.assert_called_with([ ('a', pymongo.ASCENDING) ])
         impl.ensure_index.reset_mock()
@@ -141,6 +143,34 @@ class TestSession(TestCase):
 
         self.assertRaises(ValueError, sess.remove, doc, foobar='baz')
 
+    def test_insert_many(self):
+        impl = self.bind.db['test_doc']
+        impl.insert.side_effect = lambda docs, safe: [ d['a'] for d in docs ]
+        docs = [ self.TestDoc(dict(a=i)) for i in range(4) ]
+        ids = self.session.insert_many(docs)
+        self.assertEqual(ids, range(4))
+        self.assertEqual(impl.insert.call_count, 1)
+        self.assertEqual(impl.insert.call_args[0][0][2],
+                         dict(_id=None, a=2, b=dict(a=None),
+                              cc=dict(dd=None, ee=None)))
+        impl.insert.reset_mock()
+        self.session.insert_many(docs, batch_bytes=100)
+        self.assertEqual(impl.insert.call_count, 2)
+        self.assertEqual(
+            [ len(args[0]) for args, kw in impl.insert.call_args_list ], [2, 2])
+
+    def test_insert_many_sizes_sampled(self):
+        impl = self.bind.db['test_doc']
+        impl.insert.side_effect = lambda docs, safe: [ d['a'] for d in docs ]
+        docs = [ self.TestDoc(dict(a=i)) for i in range(40) ]
+        with mock.patch.object(
+            ming.session, '_encoded_size', return_value=10) as size:
+            self.session.insert_many(docs, batch_bytes=100)
+        self.assertEqual(size.call_count, 3)
+        self.assertEqual(
+            [ len(args[0]) for args, kw in impl.insert.call_args_list ],
+            [10, 10, 10, 10])
+
 class TestThreadLocalSession(TestSession):
 
     def setUp(self):